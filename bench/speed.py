@@ -135,6 +135,14 @@ NON_WORDS_1k = ['ыва', 'xyz', 'соы', 'Axx', 'avы']*200
             0.01,
             5,
         ),
+        ("key_ids() (hits)", "data.key_ids(WORDS100k)", "M ops/sec", 0.1, 3),
+        (
+            "key_ids() (misses)",
+            "data.key_ids(NON_WORDS_10k)",
+            "M ops/sec",
+            0.01,
+            5,
+        ),
         (
             "__contains__ (hits)",
             "for word in WORDS100k: word in data",
@@ -160,6 +168,74 @@ NON_WORDS_1k = ['ыва', 'xyz', 'соы', 'Axx', 'avы']*200
             full_test_name = f"{name} {test_name}"
             bench(full_test_name, timer, descr, op_count, repeats, 9)
 
+    # reverse lookups
+    ids_setup = trie_setup + "IDS = list(range(len(data)))"
+    for name, test in [
+        ("restore_key()", "for key_id in IDS: data.restore_key(key_id)"),
+        ("restore_keys()", "data.restore_keys(IDS)"),
+        ("restore_keys(joined=True)", "data.restore_keys(IDS, joined=True)"),
+    ]:
+        bench(f"Trie {name}", timeit.Timer(test, ids_setup), runs=3, text_width=45)
+
+    # misses with and without a negative-lookup prefilter
+    prefilter_setup = common_setup + (
+        "import marisa_trie\n"
+        "B_NON_WORDS100k = [word.encode('utf8') for word in NON_WORDS100k]\n"
+    )
+    prefilter_structures = [
+        ("Trie", "marisa_trie.Trie(WORDS100k, prefilter={})", "NON_WORDS100k"),
+        (
+            "BinaryTrie",
+            "marisa_trie.BinaryTrie((word.encode('utf8') for word in WORDS100k), "
+            "prefilter={})",
+            "B_NON_WORDS100k",
+        ),
+        (
+            "StringTrie",
+            "marisa_trie.StringTrie(((word, word) for word in set(WORDS100k)), "
+            "prefilter={})",
+            "NON_WORDS100k",
+        ),
+    ]
+    for name, build, words in prefilter_structures:
+        for test_name, test in [
+            ("__contains__ (misses)", f"for word in {words}: word in data"),
+            ("get() (misses)", f"for word in {words}: data.get(word)"),
+        ]:
+            for prefilter in [False, True]:
+                setup = prefilter_setup + f"data = {build.format(prefilter)}"
+                suffix = ", prefilter" if prefilter else ""
+                bench(
+                    f"{name} {test_name[:-1]}{suffix})",
+                    timeit.Timer(test, setup),
+                    runs=3,
+                    text_width=45,
+                )
+
+    # top-k completions
+    numeric_setup = common_setup + (
+        "import heapq, marisa_trie\n"
+        "from operator import itemgetter\n"
+        "data = marisa_trie.NumericTrie((word, hash(word)) for word in set(WORDS100k))\n"
+        "data.top_k('', 1)"
+    )
+    for name, test in [
+        ("top_k(prefix, 10)", "for prefix in PREFIXES_3_1k: data.top_k(prefix, 10)"),
+        (
+            "nlargest(10, items(prefix))",
+            "for prefix in PREFIXES_3_1k: "
+            "heapq.nlargest(10, data.items(prefix), key=itemgetter(1))",
+        ),
+    ]:
+        bench(
+            f'NumericTrie {name}, prefix="xxx"',
+            timeit.Timer(test, numeric_setup),
+            "K ops/sec",
+            op_count=1,
+            runs=3,
+            text_width=60,
+        )
+
     # trie-specific benchmarks
     for struct_name, setup in structures[1:]:
         _bench_data = [
@@ -0,0 +1,97 @@
+"""Thread scaling of read-only queries against a single shared trie.
+
+Each benchmark splits the same workload across 1, 2, 4 and 8 threads
+which query one (memory mapped) ``Trie`` and reports the aggregate
+throughput. On GIL builds the scaling comes from the library releasing
+the GIL while libmarisa searches the trie.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import marisa_trie
+
+from speed import WORDS100k, PREFIXES_3_1k, format_result
+
+THREAD_COUNTS = [1, 2, 4, 8]
+
+
+def run_threads(func, chunks):
+    barrier = threading.Barrier(len(chunks) + 1)
+
+    def worker(chunk):
+        barrier.wait()
+        func(chunk)
+
+    threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_scaling(name, func, data, op_count, descr="M ops/sec", runs=3, repeats=4):
+    for num_threads in THREAD_COUNTS:
+        # every thread gets the whole ``data`` ``repeats`` times
+        # divided by the number of threads, so the total work is constant
+        work = data * repeats
+        chunks = [work[i::num_threads] for i in range(num_threads)]
+        best = min(run_threads(func, chunks) for _ in range(runs))
+        val = f"{op_count * repeats / best:0.3f}{descr}"
+        format_result(f"{name} ({num_threads} threads)", val, 45)
+
+
+def benchmark():
+    print("\n====== Thread scaling (100k unique unicode words) =======\n")
+    if hasattr(sys, "_is_gil_enabled"):
+        print(f"    GIL enabled: {sys._is_gil_enabled()}\n")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "words.marisa")
+        marisa_trie.Trie(WORDS100k).save(path)
+        trie = marisa_trie.Trie().mmap(path)
+        ids = list(range(len(trie)))
+
+        def contains(words):
+            for word in words:
+                word in trie
+
+        def key_id(words):
+            for word in words:
+                trie.key_id(word)
+
+        def key_ids(words):
+            for i in range(0, len(words), 1000):
+                trie.key_ids(words[i:i + 1000])
+
+        def restore_key(ids):
+            for key_id in ids:
+                trie.restore_key(key_id)
+
+        def prefixes(words):
+            for word in words:
+                trie.prefixes(word)
+
+        def keys(prefixes):
+            for prefix in prefixes:
+                trie.keys(prefix)
+
+        bench_scaling("Trie __contains__", contains, WORDS100k, 0.1)
+        bench_scaling("Trie.key_id", key_id, WORDS100k, 0.1)
+        bench_scaling("Trie.key_ids (batches of 1000)", key_ids, WORDS100k, 0.1)
+        bench_scaling("Trie.restore_key", restore_key, ids, 0.1)
+        bench_scaling("Trie.prefixes", prefixes, WORDS100k, 0.1)
+        bench_scaling(
+            'Trie.keys(prefix="xxx")', keys, PREFIXES_3_1k, 1, " K ops/sec"
+        )
+        del trie
+
+
+if __name__ == "__main__":
+    benchmark()
+    print("\n~~~~~~~~~~~~~~\n")
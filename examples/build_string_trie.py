@@ -3,6 +3,9 @@
 
 Input format:
     one UTF-8 line per record, with "key<TAB>value"
+
+Records are sorted and deduplicated on disk by ``StringTrieBuilder``, so
+inputs larger than the available RAM can be processed.
 """
 
 from __future__ import annotations
@@ -30,12 +33,23 @@ def parse_args() -> argparse.Namespace:
         "--progress-every",
         type=int,
         default=0,
-        help="Print progress every N input lines (0 disables progress logs).",
+        help="Print progress every N records (0 disables progress logs).",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        default=256,
+        help="Memory budget for buffered records in MiB (default: 256).",
+    )
+    parser.add_argument(
+        "--tmpdir",
+        default=None,
+        help="Directory for temporary sorted runs (default: system temp dir).",
     )
     return parser.parse_args()
 
 
-def iter_tsv_pairs(path: str, progress_every: int):
+def iter_tsv_pairs(path: str):
     if path == "-":
         ctx = nullcontext(sys.stdin)
     else:
@@ -46,8 +60,6 @@ def iter_tsv_pairs(path: str, progress_every: int):
             line = raw.rstrip("\n")
             if not line:
                 continue
-            if progress_every > 0 and lineno % progress_every == 0:
-                print(f"read {lineno} lines", file=sys.stderr)
             if "\t" not in line:
                 raise ValueError(
                     f"line {lineno}: expected a TAB separator between key and value"
@@ -56,16 +68,35 @@ def iter_tsv_pairs(path: str, progress_every: int):
             yield key, value
 
 
+def report_progress(stage: str, count: int) -> None:
+    print(f"{stage}: {count}", file=sys.stderr)
+
+
 def main() -> int:
     args = parse_args()
+    builder = marisa_trie.StringTrieBuilder(
+        memory_limit=args.memory_limit * 1024 * 1024,
+        tmpdir=args.tmpdir,
+        progress=report_progress if args.progress_every > 0 else None,
+        progress_every=args.progress_every,
+    )
     try:
-        trie = marisa_trie.StringTrie(
-            iter_tsv_pairs(args.input, args.progress_every)
-        )
+        with builder:
+            builder.update(iter_tsv_pairs(args.input))
+            trie = builder.build()
         trie.save(args.output)
     except Exception as exc:
         print(f"error: {exc}", file=sys.stderr)
         return 1
+
+    stats = builder.stats
+    print(
+        f"{stats['keys']} keys, {stats['values']} unique values, "
+        f"{stats['runs']} sorted runs",
+        file=sys.stderr,
+    )
+    if stats["peak_rss"] is not None:
+        print(f"peak memory: {stats['peak_rss'] / 2**20:.1f} MiB", file=sys.stderr)
     return 0
 
 
@@ -8,11 +8,11 @@ cdef extern from "<marisa/agent.h>" namespace "marisa" nogil:
         key.Key &key()
 
         void set_query(char *str)
-        void set_query(char *ptr, int length)
+        void set_query(char *ptr, size_t length)
         void set_query(int key_id)
 
         void set_key(char *str)
-        void set_key(char *ptr, int length)
+        void set_key(char *ptr, size_t length)
         void set_key(int id)
 
         void clear()
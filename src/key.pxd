@@ -6,16 +6,16 @@ cdef extern from "<marisa/key.h>" namespace "marisa" nogil:
 
         #Key &operator=(Key &query)
 
-        char operator[](int i)
+        char operator[](size_t i)
 
         void set_str(char *str)
-        void set_str(char *ptr, int length)
+        void set_str(char *ptr, size_t length)
         void set_id(int id)
         void set_weight(float weight)
 
         char *ptr()
-        int length()
-        int id()
+        size_t length()
+        size_t id()
         float weight()
 
         void clear()
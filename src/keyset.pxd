@@ -14,16 +14,16 @@ cdef extern from "<marisa/keyset.h>" namespace "marisa" nogil:
         void push_back(key.Key &key, char end_marker)
 
         void push_back(char *str)
-        void push_back(char *ptr, int length)
-        void push_back(char *ptr, int length, float weight)
+        void push_back(char *ptr, size_t length)
+        void push_back(char *ptr, size_t length, float weight)
 
-        key.Key &operator[](int i)
+        key.Key &operator[](size_t i)
 
-        int num_keys()
+        size_t num_keys()
         bint empty()
 
-        int size()
-        int total_length()
+        size_t size()
+        size_t total_length()
 
         void reset()
         void clear()
@@ -1,19 +1,43 @@
 # cython: profile=False, embedsignature=True
 
-from std_iostream cimport stringstream, istream, ostream
-from libc.string cimport strncmp
+cimport cython
+from libc.string cimport memcmp, memcpy, memset, strlen, strncmp
+from libcpp.algorithm cimport pop_heap, push_heap, sort
+from libcpp.string cimport string
+from libcpp.utility cimport pair
+from libcpp.vector cimport vector
 cimport keyset
 cimport key
 cimport agent
 cimport trie
-cimport iostream
 cimport base
 
-from cpython.buffer cimport PyBUF_SIMPLE, Py_buffer, PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release
+from cpython.buffer cimport PyBUF_READ, PyBUF_SIMPLE, PyBUF_WRITE, Py_buffer, PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, PyBuffer_FillInfo
+from cpython.memoryview cimport PyMemoryView_FromMemory
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE, PyBytes_FromStringAndSize
+from cpython.number cimport PyNumber_Index
+from cpython.unicode cimport PyUnicode_AsUTF8AndSize
+from cpython cimport array
 
+import array
+import errno
+import heapq
 import itertools
+import mmap
+import os
+import pickle
+import re
 import struct
+import sys
+import tempfile
+import threading
 import warnings
+import zlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 DEFAULT_CACHE = base.MARISA_DEFAULT_CACHE
 HUGE_CACHE = base.MARISA_HUGE_CACHE
@@ -52,12 +76,71 @@ WEIGHT_ORDER = base.MARISA_WEIGHT_ORDER
 DEFAULT_ORDER = base.MARISA_DEFAULT_ORDER
 
 _STRING_TRIE_MAGIC = b"STRTRIE\x00"
-_STRING_TRIE_VERSION = 1
+_STRING_TRIE_VERSION = 2
 _STRING_TRIE_FLAGS = 0
 _STRING_TRIE_U32_MAX = 2**32 - 1
-_STRING_TRIE_HEADER = struct.Struct("<8sHHIII")
+# magic, version, flags, padding, sizes of the key trie, the value trie and
+# the ID table
+_STRING_TRIE_HEADER = struct.Struct("<8sHH4xQQQ")
+# version 1 stored 32-bit sizes
+_STRING_TRIE_HEADER_V1 = struct.Struct("<8sHHIII")
+_STRING_TRIE_PREFIX = struct.Struct("<8sH")
+
+# libmarisa stores key lengths and key IDs as 32-bit integers. Key IDs are
+# returned as C ints and as array('i') with -1 for missing keys, so the
+# number of keys is capped so that every ID stays positive.
+_MAX_KEY_LENGTH = 2**32 - 1
+_MAX_NUM_KEYS = 2**31 - 1
 _U32 = struct.Struct("<I")
 
+_NUMERIC_TRIE_MAGIC = b"NUMTRIE\x00"
+_NUMERIC_TRIE_VERSION = 1
+# Values are float64 rather than int64.
+_NUMERIC_TRIE_FLOAT = 1
+# magic, version, flags, padding, key trie size, values size; the header
+# is 32 bytes long to keep the values 8-byte aligned.
+_NUMERIC_TRIE_HEADER = struct.Struct("<8sHH4xQQ")
+
+_PAYLOAD_TRIE_MAGIC = b"PLDTRIE\x00"
+_PAYLOAD_TRIE_VERSION = 1
+# magic, version, flags, padding, sizes of the key trie, key offsets,
+# payload offsets and payload blob; 48 bytes to keep the offsets aligned.
+_PAYLOAD_TRIE_HEADER = struct.Struct("<8sHH4xQQQQ")
+_U64 = struct.Struct("<Q")
+_EMPTY_OFFSETS = _U64.pack(0)
+
+_BUNDLE_MAGIC = b"TRIEBNDL"
+_BUNDLE_VERSION = 1
+_BUNDLE_HEADER = struct.Struct("<8sHH4x")
+# index offset and size; the index follows the last section
+_BUNDLE_TRAILER = struct.Struct("<QQ")
+# section offset, size and CRC-32, then the sizes of the name, the type
+# name, the struct format and the value separator stored after the entry
+_BUNDLE_ENTRY = struct.Struct("<QQIHHHH")
+# sections start at page boundaries
+_BUNDLE_ALIGNMENT = 4096
+
+# struct format item: an optional repeat count and a format character
+_STRUCT_ITEM_RE = re.compile(r"\s*(\d*)([xcbB?hHiIlLqQnNefdspP])")
+
+# StringTrieBuilder run files are sequences of (a, b) byte string pairs,
+# each prefixed with the lengths of both strings.
+_RUN_RECORD_HEADER = struct.Struct("<II")
+# Rough per-record overhead of a buffered (bytes, bytes) tuple.
+_RUN_RECORD_OVERHEAD = 150
+# Maximum number of runs merged at once; more runs are merged into one first.
+_MAX_MERGE_RUNS = 64
+
+cdef array.array _ID_ARRAY_TEMPLATE = array.array("i")
+cdef array.array _OFFSET_ARRAY_TEMPLATE = array.array("q")
+cdef array.array _RANK_ARRAY_TEMPLATE = array.array("I")
+
+# Guards the one-time assignment of lazily built lexicographic orders.
+_LEX_ORDER_LOCK = threading.Lock()
+
+# Number of keys collected per GIL release by predictive search loops.
+cdef size_t _PREDICTIVE_BATCH_SIZE = 256
+
 
 cdef inline int getbufptr(object obj, char ** ptr, Py_ssize_t * size, Py_buffer * buf):
     """Get a pointer from bytes/buffer object ``obj``.
@@ -79,17 +162,1993 @@ cdef inline void releasebuf(Py_buffer *buf):
     PyBuffer_Release(buf)
 
 
-cdef class _Trie:
+# Shared memory blocks may be larger than requested (they are rounded up to
+# the page size on some platforms), so the data length is stored in front.
+_SHARED_MEMORY_HEADER = struct.Struct("<Q")
+
+
+@cython.no_gc
+cdef class _SharedMemoryBuffer:
+    """Read-only buffer over a part of a shared memory block.
+
+    Views of the buffer keep it (and so the block) open, whatever order
+    the objects holding them are released in. The block is not visible
+    to the garbage collector through the buffer, so when a trie is
+    collected the block isn't finalized (and closed) before the buffer
+    releases it."""
+    cdef object _shm
+    cdef Py_buffer _view
+    cdef Py_ssize_t _offset
+    cdef Py_ssize_t _size
+
+    def __cinit__(self, shm, Py_ssize_t offset, Py_ssize_t size):
+        PyObject_GetBuffer(shm.buf, &self._view, PyBUF_SIMPLE)
+        self._shm = shm
+        self._offset = offset
+        self._size = size
+
+    def __getbuffer__(self, Py_buffer* buffer, int flags):
+        PyBuffer_FillInfo(buffer, self, <char*>self._view.buf + self._offset,
+                          self._size, 1, flags)
+
+    def __dealloc__(self):
+        if self._shm is not None:
+            PyBuffer_Release(&self._view)
+
+
+def _create_shared_memory(bytes data, name):
+    """Copy ``data`` into a new shared memory block.
+
+    Return the block and a memoryview of the copied data."""
+    from multiprocessing import shared_memory
+    cdef Py_ssize_t header_len = _SHARED_MEMORY_HEADER.size
+    cdef Py_ssize_t size = len(data)
+    shm = shared_memory.SharedMemory(name, create=True, size=header_len + size)
+    _SHARED_MEMORY_HEADER.pack_into(shm.buf, 0, size)
+    shm.buf[header_len:header_len + size] = data
+    return shm, memoryview(_SharedMemoryBuffer(shm, header_len, size))
+
+
+def _attach_shared_memory(name):
+    """Attach to a shared memory block created by _create_shared_memory.
+
+    Return the block and a memoryview of the stored data."""
+    from multiprocessing import shared_memory
+    if sys.version_info >= (3, 13):
+        # the block is owned (and unlinked) by the process which created it
+        shm = shared_memory.SharedMemory(name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name)
+    cdef Py_ssize_t header_len = _SHARED_MEMORY_HEADER.size
+    if shm.size < header_len:
+        raise ValueError("Invalid shared memory block: too small")
+    cdef Py_ssize_t size = _SHARED_MEMORY_HEADER.unpack_from(shm.buf)[0]
+    if size > shm.size - header_len:
+        raise ValueError("Invalid shared memory block: invalid data length")
+    return shm, memoryview(_SharedMemoryBuffer(shm, header_len, size))
+
+
+def _from_shared_memory(cls, args, name):
+    """Unpickle a trie sent by reference to its shared memory block."""
+    return cls(*args).from_shared_memory(name)
+
+
+def _from_pickle_buffer(cls, args, buffer):
+    """Unpickle a trie sent as a protocol 5 buffer by mapping the buffer."""
+    return cls(*args).map(buffer)
+
+
+cdef extern from *:
+    """
+    #include <cstring>
+    #include <istream>
+    #include <ostream>
+    #include <stdexcept>
+    #include <streambuf>
+    #include <vector>
+    #include <marisa/iostream.h>
+    #include <marisa/trie.h>
+
+    typedef Py_ssize_t (*marisa_trie_stream_fn)(void *, char *, Py_ssize_t);
+
+    // A streambuf forwarding to a Python file-like object through ``fn``.
+    // Small writes are collected into chunks, large writes and all reads
+    // are passed through, so nothing past the trie is read from a stream.
+    class MarisaTrieStreamBuf : public std::streambuf {
+     public:
+      MarisaTrieStreamBuf(void *stream, marisa_trie_stream_fn fn,
+                          size_t chunk_size)
+          : stream_(stream), fn_(fn), chunk_(chunk_size) {
+        setp(chunk_.data(), chunk_.data() + chunk_.size());
+      }
+
+     protected:
+      int sync() {
+        Py_ssize_t size = pptr() - pbase();
+        if (size > 0 && fn_(stream_, pbase(), size) != size) {
+          return -1;
+        }
+        setp(chunk_.data(), chunk_.data() + chunk_.size());
+        return 0;
+      }
+
+      int_type overflow(int_type ch) {
+        if (sync() != 0) {
+          return traits_type::eof();
+        }
+        if (!traits_type::eq_int_type(ch, traits_type::eof())) {
+          char c = traits_type::to_char_type(ch);
+          return xsputn(&c, 1) == 1 ? ch : traits_type::eof();
+        }
+        return traits_type::not_eof(ch);
+      }
+
+      std::streamsize xsputn(const char *s, std::streamsize n) {
+        if (n > epptr() - pptr() && sync() != 0) {
+          return 0;
+        }
+        if (n <= epptr() - pptr()) {
+          std::memcpy(pptr(), s, static_cast<size_t>(n));
+          pbump(static_cast<int>(n));
+          return n;
+        }
+        Py_ssize_t written = fn_(stream_, const_cast<char *>(s), n);
+        return written < 0 ? 0 : written;
+      }
+
+      std::streamsize xsgetn(char *s, std::streamsize n) {
+        Py_ssize_t read = fn_(stream_, s, n);
+        return read < 0 ? 0 : read;
+      }
+
+     private:
+      void *stream_;
+      marisa_trie_stream_fn fn_;
+      std::vector<char> chunk_;
+    };
+
+    // A streambuf over a fixed memory block.
+    class MarisaTrieMemoryBuf : public std::streambuf {
+     public:
+      MarisaTrieMemoryBuf(char *data, size_t size) {
+        setp(data, data + size);
+        setg(data, data, data + size);
+      }
+
+      size_t written() const { return pptr() - pbase(); }
+    };
+
+    static void marisa_trie_write_stream(const marisa::Trie &trie, void *stream,
+                                         marisa_trie_stream_fn fn,
+                                         size_t chunk_size) {
+      MarisaTrieStreamBuf buf(stream, fn, chunk_size);
+      std::ostream out(&buf);
+      marisa::write(out, trie);
+      if (buf.pubsync() != 0) {
+        throw std::runtime_error("failed to write the trie");
+      }
+    }
+
+    static void marisa_trie_read_stream(marisa::Trie *trie, void *stream,
+                                        marisa_trie_stream_fn fn) {
+      MarisaTrieStreamBuf buf(stream, fn, 0);
+      std::istream in(&buf);
+      marisa::read(in, trie);
+    }
+
+    static size_t marisa_trie_write_memory(const marisa::Trie &trie,
+                                           char *data, size_t size) {
+      MarisaTrieMemoryBuf buf(data, size);
+      std::ostream out(&buf);
+      marisa::write(out, trie);
+      return buf.written();
+    }
+
+    static void marisa_trie_read_memory(marisa::Trie *trie, const char *data,
+                                        size_t size) {
+      MarisaTrieMemoryBuf buf(const_cast<char *>(data), size);
+      std::istream in(&buf);
+      marisa::read(in, trie);
+    }
+    """
+    ctypedef Py_ssize_t (*_stream_fn)(void*, char*, Py_ssize_t) noexcept
+    void marisa_trie_write_stream(const trie.Trie& t, void* stream, _stream_fn fn,
+                                  size_t chunk_size) except +
+    void marisa_trie_read_stream(trie.Trie* t, void* stream, _stream_fn fn) except +
+    size_t marisa_trie_write_memory(const trie.Trie& t, char* data, size_t size) nogil except +
+    void marisa_trie_read_memory(trie.Trie* t, const char* data, size_t size) nogil except +
+
+
+# Size of the chunks small writes are collected into by Trie.save.
+cdef Py_ssize_t _STREAM_CHUNK_SIZE = 1 << 16
+
+
+cdef class _FileStream:
+    """Reads and writes raw memory through a Python file-like object,
+    keeping the exception it raised for the C++ stream callbacks."""
+    cdef object _file
+    cdef object _error
+    # bytes put back by ``unread``, read again before the file
+    cdef bytes _pending
+
+    def __cinit__(self, file):
+        self._file = file
+        self._error = None
+        self._pending = b""
+
+    cdef Py_ssize_t write(self, char* data, Py_ssize_t size) except -1:
+        cdef Py_ssize_t done = 0
+        while done < size:
+            view = PyMemoryView_FromMemory(data + done, size - done, PyBUF_READ)
+            try:
+                written = self._file.write(view)
+            finally:
+                view.release()
+            # file-likes which return None write everything
+            if written is None:
+                break
+            if written <= 0:
+                raise OSError("write() did not accept any data")
+            done += written
+        return size
+
+    cdef Py_ssize_t readinto(self, char* data, Py_ssize_t size) except -1:
+        cdef Py_ssize_t done = 0, n
+        cdef const unsigned char[::1] chunk
+        if self._pending:
+            done = min(size, len(self._pending))
+            memcpy(data, PyBytes_AS_STRING(self._pending), done)
+            self._pending = self._pending[done:]
+        readinto = getattr(self._file, "readinto", None)
+        while done < size:
+            if readinto is not None:
+                view = PyMemoryView_FromMemory(data + done, size - done, PyBUF_WRITE)
+                try:
+                    n = readinto(view) or 0
+                finally:
+                    view.release()
+            else:
+                chunk = self._file.read(size - done)
+                n = chunk.shape[0]
+                if n > size - done:
+                    raise ValueError("read() returned more data than requested")
+                if n:
+                    memcpy(data + done, &chunk[0], n)
+            if n == 0:
+                break
+            done += n
+        return done
+
+    cdef bytes read(self, Py_ssize_t size):
+        """Read ``size`` bytes, or fewer at the end of the file."""
+        cdef bytes data = PyBytes_FromStringAndSize(NULL, size)
+        cdef Py_ssize_t n = self.readinto(PyBytes_AS_STRING(data), size)
+        return data if n == size else data[:n]
+
+    cdef unread(self, bytes data):
+        """Put ``data`` back to be read again before the rest of the file."""
+        self._pending = data + self._pending
+
+    cdef check(self):
+        """Re-raise the exception raised by the file-like object, if any."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+cdef Py_ssize_t _stream_write(void* stream, char* data, Py_ssize_t size) noexcept:
+    try:
+        return (<_FileStream>stream).write(data, size)
+    except BaseException as e:
+        (<_FileStream>stream)._error = e
+        return -1
+
+
+cdef Py_ssize_t _stream_readinto(void* stream, char* data, Py_ssize_t size) noexcept:
+    try:
+        return (<_FileStream>stream).readinto(data, size)
+    except BaseException as e:
+        (<_FileStream>stream)._error = e
+        return -1
+
+
+cdef bytes _read_header(_FileStream stream, bytes head, header, bytes magic, name):
+    """Read the ``header`` of a serialized ``name`` from ``stream`` given
+    its first bytes ``head``."""
+    head += stream.read(header.size - len(head))
+    if len(head) < header.size:
+        raise ValueError("Invalid %s data: truncated header" % name)
+    if head[:8] != magic:
+        raise ValueError("Invalid %s data: bad magic" % name)
+    return head
+
+
+cdef Trie _read_trie(_FileStream stream, unsigned long long size, name):
+    """Read a ``size`` bytes long trie section of a serialized ``name``
+    from ``stream``."""
+    cdef Trie trie = Trie()
+    try:
+        trie._read_stream(stream)
+    except RuntimeError as e:
+        raise ValueError("Invalid %s data: %s" % (name, e)) from e
+    if <unsigned long long>trie._image_size() != size:
+        raise ValueError("Invalid %s data: invalid payload length" % name)
+    return trie
+
+
+cdef bytes _read_table(_FileStream stream, unsigned long long size, name):
+    """Read a ``size`` bytes long table of a serialized ``name`` from
+    ``stream`` straight into a new bytes object.
+
+    Callers check ``size`` against the sections read before it, so a
+    corrupted length is not allocated."""
+    cdef bytes data = PyBytes_FromStringAndSize(NULL, size)
+    if stream.readinto(PyBytes_AS_STRING(data), size) != <Py_ssize_t>size:
+        raise ValueError("Invalid %s data: truncated" % name)
+    return data
+
+
+cdef extern from *:
+    """
+    #include <errno.h>
+    #include <stdint.h>
+    #include <vector>
+    #ifndef _WIN32
+    #include <sys/mman.h>
+    #include <unistd.h>
+    #endif
+
+    static size_t marisa_trie_page_size() {
+    #ifdef _WIN32
+      return 4096;
+    #else
+      long size = sysconf(_SC_PAGESIZE);
+      return size > 0 ? static_cast<size_t>(size) : 4096;
+    #endif
+    }
+
+    // Widens [ptr, ptr + size) to whole pages, as the calls below need.
+    static void marisa_trie_page_range(const char *ptr, size_t size,
+                                       char **start, size_t *length) {
+      uintptr_t page = marisa_trie_page_size();
+      uintptr_t begin = reinterpret_cast<uintptr_t>(ptr) & ~(page - 1);
+      *start = reinterpret_cast<char *>(begin);
+      *length = reinterpret_cast<uintptr_t>(ptr) + size - begin;
+    }
+
+    // The functions below return 0 on success, errno on failure and
+    // ENOSYS where the platform has no equivalent.
+    static int marisa_trie_madvise(const char *ptr, size_t size, int advice) {
+    #ifdef _WIN32
+      return ENOSYS;
+    #else
+      static const int advices[] = {MADV_NORMAL, MADV_RANDOM,
+                                    MADV_SEQUENTIAL, MADV_WILLNEED};
+      char *start;
+      size_t length;
+      if (size == 0) return 0;
+      marisa_trie_page_range(ptr, size, &start, &length);
+      return madvise(start, length, advices[advice]) == 0 ? 0 : errno;
+    #endif
+    }
+
+    static int marisa_trie_mlock(const char *ptr, size_t size) {
+    #ifdef _WIN32
+      return ENOSYS;
+    #else
+      char *start;
+      size_t length;
+      if (size == 0) return 0;
+      marisa_trie_page_range(ptr, size, &start, &length);
+      return mlock(start, length) == 0 ? 0 : errno;
+    #endif
+    }
+
+    static int marisa_trie_resident_pages(const char *ptr, size_t size,
+                                          size_t *resident, size_t *total) {
+      *resident = *total = 0;
+    #ifdef _WIN32
+      return ENOSYS;
+    #else
+    #ifdef __linux__
+      typedef unsigned char mincore_t;
+    #else
+      typedef char mincore_t;
+    #endif
+      char *start;
+      size_t length, page = marisa_trie_page_size();
+      if (size == 0) return 0;
+      marisa_trie_page_range(ptr, size, &start, &length);
+      std::vector<mincore_t> pages((length + page - 1) / page);
+      if (mincore(start, length, pages.data()) != 0) return errno;
+      for (size_t i = 0; i < pages.size(); ++i) {
+        *resident += pages[i] & 1;
+      }
+      *total = pages.size();
+      return 0;
+    #endif
+    }
+
+    // Reads a byte of every page, faulting the pages in.
+    static void marisa_trie_touch_pages(const char *ptr, size_t size) {
+      const volatile char *data = ptr;
+      size_t page = marisa_trie_page_size();
+      char sink = 0;
+      for (size_t i = 0; i < size; i += page) {
+        sink ^= data[i];
+      }
+      if (size != 0) {
+        sink ^= data[size - 1];
+      }
+      (void)sink;
+    }
+    """
+    int marisa_trie_madvise(const char* ptr, size_t size, int advice) nogil
+    int marisa_trie_mlock(const char* ptr, size_t size) nogil
+    int marisa_trie_resident_pages(const char* ptr, size_t size,
+                                   size_t* resident, size_t* total) nogil
+    void marisa_trie_touch_pages(const char* ptr, size_t size) nogil
+
+
+# Access pattern hints accepted by ``mmap(advice=...)``, in the order of
+# the table in marisa_trie_madvise.
+_MMAP_ADVICE = {"normal": 0, "random": 1, "sequential": 2, "willneed": 3}
+
+
+cdef int _view_range(view, const char** ptr, size_t* size) except -1:
+    """Set ``ptr`` and ``size`` to the memory of memoryview ``view``,
+    which keeps it exported."""
+    cdef char* data = NULL
+    cdef Py_ssize_t length = 0
+    cdef Py_buffer buf
+    if getbufptr(view, &data, &length, &buf) != 0:
+        raise ValueError("Invalid buffer.")
+    releasebuf(&buf)
+    ptr[0] = data
+    size[0] = length
+    return 0
+
+
+cdef _check_errno(int error):
+    if error != 0:
+        raise OSError(error, os.strerror(error))
+
+
+def _mmap_file(path, populate=False, advice=None, lock=False):
+    """Map the file at ``path`` read-only, applying the options of mmap().
+
+    Return a memoryview of the mapping."""
+    cdef const char* ptr
+    cdef size_t size
+    if advice is not None and advice not in _MMAP_ADVICE:
+        raise ValueError(
+            f"advice must be one of {', '.join(map(repr, _MMAP_ADVICE))}")
+    # MAP_POPULATE reads the file in as part of mmap() on Linux, elsewhere
+    # the pages are touched one by one below.
+    populate_flag = getattr(mmap, "MAP_POPULATE", 0) if populate else 0
+    with open(path, "rb") as f:
+        if populate_flag:
+            mapped = mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED | populate_flag,
+                               prot=mmap.PROT_READ)
+        else:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    _view_range(view, &ptr, &size)
+    if advice is not None:
+        error = marisa_trie_madvise(ptr, size, _MMAP_ADVICE[advice])
+        # advice is only a hint, so platforms without madvise ignore it
+        if error != errno.ENOSYS:
+            _check_errno(error)
+    if populate and not populate_flag:
+        with nogil:
+            marisa_trie_touch_pages(ptr, size)
+    if lock:
+        _check_errno(marisa_trie_mlock(ptr, size))
+    return view
+
+
+def _touch_view(view):
+    cdef const char* ptr
+    cdef size_t size
+    _view_range(view, &ptr, &size)
+    # the pages are faulted in by the kernel concurrently with the loop
+    marisa_trie_madvise(ptr, size, _MMAP_ADVICE["willneed"])
+    with nogil:
+        marisa_trie_touch_pages(ptr, size)
+
+
+def _warmup(view, wait):
+    """Touch the pages of ``view`` in a new thread and return the thread.
+
+    The thread holds ``view``, so the memory stays valid even if the
+    trie is reloaded meanwhile."""
+    thread = threading.Thread(
+        target=_touch_view if view is not None else None, args=(view,),
+        name="marisa-trie-warmup", daemon=True)
+    thread.start()
+    if wait:
+        thread.join()
+    return thread
+
+
+def _resident_fraction(view):
+    """Return the fraction of the pages of ``view`` resident in memory,
+    or None if there's no view or the platform can't tell."""
+    cdef const char* ptr
+    cdef size_t size, resident, total
+    if view is None:
+        return None
+    _view_range(view, &ptr, &size)
+    error = marisa_trie_resident_pages(ptr, size, &resident, &total)
+    if error == errno.ENOSYS:
+        return None
+    _check_errno(error)
+    return resident / total if total else 1.0
+
+
+cdef extern from *:
+    """
+    #include <stdint.h>
+
+    // 64-bit FNV-1a with the MurmurHash3 finalizer. The hash is a part of
+    // the saved prefilter format and must not change.
+    static inline uint64_t marisa_trie_prefilter_hash(const char *ptr,
+                                                      size_t length) {
+      uint64_t hash = 14695981039346656037ULL;
+      for (size_t i = 0; i < length; ++i) {
+        hash ^= static_cast<unsigned char>(ptr[i]);
+        hash *= 1099511628211ULL;
+      }
+      hash ^= hash >> 33;
+      hash *= 0xff51afd7ed558ccdULL;
+      hash ^= hash >> 33;
+      hash *= 0xc4ceb9fe1a85ec53ULL;
+      hash ^= hash >> 33;
+      return hash;
+    }
+
+    // A split block Bloom filter: a key sets one bit in each of the eight
+    // little-endian 32-bit words of a single 32-byte block, so a check
+    // reads one cache line.
+    static const uint32_t marisa_trie_prefilter_salt[8] = {
+        0x47b6137bU, 0x44974d91U, 0x8824ad5bU, 0xa2b7289dU,
+        0x705495c7U, 0x2df1424bU, 0x9efc4947U, 0x5c6bfb31U};
+
+    static inline const unsigned char *marisa_trie_prefilter_block(
+        const unsigned char *blocks, uint64_t num_blocks, uint64_t hash) {
+      return blocks + (((hash >> 32) * num_blocks) >> 32) * 32;
+    }
+
+    static void marisa_trie_prefilter_add(unsigned char *blocks,
+                                          uint64_t num_blocks,
+                                          const char *ptr, size_t length) {
+      uint64_t hash = marisa_trie_prefilter_hash(ptr, length);
+      unsigned char *block = const_cast<unsigned char *>(
+          marisa_trie_prefilter_block(blocks, num_blocks, hash));
+      for (int i = 0; i < 8; ++i) {
+        uint32_t bit = (static_cast<uint32_t>(hash) *
+                        marisa_trie_prefilter_salt[i]) >> 27;
+        block[i * 4 + (bit >> 3)] |= static_cast<unsigned char>(1U << (bit & 7));
+      }
+    }
+
+    static bool marisa_trie_prefilter_check(const unsigned char *blocks,
+                                            uint64_t num_blocks,
+                                            const char *ptr, size_t length) {
+      uint64_t hash = marisa_trie_prefilter_hash(ptr, length);
+      const unsigned char *block =
+          marisa_trie_prefilter_block(blocks, num_blocks, hash);
+      for (int i = 0; i < 8; ++i) {
+        uint32_t bit = (static_cast<uint32_t>(hash) *
+                        marisa_trie_prefilter_salt[i]) >> 27;
+        if (!(block[i * 4 + (bit >> 3)] & (1U << (bit & 7)))) {
+          return false;
+        }
+      }
+      return true;
+    }
+    """
+    void marisa_trie_prefilter_add(unsigned char* blocks, unsigned long long num_blocks,
+                                   const char* ptr, size_t length) nogil
+    bint marisa_trie_prefilter_check(const unsigned char* blocks,
+                                     unsigned long long num_blocks,
+                                     const char* ptr, size_t length) nogil
+
+
+# Optional parts of a trie (a prefilter and key weights) are stored right
+# before it, each as a header (magic, version, flags, number of items)
+# followed by the items padded to the header size. The headers come first
+# so that a reader of any stream knows whether a part is there without
+# reading past the trie, and the padding keeps a trie mapped after them
+# aligned. libmarisa and marisa-trie before 1.4.2 can't read a trie with
+# sections; without them the format is the one of libmarisa.
+_SECTION_HEADER = struct.Struct("<8sIIQ8x")
+_PREFILTER_MAGIC = b"MARISAPF"
+_WEIGHTS_MAGIC = b"MARISAWT"
+# (name, version, item size, minimum and maximum number of items) by magic
+_SECTIONS = {
+    _PREFILTER_MAGIC: ("prefilter", 1, 32, 1, 2**32),
+    _WEIGHTS_MAGIC: ("weights", 1, 8, 0, _MAX_NUM_KEYS),
+}
+cdef size_t _PREFILTER_BLOCK_SIZE = 32
+# ~1% false positives
+_PREFILTER_BITS_PER_KEY = 10
+
+
+cdef inline Py_ssize_t _section_padding(Py_ssize_t size):
+    return -size % _SECTION_HEADER.size
+
+
+cdef tuple _parse_section(head):
+    """Return the magic and the size of the items of the section whose
+    header starts ``head`` (bytes or a byte memoryview), or ``(None, 0)``
+    if it doesn't start one."""
+    if len(head) < _SECTION_HEADER.size:
+        return None, 0
+    magic, version, flags, count = _SECTION_HEADER.unpack_from(head)
+    if magic not in _SECTIONS:
+        return None, 0
+    name, expected_version, item_size, min_count, max_count = _SECTIONS[magic]
+    if version != expected_version or flags != 0:
+        raise ValueError("Unsupported %s version: %d" % (name, version))
+    if not min_count <= count <= max_count:
+        raise ValueError("Invalid %s: invalid number of items" % name)
+    return magic, count * item_size
+
+
+cdef bytes _pack_section(bytes magic, items):
+    """Serialize a section with ``items`` (a buffer) of kind ``magic``."""
+    name, version, item_size, _, _ = _SECTIONS[magic]
+    cdef bytes data = bytes(items)
+    return (_SECTION_HEADER.pack(magic, version, 0, len(data) // item_size) +
+            data + b"\0" * _section_padding(len(data)))
+
+
+cdef tuple _split_sections(data):
+    """Split serialized ``data`` into the items of its sections by magic
+    and the offset of the trie following them."""
+    cdef dict sections = {}
+    cdef Py_ssize_t offset = 0, start, size
+    while True:
+        magic, size = _parse_section(data[offset:offset + _SECTION_HEADER.size])
+        if magic is None:
+            return sections, offset
+        start = offset + _SECTION_HEADER.size
+        if start + size > len(data):
+            raise ValueError("Invalid %s: truncated" % _SECTIONS[magic][0])
+        sections[magic] = data[start:start + size]
+        offset = start + size + _section_padding(size)
+
+
+cdef dict _read_sections(_FileStream stream):
+    """Read the sections in front of a trie from ``stream``, putting back
+    the bytes read after them."""
+    cdef dict sections = {}
+    cdef Py_ssize_t size
+    while True:
+        head = stream.read(_SECTION_HEADER.size)
+        magic, size = _parse_section(head)
+        if magic is None:
+            stream.unread(head)
+            return sections
+        items = stream.read(size + _section_padding(size))
+        if len(items) < size + _section_padding(size):
+            raise ValueError("Invalid %s: truncated" % _SECTIONS[magic][0])
+        sections[magic] = items[:size]
+
+
+cdef inline unsigned int _read_u32le(const unsigned char* ptr) noexcept nogil:
+    return (ptr[0] | (ptr[1] << 8) | (ptr[2] << 16) |
+            (<unsigned int>ptr[3] << 24))
+
+
+cdef union _Number64:
+    unsigned long long u
+    long long q
+    double d
+
+
+cdef inline unsigned long long _read_u64le(const unsigned char* ptr) noexcept nogil:
+    cdef unsigned long long value = 0
+    cdef int i
+    for i in range(7, -1, -1):
+        value = (value << 8) | ptr[i]
+    return value
+
+
+cdef inline void _write_u64le(unsigned char* ptr, unsigned long long value) noexcept nogil:
+    cdef int i
+    for i in range(8):
+        ptr[i] = value & 0xff
+        value >>= 8
+
+
+cdef inline void _write_u32le(unsigned char* ptr, unsigned int value) noexcept nogil:
+    ptr[0] = value & 0xff
+    ptr[1] = (value >> 8) & 0xff
+    ptr[2] = (value >> 16) & 0xff
+    ptr[3] = value >> 24
+
+
+cdef bytes _pack_offsets(vector[unsigned long long]& offsets):
+    """Return ``offsets`` as an array of little-endian 64-bit integers."""
+    cdef bytes res = PyBytes_FromStringAndSize(NULL, offsets.size() * 8)
+    cdef unsigned char* ptr = <unsigned char*>PyBytes_AS_STRING(res)
+    cdef size_t i
+    for i in range(offsets.size()):
+        _write_u64le(ptr + i * 8, offsets[i])
+    return res
+
+
+cdef inline int _utf8_decode(const unsigned char* ptr, size_t size,
+                             size_t* width) noexcept nogil:
+    """Decode the UTF-8 character at ``ptr`` and store its length in ``width``.
+
+    Invalid or truncated sequences are decoded byte by byte."""
+    cdef unsigned char lead = ptr[0]
+    cdef size_t length, i
+    cdef int res
+    if lead < 0x80:
+        width[0] = 1
+        return lead
+    elif lead >= 0xF0:
+        length, res = 4, lead & 0x07
+    elif lead >= 0xE0:
+        length, res = 3, lead & 0x0F
+    elif lead >= 0xC0:
+        length, res = 2, lead & 0x1F
+    else:
+        width[0] = 1
+        return lead
+    if length > size:
+        width[0] = 1
+        return lead
+    for i in range(1, length):
+        if (ptr[i] & 0xC0) != 0x80:
+            width[0] = 1
+            return lead
+        res = (res << 6) | (ptr[i] & 0x3F)
+    width[0] = length
+    return res
+
+
+cdef inline int _compare_key(agent.Agent& ag, const char* key,
+                             size_t length) noexcept nogil:
+    """Compare the key found by ``ag`` with ``key`` byte-wise; a proper
+    prefix compares as smaller."""
+    cdef size_t key_len = ag.key().length()
+    cdef int res = memcmp(ag.key().ptr(), key, min(key_len, length))
+    if res == 0:
+        return (key_len > length) - (key_len < length)
+    return res
+
+
+cdef inline size_t _common_prefix_length(const char* a, size_t a_len,
+                                         const char* b, size_t b_len) noexcept nogil:
+    cdef size_t i = 0, length = min(a_len, b_len)
+    while i < length and a[i] == b[i]:
+        i += 1
+    return i
+
+
+cdef int _predictive_batch(trie.Trie* t, agent.Agent& ag, string& buf,
+                           vector[size_t]& ends, vector[int]* ids,
+                           size_t batch_size=_PREDICTIVE_BATCH_SIZE) except -1 nogil:
+    """Run up to ``batch_size`` predictive search steps.
+
+    Found keys are concatenated into ``buf`` with their end offsets stored
+    in ``ends`` (and their IDs in ``ids`` unless it is NULL). Return 1 if
+    the search may have more results and 0 if it is exhausted."""
+    buf.clear()
+    ends.clear()
+    if ids != NULL:
+        ids.clear()
+    while ends.size() < batch_size:
+        if not t.predictive_search(ag):
+            return 0
+        buf.append(ag.key().ptr(), ag.key().length())
+        ends.push_back(buf.size())
+        if ids != NULL:
+            ids.push_back(ag.key().id())
+    return 1
+
+
+def _fuzzy_sort_key(match):
+    return match[2]
+
+
+cdef void _char_offsets(const char* ptr, vector[Py_ssize_t]& matches,
+                        Py_ssize_t* pos, Py_ssize_t* chars) noexcept nogil:
+    """Map the byte offsets of (start, end, id) ``matches`` into UTF-8
+    ``ptr`` to character offsets. Starts must not decrease; ``pos`` and
+    ``chars`` are a byte offset and its character offset, and are moved
+    to the last start so that the text is counted once across calls."""
+    cdef size_t i
+    cdef Py_ssize_t j, end
+    for i in range(0, matches.size(), 3):
+        while pos[0] < matches[i]:
+            if (<unsigned char>ptr[pos[0]] & 0xC0) != 0x80:
+                chars[0] += 1
+            pos[0] += 1
+        end = chars[0]
+        for j in range(pos[0], matches[i + 1]):
+            if (<unsigned char>ptr[j] & 0xC0) != 0x80:
+                end += 1
+        matches[i] = chars[0]
+        matches[i + 1] = end
+
+
+cdef class _LexOrder:
+    """The keys of a trie in lexicographic (byte) order.
+
+    libmarisa has no public node-level traversal, so ordered queries run
+    on this permutation instead: keys with a common prefix occupy a
+    contiguous range of ranks. For every rank it also stores the length
+    of the common prefix with the previous key and the byte following it,
+    which is enough to split a range by the next byte without looking
+    keys up.
+    """
+    cdef vector[unsigned int] ids
+    cdef vector[unsigned int] lcp
+    cdef vector[unsigned char] labels
+    # the next rank with a shorter ``lcp``, for skipping whole subtrees
+    cdef vector[unsigned int] next_lower
+    # for tries storing several entries per key (BytesTrie), the number of
+    # distinct keys among the ranks before every rank; empty otherwise
+    cdef vector[unsigned int] groups
+
+    cdef void _append(self, unsigned int key_id, string& prev, const char* ptr,
+                      size_t length) noexcept nogil:
+        cdef size_t i = 0, common = min(prev.size(), length)
+        while i < common and prev[i] == ptr[i]:
+            i += 1
+        self.ids.push_back(key_id)
+        self.lcp.push_back(i)
+        self.labels.push_back(ptr[i] if i < length else 0)
+        prev.assign(ptr, length)
+
+    cdef void _group(self, size_t key_length) noexcept nogil:
+        """Count the last appended entry as a new key unless it shares its
+        first ``key_length`` bytes and the byte after them (the separator)
+        with the previous entry."""
+        if self.groups.empty():
+            self.groups.push_back(0)
+        self.groups.push_back(self.groups.back() + (self.lcp.back() <= key_length))
+
+    cdef size_t count(self, size_t lo, size_t hi) noexcept nogil:
+        """Return the number of distinct keys in the ranks [lo, hi)."""
+        if self.groups.empty():
+            return hi - lo
+        return self.groups[hi] - self.groups[lo]
+
+    cdef void _finish(self) noexcept nogil:
+        cdef size_t i, num_keys = self.lcp.size()
+        cdef vector[size_t] stack
+        self.next_lower.resize(num_keys)
+        for i in reversed(range(num_keys)):
+            while not stack.empty() and self.lcp[stack.back()] >= self.lcp[i]:
+                stack.pop_back()
+            self.next_lower[i] = num_keys if stack.empty() else stack.back()
+            stack.push_back(i)
+
+    cdef const string* key_at(self, trie.Trie* t, size_t rank, string* key,
+                              size_t* key_rank) noexcept nogil:
+        """Return the key at ``rank``, reusing ``key`` if it is cached
+        (``key_rank[0] == rank``)."""
+        cdef agent.Agent ag
+        if key_rank[0] != rank:
+            ag.set_query(<size_t>self.ids[rank])
+            t.reverse_lookup(ag)
+            key.assign(ag.key().ptr(), ag.key().length())
+            key_rank[0] = rank
+        return key
+
+    cdef size_t bisect(self, trie.Trie* t, size_t lo, size_t hi, const char* key,
+                       size_t length, bint right) noexcept nogil:
+        """Return the first rank in [lo, hi) whose key compares greater than
+        or equal to (greater than if ``right``) ``key``, or ``hi``."""
+        cdef agent.Agent ag
+        cdef size_t mid
+        cdef int res
+        while lo < hi:
+            mid = lo + (hi - lo) // 2
+            ag.set_query(<size_t>self.ids[mid])
+            t.reverse_lookup(ag)
+            res = _compare_key(ag, key, length)
+            if res < 0 or (right and res == 0):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    cdef bint narrow(self, trie.Trie* t, size_t* lo, size_t* hi, size_t depth,
+                     const char* ptr, size_t size, string* key,
+                     size_t* key_rank) noexcept nogil:
+        """Narrow the range [lo, hi) of keys starting with a ``depth`` bytes
+        long prefix to the keys continuing with ``ptr[:size]``, walking the
+        branches below the prefix in order and looking up at most one key
+        per byte (see ``key_at`` for ``key`` and ``key_rank``).
+
+        Return ``False`` and leave the range unchanged if it becomes empty."""
+        cdef size_t i, r, start = lo[0], end = hi[0]
+        cdef unsigned char label, byte
+        cdef const string* first
+        for i in range(size):
+            byte = ptr[i]
+            if start >= end:
+                return False
+            first = self.key_at(t, start, key, key_rank)
+            if first.size() == depth + i:
+                r = start + 1
+                label = self.labels[r] if r < end else 0
+            else:
+                r = start
+                label = first[0][depth + i]
+            while r < end and label < byte:
+                r = self.range_end(r + 1, end, depth + i + 1)
+                if r < end:
+                    label = self.labels[r]
+            if r >= end or label != byte:
+                return False
+            start, end = r, self.range_end(r + 1, end, depth + i + 1)
+        if start >= end:
+            return False
+        lo[0], hi[0] = start, end
+        return True
+
+    cdef size_t range_end(self, size_t rank, size_t hi, size_t length) noexcept nogil:
+        """Return the first rank in [rank, hi) whose key shares fewer than
+        ``length`` bytes with the previous one, or ``hi``."""
+        while rank < hi and self.lcp[rank] >= length:
+            rank = self.next_lower[rank]
+        return min(rank, hi)
+
+
+cdef class _LabelRange:
+    """The keys ``key`` with ``lo <= key < hi`` of a ``LABEL_ORDER`` trie,
+    read in order without an index.
+
+    Predictive search enumerates such a trie in lexicographic order, so
+    the keys from ``lo`` on are the ones starting with ``lo`` followed,
+    for every shorter prefix ``lo[:i]`` from the longest, by the ones
+    starting with ``lo[:i]`` and a byte greater than ``lo[i]``.
+    """
+    # keeps the trie alive
+    cdef object _owner
+    cdef trie.Trie* _trie
+    cdef string _lo, _hi, _query
+    cdef bint _has_hi
+    # set by ``next`` to the current key
+    cdef agent.Agent ag
+    # whether ``ag`` is in a predictive search, and the length of the prefix
+    # of ``lo`` and the byte following it to search for next (-1 when done)
+    cdef bint _active
+    cdef Py_ssize_t _level
+    cdef int _byte
+
+    cdef int _init(self, owner, trie.Trie* t, const char* lo, size_t lo_len,
+                   const char* hi, size_t hi_len, bint has_hi) except -1:
+        self._owner = owner
+        self._trie = t
+        self._lo.assign(lo, lo_len)
+        self._hi.assign(hi, hi_len)
+        self._has_hi = has_hi
+        cdef size_t found = 0, low = 0, high = lo_len, mid
+        with nogil:
+            # the longest prefix of ``lo`` which some key starts with
+            while low <= high:
+                mid = low + (high - low) // 2
+                self.ag.set_query(lo, mid)
+                if self._trie.predictive_search(self.ag):
+                    found, low = mid + 1, mid + 1
+                elif mid == 0:
+                    break
+                else:
+                    high = mid - 1
+        if found == 0:
+            self._level = -1
+        elif found - 1 == lo_len:
+            self.ag.set_query(self._lo.data(), lo_len)
+            self._active = True
+            self._level, self._byte = lo_len, 256
+        else:
+            self._level, self._byte = found - 1, <unsigned char>lo[found - 1] + 1
+        return 0
+
+    cdef bint next(self) noexcept nogil:
+        """Move ``ag`` to the next key; return ``False`` at the end."""
+        while True:
+            if self._active:
+                if self._trie.predictive_search(self.ag):
+                    if self._has_hi and _compare_key(
+                            self.ag, self._hi.data(), self._hi.size()) >= 0:
+                        self._level = -1
+                        self._active = False
+                        return False
+                    return True
+                self._active = False
+            while self._level >= 0 and self._byte > 255:
+                self._level -= 1
+                if self._level >= 0:
+                    self._byte = <unsigned char>self._lo[self._level] + 1
+            if self._level < 0:
+                return False
+            self._query.assign(self._lo.data(), self._level)
+            self._query.push_back(<char>self._byte)
+            self._byte += 1
+            if self._has_hi and self._query.compare(self._hi) >= 0:
+                # every key from here on is at least ``hi``
+                self._level = -1
+                return False
+            self.ag.set_query(self._query.data(), self._query.size())
+            self._active = True
+
+
+# (value score, -rank) of the best key of a range of ranks, and the range
+ctypedef pair[pair[unsigned long long, long long], pair[size_t, size_t]] _TopKEntry
+
+
+cdef class _TopKIndex:
+    """A range maximum tree over the values of a :class:`NumericTrie` (or
+    the weights stored with a :class:`Trie`) in the lexicographic order
+    of its keys.
+
+    The keys starting with a prefix form a range of ranks, and so do the
+    keys of every subtree below it, so the tree gives the upper bound of
+    any subtree in ``O(log n)`` and the ``k`` largest values are found
+    best-first without enumerating the subtree.
+    """
+    # values by rank mapped to unsigned integers with the same order
+    cdef vector[unsigned long long] scores
+    # the best rank of every node; the leaves are at ``num_keys + rank``
+    cdef vector[unsigned int] tree
+
+    cdef void _build(self, const vector[unsigned int]& ids,
+                     const unsigned char* values, bint is_float) noexcept nogil:
+        cdef size_t i, num_keys = ids.size()
+        cdef _Number64 num
+        self.scores.resize(num_keys)
+        self.tree.resize(2 * num_keys)
+        for i in range(num_keys):
+            num.u = _read_u64le(values + <size_t>ids[i] * 8)
+            if is_float and num.d == 0:
+                num.u = 0  # -0.0 ranks as 0.0
+            if not is_float:
+                self.scores[i] = num.u ^ (1ULL << 63)
+            elif num.u >> 63:
+                self.scores[i] = ~num.u
+            else:
+                self.scores[i] = num.u | (1ULL << 63)
+            self.tree[num_keys + i] = i
+        for i in reversed(range(1, num_keys)):
+            self.tree[i] = self._better(self.tree[2 * i], self.tree[2 * i + 1])
+
+    cdef inline size_t _better(self, size_t a, size_t b) noexcept nogil:
+        """Return the rank with the larger value, the smaller one on ties."""
+        if self.scores[b] > self.scores[a] or (
+                self.scores[b] == self.scores[a] and b < a):
+            return b
+        return a
+
+    cdef _TopKEntry entry(self, size_t lo, size_t hi) noexcept nogil:
+        """Return the heap entry of the non-empty range [lo, hi)."""
+        cdef size_t rank = self.best(lo, hi)
+        cdef _TopKEntry res
+        res.first.first = self.scores[rank]
+        res.first.second = -<long long>rank
+        res.second.first = lo
+        res.second.second = hi
+        return res
+
+    cdef size_t best(self, size_t lo, size_t hi) noexcept nogil:
+        """Return the rank of the largest value in the non-empty [lo, hi)."""
+        cdef size_t res = lo, num_keys = self.scores.size()
+        lo += num_keys
+        hi += num_keys
+        while lo < hi:
+            if lo & 1:
+                res = self._better(res, self.tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                res = self._better(res, self.tree[hi])
+            lo >>= 1
+            hi >>= 1
+        return res
+
+    cdef void top_k(self, _LexOrder lex_order, trie.Trie* t, const char* prefix,
+                    size_t length, size_t k, vector[size_t]& ranks) noexcept nogil:
+        """Find the ranks of the ``k`` largest values of the keys starting
+        with ``prefix``, best-first over the maxima of their subranges."""
+        cdef size_t lo = 0, hi = lex_order.ids.size(), rank
+        cdef string key
+        cdef size_t key_rank = hi
+        cdef vector[_TopKEntry] heap
+        cdef _TopKEntry top
+        if k and lex_order.narrow(t, &lo, &hi, 0, prefix, length, &key, &key_rank):
+            heap.push_back(self.entry(lo, hi))
+        while heap.size() and ranks.size() < k:
+            pop_heap(heap.begin(), heap.end())
+            top = heap.back()
+            heap.pop_back()
+            lo, hi = top.second.first, top.second.second
+            rank = <size_t>-top.first.second
+            ranks.push_back(rank)
+            if lo < rank:
+                heap.push_back(self.entry(lo, rank))
+                push_heap(heap.begin(), heap.end())
+            if rank + 1 < hi:
+                heap.push_back(self.entry(rank + 1, hi))
+                push_heap(heap.begin(), heap.end())
+
+
+cdef class _Mappable:
+    """Memory mapping, shared memory and pickling for the tries which can
+    be loaded from a buffer with ``map`` and serialized with ``tobytes``."""
+    # memoryview the trie is mapped from, or None
+    cdef object _buffer
+    # SharedMemory block ``_buffer`` points into, or None
+    cdef object _shm
+
+    cdef void _release_buffer(self):
+        self._buffer = None
+        self._shm = None
+
+    cdef int _clear(self) except -1:
+        """Make the trie empty, dropping any references into its buffer."""
+        raise NotImplementedError
+
+    def close(self):
+        """Make the trie empty and release the buffer it is mapped from.
+
+        The shared memory block of a trie from :meth:`to_shared_memory`
+        or :meth:`from_shared_memory` is closed too (but not unlinked).
+        A block can't be closed while a trie is mapped from it, so use
+        this instead of ``trie.shared_memory.close()``.
+        """
+        shm = self._shm
+        self._clear()
+        self._release_buffer()
+        if shm is not None:
+            shm.close()
+
+    cdef tuple _pickle_args(self):
+        """Return the constructor arguments of an unpickled trie."""
+        return ()
+
+    cdef object _pickle_image(self):
+        """Return the buffer to send out of band when pickling."""
+        return self._buffer if self._buffer is not None else self.tobytes()
+
+    def __reduce__(self):
+        if self._shm is not None:
+            return _from_shared_memory, (self.__class__, self._pickle_args(), self._shm.name)
+        return self.__class__, self._pickle_args(), self.tobytes()
+
+    def __reduce_ex__(self, protocol):
+        # With protocol 5 the serialized trie (or the buffer it is mapped
+        # from) can be sent out of band and is mapped on the receiving side.
+        if protocol < 5 or self._shm is not None:
+            return self.__reduce__()
+        return _from_pickle_buffer, (
+            self.__class__, self._pickle_args(), pickle.PickleBuffer(self._pickle_image()))
+
+    def __setstate__(self, state):
+        self.frombytes(state)
+
+    def mmap(self, path, populate=False, advice=None, lock=False):
+        """Memory map the content of a trie stored in a file.
+
+        This allows to query trie without loading it fully in memory.
+        ``populate=True`` reads the whole file in before returning,
+        ``advice`` ("random", "sequential", "willneed" or "normal") tells
+        the OS how the pages will be accessed and ``lock=True`` locks them
+        in memory (which may need a larger ``RLIMIT_MEMLOCK``).
+        """
+        return self.map(_mmap_file(path, populate, advice, lock))
+
+    def warmup(self, wait=False):
+        """Read the pages of a mapped trie in a background thread.
+
+        This pre-faults a trie opened with :meth:`mmap` so the first
+        queries don't wait for the disk. Return the started
+        :class:`threading.Thread`, which is already finished if ``wait``
+        is true. Tries which aren't mapped have nothing to read.
+        """
+        return _warmup(self._buffer, wait)
+
+    def resident_fraction(self):
+        """Return the fraction (from 0.0 to 1.0) of the pages of a mapped
+        trie which are resident in memory.
+
+        Return None if the trie isn't mapped or the platform can't tell.
+        """
+        return _resident_fraction(self._buffer)
+
+    def to_shared_memory(self, name=None):
+        """Copy the trie into a new shared memory block and use it from there.
+
+        Pickling a trie backed by shared memory (e.g. to send it to
+        ``multiprocessing`` workers) transfers only the block name, and
+        every process maps the same physical copy. The creating process
+        owns the block and should call ``trie.shared_memory.unlink()``
+        when it is no longer needed.
+        """
+        shm, view = _create_shared_memory(self.tobytes(), name)
+        try:
+            self.map(view)
+        except:
+            del view
+            shm.close()
+            shm.unlink()
+            raise
+        self._shm = shm
+        return self
+
+    def from_shared_memory(self, name):
+        """Map a trie from the shared memory block ``name`` created by
+        :meth:`to_shared_memory`, without copying it."""
+        shm, view = _attach_shared_memory(name)
+        self.map(view)
+        self._shm = shm
+        return self
+
+    @property
+    def shared_memory(self):
+        """The :class:`multiprocessing.shared_memory.SharedMemory` block
+        the trie is mapped from, or None."""
+        return self._shm
+
+
+cdef class _Trie(_Mappable):
     cdef trie.Trie* _trie
+    # built on demand by _get_lex_order
+    cdef _LexOrder _lex_order
+    # bytes or memoryview with the blocks of the prefilter, or None
+    cdef object _prefilter
+    cdef const unsigned char* _prefilter_blocks
+    cdef unsigned long long _prefilter_num_blocks
+    # bytes or memoryview with the float64 weights of the keys by ID, or None
+    cdef object _weights
+    cdef const unsigned char* _weights_ptr
+    # built on demand by _get_top_k_index
+    cdef _TopKIndex _top_k_index
 
     cdef bytes _encode_key(self, key):
         return key
 
+    cdef _decode_key(self, const char* ptr, Py_ssize_t length):
+        return ptr[:length]
+
     cdef _get_key(self, agent.Agent& ag):
-        return ag.key().ptr()[:ag.key().length()]
+        return self._decode_key(ag.key().ptr(), ag.key().length())
+
+    cdef const char* _key_ptr(self, object key, Py_ssize_t* size) except NULL:
+        """Return a pointer to the raw bytes of ``key`` and set ``size``.
+
+        The pointer is only valid while ``key`` is alive."""
+        if not isinstance(key, bytes):
+            raise TypeError("key must be bytes, not %s" % type(key).__name__)
+        size[0] = PyBytes_GET_SIZE(key)
+        return PyBytes_AS_STRING(key)
+
+    cdef inline bint _may_contain(self, const char* key, size_t length) noexcept nogil:
+        """Whether ``key`` passes the prefilter; always true without one."""
+        return (self._prefilter_blocks == NULL or
+                marisa_trie_prefilter_check(self._prefilter_blocks,
+                                            self._prefilter_num_blocks, key, length))
+
+    cdef int _set_prefilter(self, blocks) except -1:
+        cdef char* ptr = NULL
+        cdef Py_ssize_t size = 0
+        cdef Py_buffer buf
+        self._prefilter_blocks = NULL
+        self._prefilter_num_blocks = 0
+        self._prefilter = None
+        if blocks is None:
+            return 0
+        if getbufptr(blocks, &ptr, &size, &buf) != 0:
+            raise ValueError("Invalid buffer.")
+        # ``blocks`` is immutable bytes or a memoryview keeping its buffer
+        # exported, so the pointer stays valid after ``buf`` is released.
+        releasebuf(&buf)
+        self._prefilter = blocks
+        self._prefilter_num_blocks = size // _PREFILTER_BLOCK_SIZE
+        self._prefilter_blocks = <const unsigned char*>ptr
+        return 0
+
+    cdef int _build_prefilter(self, bits_per_key) except -1:
+        """Build a prefilter over the keys of the trie with ``bits_per_key``
+        bits per key (True for the default); 0 or None removes it."""
+        if bits_per_key is True:
+            bits_per_key = _PREFILTER_BITS_PER_KEY
+        if not bits_per_key:
+            return self._set_prefilter(None)
+        if self._has_payloads():
+            raise TypeError("%s lookups are not exact key lookups, so they "
+                            "can't use a prefilter" % type(self).__name__)
+        if not 1 <= bits_per_key <= 64:
+            raise ValueError("bits_per_key must be between 1 and 64")
+        cdef unsigned long long num_blocks = max(
+            1, (self._trie.num_keys() * bits_per_key + 255) // 256)
+        cdef size_t size = num_blocks * _PREFILTER_BLOCK_SIZE
+        cdef bytes blocks = PyBytes_FromStringAndSize(NULL, size)
+        cdef unsigned char* ptr = <unsigned char*>PyBytes_AS_STRING(blocks)
+        cdef agent.Agent ag
+        ag.set_query(b"", 0)
+        with nogil:
+            memset(ptr, 0, size)
+            while self._trie.predictive_search(ag):
+                marisa_trie_prefilter_add(ptr, num_blocks, ag.key().ptr(),
+                                          ag.key().length())
+        return self._set_prefilter(blocks)
+
+    cdef int _set_weights(self, weights) except -1:
+        cdef char* ptr = NULL
+        cdef Py_ssize_t size = 0
+        cdef Py_buffer buf
+        self._weights_ptr = NULL
+        self._weights = None
+        self._top_k_index = None
+        if weights is None:
+            return 0
+        if getbufptr(weights, &ptr, &size, &buf) != 0:
+            raise ValueError("Invalid buffer.")
+        # kept alive like the prefilter blocks
+        releasebuf(&buf)
+        self._weights = weights
+        self._weights_ptr = <const unsigned char*>ptr
+        return 0
+
+    cdef int _set_sections(self, dict sections) except -1:
+        """Use the sections read in front of the trie, which is loaded."""
+        weights = sections.get(_WEIGHTS_MAGIC)
+        if weights is not None and len(weights) != self._trie.num_keys() * 8:
+            self._set_prefilter(None)
+            self._set_weights(None)
+            raise ValueError("Invalid weights: the number of weights does not "
+                             "match the number of keys")
+        self._set_prefilter(sections.get(_PREFILTER_MAGIC))
+        self._set_weights(weights)
+        return 0
+
+    cdef list _sections(self):
+        """Return ``(magic, items)`` of the sections stored with the trie."""
+        cdef list res = []
+        if self._prefilter is not None:
+            res.append((_PREFILTER_MAGIC, self._prefilter))
+        if self._weights is not None:
+            res.append((_WEIGHTS_MAGIC, self._weights))
+        return res
+
+    cdef int _clear(self) except -1:
+        self._build([])
+        return 0
+
+    cdef object _pickle_image(self):
+        # a prefilter built after mapping is not in the buffer (weights
+        # can only be stored while building)
+        if self._buffer is not None and (
+                self._prefilter is None or isinstance(self._prefilter, memoryview)):
+            return self._buffer
+        return self.tobytes()
+
+    cdef Py_ssize_t _image_size(self) except -1:
+        """Return the size of :meth:`tobytes` without serializing the trie."""
+        cdef Py_ssize_t size = self._trie.io_size()
+        for _, items in self._sections():
+            size += _SECTION_HEADER.size + len(items) + _section_padding(len(items))
+        return size
+
+    cdef bytes _sections_bytes(self):
+        """Return the serialized sections, or b"" if there are none."""
+        return b"".join([_pack_section(magic, items)
+                         for magic, items in self._sections()])
+
+    cdef object _key_ids(self, keys, int default, object out):
+        # A single Agent is reused for the whole batch and no intermediate
+        # bytes objects are created for the keys. ``key_list`` keeps the
+        # keys (and so the encoded pointers) alive while the GIL is released.
+        cdef list key_list = list(keys)
+        cdef Py_ssize_t num_keys = len(key_list)
+        cdef Py_ssize_t i, length
+        cdef vector[const char*] ptrs
+        cdef vector[Py_ssize_t] lengths
+        cdef int[:] res
+        cdef agent.Agent ag
+
+        if out is None:
+            out = array.clone(_ID_ARRAY_TEMPLATE, num_keys, False)
+        res = out
+        if res.shape[0] < num_keys:
+            raise ValueError(
+                "out has room for %d ids, but %d keys were given" %
+                (res.shape[0], num_keys))
+
+        ptrs.reserve(num_keys)
+        lengths.reserve(num_keys)
+        for i in range(num_keys):
+            ptrs.push_back(self._key_ptr(key_list[i], &length))
+            lengths.push_back(length)
+
+        with nogil:
+            for i in range(num_keys):
+                ag.set_query(<char *>ptrs[i], lengths[i])
+                if self._may_contain(ptrs[i], lengths[i]) and self._trie.lookup(ag):
+                    res[i] = ag.key().id()
+                else:
+                    res[i] = default
+        return out
+
+    cdef int _collect_ids(self, ids, vector[size_t]& res) except -1:
+        """Validate key IDs from a sequence or an integer buffer into ``res``."""
+        cdef const int[:] ids32
+        cdef const long long[:] ids64
+        cdef size_t num_keys = self._trie.num_keys()
+        cdef Py_ssize_t i
+        cdef long long key_id
+
+        # fast paths for int32 and int64 buffers (array.array, NumPy)
+        try:
+            ids32 = ids
+        except (TypeError, ValueError):
+            pass
+        else:
+            res.reserve(ids32.shape[0])
+            for i in range(ids32.shape[0]):
+                if ids32[i] < 0 or <size_t>ids32[i] >= num_keys:
+                    raise KeyError(ids32[i])
+                res.push_back(ids32[i])
+            return 0
+        try:
+            ids64 = ids
+        except (TypeError, ValueError):
+            pass
+        else:
+            res.reserve(ids64.shape[0])
+            for i in range(ids64.shape[0]):
+                if ids64[i] < 0 or <unsigned long long>ids64[i] >= num_keys:
+                    raise KeyError(ids64[i])
+                res.push_back(ids64[i])
+            return 0
+
+        for obj in ids:
+            key_id = obj
+            if key_id < 0 or <unsigned long long>key_id >= num_keys:
+                raise KeyError(obj)
+            res.push_back(key_id)
+        return 0
+
+    cdef object _restore_keys(self, ids, bint joined):
+        # A single Agent is reused and keys are gathered into one buffer
+        # with the GIL released; Python objects are created afterwards.
+        cdef vector[size_t] key_ids
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef agent.Agent ag
+        cdef size_t i, start = 0
+        cdef list res
+        cdef array.array offsets
+
+        self._collect_ids(ids, key_ids)
+        ends.reserve(key_ids.size())
+        with nogil:
+            for i in range(key_ids.size()):
+                ag.set_query(key_ids[i])
+                self._trie.reverse_lookup(ag)
+                buf.append(ag.key().ptr(), ag.key().length())
+                ends.push_back(buf.size())
+
+        if joined:
+            offsets = array.clone(_OFFSET_ARRAY_TEMPLATE, ends.size() + 1, False)
+            offsets.data.as_longlongs[0] = 0
+            for i in range(ends.size()):
+                offsets.data.as_longlongs[i + 1] = ends[i]
+            return buf.data()[:buf.size()], offsets
+
+        res = []
+        for i in range(ends.size()):
+            res.append(self._decode_key(buf.data() + start, ends[i] - start))
+            start = ends[i]
+        return res
+
+    cdef void _scan_range(self, const char* ptr, Py_ssize_t length, bint is_text,
+                          bint longest, bint overlapping, Py_ssize_t* start,
+                          Py_ssize_t stop, vector[Py_ssize_t]& matches) noexcept nogil:
+        """Search the start positions from ``start`` up to ``stop``, adding
+        matches as (start, end, id) triples of byte offsets, and advance
+        ``start`` to the next position to search."""
+        cdef Py_ssize_t pos = start[0], best_end
+        cdef int best_id
+        cdef agent.Agent ag
+        while pos < stop:
+            # only start matches at UTF-8 character boundaries
+            if is_text and (<unsigned char>ptr[pos] & 0xC0) == 0x80:
+                pos += 1
+                continue
+            ag.set_query(ptr + pos, length - pos)
+            best_end = -1
+            while self._trie.common_prefix_search(ag):
+                if ag.key().length() == 0:
+                    continue
+                best_end = pos + ag.key().length()
+                best_id = ag.key().id()
+                if not longest:
+                    matches.push_back(pos)
+                    matches.push_back(best_end)
+                    matches.push_back(best_id)
+                    if not overlapping:
+                        break
+            if longest and best_end != -1:
+                matches.push_back(pos)
+                matches.push_back(best_end)
+                matches.push_back(best_id)
+            if not overlapping and best_end != -1:
+                pos = best_end
+            else:
+                pos += 1
+        start[0] = pos
+
+    cdef list _scan(self, bytes data, bint is_text, bint longest, bint overlapping):
+        # All start positions are searched in one nogil loop.
+        cdef const char* ptr = PyBytes_AS_STRING(data)
+        cdef Py_ssize_t length = PyBytes_GET_SIZE(data)
+        cdef Py_ssize_t start = 0, pos = 0, chars = 0, i
+        cdef vector[Py_ssize_t] matches
+        cdef list res = []
+
+        with nogil:
+            self._scan_range(ptr, length, is_text, longest, overlapping,
+                             &start, length, matches)
+            if is_text:
+                _char_offsets(ptr, matches, &pos, &chars)
+
+        for i in range(matches.size() // 3):
+            res.append((matches[3 * i], matches[3 * i + 1], matches[3 * i + 2]))
+        return res
+
+    def _iter_scan(self, bytes data, bint is_text, bint longest, bint overlapping):
+        # Like _scan, but start positions are searched in chunks and the
+        # matches of every chunk are yielded before the next one.
+        cdef const char* ptr = PyBytes_AS_STRING(data)
+        cdef Py_ssize_t length = PyBytes_GET_SIZE(data)
+        cdef Py_ssize_t start = 0, pos = 0, chars = 0, i
+        cdef vector[Py_ssize_t] matches
+
+        while start < length:
+            matches.clear()
+            with nogil:
+                self._scan_range(ptr, length, is_text, longest, overlapping, &start,
+                                 min(start + _STREAM_CHUNK_SIZE, length), matches)
+                if is_text:
+                    _char_offsets(ptr, matches, &pos, &chars)
+            for i in range(matches.size() // 3):
+                yield matches[3 * i], matches[3 * i + 1], matches[3 * i + 2]
+
+    cdef bint _has_payloads(self) noexcept nogil:
+        """Whether entries are keys followed by a separator and a payload."""
+        return False
+
+    cdef size_t _key_part_length(self, const string& entry) noexcept nogil:
+        """Return the length of the key part of a trie entry."""
+        return entry.size()
+
+    def count(self, prefix=""):
+        """
+        Return the number of keys starting with ``prefix``.
+
+        The first call builds an index of the key order (like
+        :meth:`fuzzy`); after that counting walks the prefix only and
+        does not enumerate the keys.
+        """
+        cdef _LexOrder lex_order = self._get_lex_order()
+        cdef Py_ssize_t length
+        cdef const char* ptr = self._key_ptr(prefix, &length)
+        cdef size_t lo = 0, hi = lex_order.ids.size(), key_rank = hi
+        cdef string key
+        cdef bint found
+        with nogil:
+            found = lex_order.narrow(self._trie, &lo, &hi, 0, ptr, length,
+                                     &key, &key_rank)
+        return lex_order.count(lo, hi) if found else 0
+
+    cdef _TopKIndex _get_top_k_index(self):
+        cdef _TopKIndex index = self._top_k_index
+        if index is not None:
+            return index
+
+        cdef _LexOrder lex_order = self._get_lex_order()
+        index = _TopKIndex.__new__(_TopKIndex)
+        if lex_order.ids.size():
+            with nogil:
+                index._build(lex_order.ids, self._weights_ptr, True)
+
+        with _LEX_ORDER_LOCK:
+            if self._top_k_index is None:
+                self._top_k_index = index
+            return self._top_k_index
+
+    def build_prefilter(self, bits_per_key=_PREFILTER_BITS_PER_KEY):
+        """
+        Build a Bloom filter over the keys which is checked before exact
+        lookups (``in``, ``[]``, :meth:`get`, :meth:`key_id` and
+        :meth:`key_ids`), so most missing keys are rejected without
+        searching the trie or touching its mapped pages. With the default
+        10 bits per key about 1% of missing keys get past the filter;
+        ``bits_per_key=0`` removes it.
+
+        The prefilter is saved, loaded and mapped together with the trie;
+        neither libmarisa nor marisa-trie before 1.4.2 can read a trie saved
+        with it. Return the trie itself. :class:`BytesTrie` and :class:`RecordTrie`
+        don't support prefilters.
+        """
+        self._build_prefilter(bits_per_key)
+        return self
+
+    @property
+    def has_prefilter(self):
+        """Whether the trie has a prefilter (see :meth:`build_prefilter`)."""
+        return self._prefilter is not None
+
+    @property
+    def has_weights(self):
+        """Whether the weights of the keys are stored with the trie."""
+        return self._weights is not None
+
+    def top_k(self, prefix, int k):
+        """
+        Return up to ``k`` ``(key, weight)`` pairs with the largest weights
+        among the keys starting with ``prefix``, ordered by weight from the
+        largest (ties in lexicographic order of keys).
+
+        The trie must be built with ``store_weights=True``. Like
+        :meth:`NumericTrie.top_k`, the first call builds an index over the
+        key order (about 16 bytes per key); after that a search costs
+        ``O(k log n)`` regardless of how many keys match.
+        """
+        if self._weights is None:
+            raise ValueError("the trie has no stored weights; build it "
+                             "with store_weights=True")
+        if k < 0:
+            raise ValueError("k must be non-negative")
+        cdef _TopKIndex index = self._get_top_k_index()
+        cdef _LexOrder lex_order = self._get_lex_order()
+        cdef Py_ssize_t length
+        cdef const char* ptr = self._key_ptr(prefix, &length)
+        cdef size_t rank, key_id
+        cdef vector[size_t] ranks
+        cdef agent.Agent ag
+        cdef _Number64 weight
+        cdef list res = []
+        with nogil:
+            index.top_k(lex_order, self._trie, ptr, length, k, ranks)
+
+        for rank in ranks:
+            key_id = lex_order.ids[rank]
+            ag.set_query(key_id)
+            self._trie.reverse_lookup(ag)
+            weight.u = _read_u64le(self._weights_ptr + key_id * 8)
+            res.append((self._get_key(ag), weight.d))
+        return res
+
+    def has_prefix(self, prefix=""):
+        """Return ``True`` if any key starts with ``prefix``."""
+        cdef Py_ssize_t length
+        cdef const char* ptr = self._key_ptr(prefix, &length)
+        cdef agent.Agent ag
+        cdef bint res
+        ag.set_query(ptr, length)
+        with nogil:
+            res = self._trie.predictive_search(ag)
+        return res
+
+    cdef _LexOrder _get_lex_order(self):
+        cdef _LexOrder lex_order = self._lex_order
+        if lex_order is not None:
+            return lex_order
+
+        cdef size_t i, num_keys = self._trie.num_keys()
+        cdef vector[pair[string, size_t]] keys
+        cdef string prev
+        cdef agent.Agent ag
+        cdef bint grouped = self._has_payloads()
+        lex_order = _LexOrder.__new__(_LexOrder)
+        ag.set_query(b"", 0)
+        with nogil:
+            lex_order.ids.reserve(num_keys)
+            lex_order.lcp.reserve(num_keys)
+            lex_order.labels.reserve(num_keys)
+            if self._trie.node_order() == base.MARISA_LABEL_ORDER:
+                # predictive search already enumerates keys in label order
+                while self._trie.predictive_search(ag):
+                    lex_order._append(ag.key().id(), prev, ag.key().ptr(),
+                                      ag.key().length())
+                    if grouped:
+                        lex_order._group(self._key_part_length(prev))
+            else:
+                keys.reserve(num_keys)
+                while self._trie.predictive_search(ag):
+                    keys.push_back(pair[string, size_t](
+                        string(ag.key().ptr(), ag.key().length()), ag.key().id()))
+                sort(keys.begin(), keys.end())
+                for i in range(num_keys):
+                    lex_order._append(keys[i].second, prev, keys[i].first.data(),
+                                      keys[i].first.size())
+                    if grouped:
+                        lex_order._group(self._key_part_length(prev))
+            lex_order._finish()
+
+        with _LEX_ORDER_LOCK:
+            if self._lex_order is None:
+                self._lex_order = lex_order
+            return self._lex_order
+
+    cdef list _page(self, prefix, limit, after, bint with_ids):
+        """Return keys (or ``(key, ID)`` pairs if ``with_ids``) starting
+        with ``prefix`` in lexicographic order, at most ``limit`` of them,
+        starting right after the key ``after`` if it is not None."""
+        cdef _LexOrder lex_order = self._get_lex_order()
+        cdef Py_ssize_t prefix_len, after_len = 0
+        cdef const char* prefix_ptr = self._key_ptr(prefix, &prefix_len)
+        cdef const char* after_ptr = NULL
+        if after is not None:
+            after_ptr = self._key_ptr(after, &after_len)
+        cdef size_t lo = 0, hi = lex_order.ids.size(), key_rank = hi
+        cdef string key
+        with nogil:
+            if not lex_order.narrow(self._trie, &lo, &hi, 0, prefix_ptr, prefix_len,
+                                    &key, &key_rank):
+                hi = lo
+            elif after_ptr != NULL:
+                lo = lex_order.bisect(self._trie, lo, hi, after_ptr, after_len, True)
+        return self._ranked_keys(lex_order, lo, hi, limit, with_ids)
+
+    cdef int _rank_range(self, _LexOrder lex_order, lo, hi, size_t* start,
+                         size_t* end) except -1:
+        """Find the ranks [start, end) of the keys in [lo, hi), where None
+        stands for an open bound."""
+        cdef Py_ssize_t lo_len = 0, hi_len = 0
+        cdef const char* lo_ptr = NULL
+        cdef const char* hi_ptr = NULL
+        if lo is not None:
+            lo_ptr = self._key_ptr(lo, &lo_len)
+        if hi is not None:
+            hi_ptr = self._key_ptr(hi, &hi_len)
+        start[0], end[0] = 0, lex_order.ids.size()
+        with nogil:
+            if lo_ptr != NULL:
+                start[0] = lex_order.bisect(self._trie, 0, end[0], lo_ptr, lo_len, False)
+            if hi_ptr != NULL:
+                end[0] = max(start[0], lex_order.bisect(
+                    self._trie, start[0], end[0], hi_ptr, hi_len, False))
+        return 0
+
+    cdef _LabelRange _label_range(self, lo, hi):
+        """Return the keys in [lo, hi) of a ``LABEL_ORDER`` trie, where
+        None stands for an open bound."""
+        cdef Py_ssize_t lo_len = 0, hi_len = 0
+        cdef const char* lo_ptr = NULL
+        cdef const char* hi_ptr = NULL
+        if lo is not None:
+            lo_ptr = self._key_ptr(lo, &lo_len)
+        if hi is not None:
+            hi_ptr = self._key_ptr(hi, &hi_len)
+        cdef _LabelRange keys = _LabelRange.__new__(_LabelRange)
+        keys._init(self, self._trie, lo_ptr, lo_len, hi_ptr, hi_len, hi is not None)
+        return keys
+
+    cdef list _range(self, lo, hi, limit):
+        """Return the keys in [lo, hi) in lexicographic order, at most
+        ``limit`` of them (see :meth:`Trie.range`)."""
+        cdef size_t start, end
+        cdef _LexOrder lex_order
+        if self._trie.node_order() != base.MARISA_LABEL_ORDER:
+            lex_order = self._get_lex_order()
+            self._rank_range(lex_order, lo, hi, &start, &end)
+            return self._ranked_keys(lex_order, start, end, limit, False)
+
+        cdef _LabelRange keys = self._label_range(lo, hi)
+        cdef size_t count = self._trie.num_keys()
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef list res = []
+        if limit is not None:
+            if limit < 0:
+                raise ValueError("limit must be non-negative")
+            count = min(count, <size_t>limit)
+        with nogil:
+            while ends.size() < count and keys.next():
+                buf.append(keys.ag.key().ptr(), keys.ag.key().length())
+                ends.push_back(buf.size())
+        start = 0
+        for end in ends:
+            res.append(self._decode_key(buf.data() + start, end - start))
+            start = end
+        return res
+
+    def _iter_range(self, lo, hi, limit):
+        """Yield the keys of :meth:`_range`."""
+        cdef size_t start, end
+        cdef _LexOrder lex_order = None
+        cdef _LabelRange keys = None
+        cdef agent.Agent ag
+        cdef bint found
+        if self._trie.node_order() == base.MARISA_LABEL_ORDER:
+            keys = self._label_range(lo, hi)
+            start, end = 0, self._trie.num_keys()
+        else:
+            lex_order = self._get_lex_order()
+            self._rank_range(lex_order, lo, hi, &start, &end)
+        if limit is not None:
+            if limit < 0:
+                raise ValueError("limit must be non-negative")
+            end = min(end, start + <size_t>limit)
+        while start < end:
+            if keys is not None:
+                with nogil:
+                    found = keys.next()
+                if not found:
+                    break
+                yield self._get_key(keys.ag)
+            else:
+                ag.set_query(<size_t>lex_order.ids[start])
+                with nogil:
+                    self._trie.reverse_lookup(ag)
+                yield self._get_key(ag)
+            start += 1
+
+    cdef list _ranked_keys(self, _LexOrder lex_order, size_t lo, size_t hi,
+                           limit, bint with_ids):
+        """Return the keys (or ``(key, ID)`` pairs) at ranks [lo, hi), at
+        most ``limit`` of them."""
+        if limit is not None:
+            if limit < 0:
+                raise ValueError("limit must be non-negative")
+            hi = min(hi, lo + <size_t>limit)
+        cdef size_t r, start = 0
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef agent.Agent ag
+        cdef list res = []
+        with nogil:
+            for r in range(lo, hi):
+                ag.set_query(<size_t>lex_order.ids[r])
+                self._trie.reverse_lookup(ag)
+                buf.append(ag.key().ptr(), ag.key().length())
+                ends.push_back(buf.size())
+
+        for r in range(ends.size()):
+            item = self._decode_key(buf.data() + start, ends[r] - start)
+            res.append((item, lex_order.ids[lo + r]) if with_ids else item)
+            start = ends[r]
+        return res
+
+    cdef list _fuzzy(self, query, bint is_text, int max_distance):
+        # Depth-first search over the lexicographic order: every frame is a
+        # prefix with its range of ranks and a Levenshtein DP row. Children
+        # are split off by the next byte using the common prefix lengths;
+        # a key is only looked up when the search moves to a new rank, and
+        # branches are pruned once the row minimum exceeds ``max_distance``.
+        # For text, the DP row only advances once a UTF-8 sequence is
+        # complete.
+        if max_distance < 0:
+            raise ValueError("max_distance must be non-negative")
+        cdef _LexOrder lex_order = self._get_lex_order()
+        cdef const unsigned int* order = lex_order.ids.data()
+        cdef size_t num_keys = lex_order.ids.size()
+        cdef vector[int] symbols
+        cdef size_t m
+        cdef vector[int] rows
+        cdef vector[size_t] frame_len, frame_next, frame_hi, frame_char
+        cdef string found_keys
+        cdef vector[size_t] found_ends
+        cdef vector[int] found_ids, found_distances
+        cdef agent.Agent ag
+        cdef size_t plen, child_len, char_start, width, r, end, row_start, j
+        cdef size_t cur_rank = num_keys
+        cdef string cur_key
+        cdef int symbol, row_min, cost
+        cdef int* parent_row
+        cdef int* row
+        cdef bint is_key
+        cdef list res = []
+
+        if is_text:
+            symbols = [ord(ch) for ch in query]
+        else:
+            symbols = list(query)
+        m = symbols.size()
+
+        with nogil:
+            for j in range(m + 1):
+                rows.push_back(j)
+            frame_len.push_back(0)
+            frame_next.push_back(0)
+            frame_hi.push_back(num_keys)
+            frame_char.push_back(0)
+            if num_keys:
+                ag.set_query(<size_t>order[0])
+                self._trie.reverse_lookup(ag)
+                if ag.key().length() == 0:
+                    frame_next[0] = 1
+                    if <int>m <= max_distance:
+                        found_ends.push_back(0)
+                        found_ids.push_back(order[0])
+                        found_distances.push_back(m)
+
+            while frame_next.size():
+                r = frame_next.back()
+                if r >= frame_hi.back():
+                    frame_len.pop_back()
+                    frame_next.pop_back()
+                    frame_hi.pop_back()
+                    frame_char.pop_back()
+                    rows.resize(rows.size() - (m + 1))
+                    continue
+
+                if r != cur_rank:
+                    ag.set_query(<size_t>order[r])
+                    self._trie.reverse_lookup(ag)
+                    cur_key.assign(ag.key().ptr(), ag.key().length())
+                    cur_rank = r
+                plen = frame_len.back()
+                child_len = plen + 1
+                end = lex_order.range_end(r + 1, frame_hi.back(), child_len)
+                frame_next[frame_next.size() - 1] = end
+                is_key = cur_key.size() == child_len
+
+                row_start = rows.size()
+                rows.resize(row_start + m + 1)
+                parent_row = &rows[row_start - m - 1]
+                row = &rows[row_start]
+                char_start = frame_char.back()
+                if is_text:
+                    symbol = _utf8_decode(
+                        <const unsigned char*>cur_key.data() + char_start,
+                        cur_key.size() - char_start, &width)
+                    if char_start + width > child_len:
+                        # inside a multi-byte character: carry the row over
+                        for j in range(m + 1):
+                            row[j] = parent_row[j]
+                        frame_len.push_back(child_len)
+                        frame_next.push_back(r)
+                        frame_hi.push_back(end)
+                        frame_char.push_back(char_start)
+                        continue
+                else:
+                    symbol = <unsigned char>cur_key[plen]
+
+                row[0] = parent_row[0] + 1
+                row_min = row[0]
+                for j in range(1, m + 1):
+                    cost = parent_row[j - 1] + (symbols[j - 1] != symbol)
+                    row[j] = min(cost, min(parent_row[j], row[j - 1]) + 1)
+                    row_min = min(row_min, row[j])
+                if row_min > max_distance:
+                    rows.resize(row_start)
+                    continue
+
+                if is_key and row[m] <= max_distance:
+                    found_keys.append(cur_key)
+                    found_ends.push_back(found_keys.size())
+                    found_ids.push_back(order[r])
+                    found_distances.push_back(row[m])
+                frame_len.push_back(child_len)
+                frame_next.push_back(r + 1 if is_key else r)
+                frame_hi.push_back(end)
+                frame_char.push_back(child_len)
+
+        r = 0
+        for j in range(found_ids.size()):
+            res.append((self._decode_key(found_keys.data() + r, found_ends[j] - r),
+                        found_ids[j], found_distances[j]))
+            r = found_ends[j]
+        res.sort(key=_fuzzy_sort_key)
+        return res
 
     def __init__(self, arg=None, num_tries=DEFAULT_NUM_TRIES, binary=False,
-                 cache_size=DEFAULT_CACHE, order=DEFAULT_ORDER, weights=None):
+                 cache_size=DEFAULT_CACHE, order=DEFAULT_ORDER, weights=None,
+                 prefilter=False, store_weights=False):
         """
         ``arg`` can be one of the following:
 
@@ -97,7 +2156,13 @@ cdef class _Trie:
         * None (if you're going to load a trie later).
 
         Pass a ``weights`` iterable with expected lookup frequencies
-        to optimize lookup and prefix search speed.
+        to optimize lookup and prefix search speed. Pass ``prefilter=True``
+        (or a number of bits per key) to build a Bloom filter which rejects
+        most missing keys before the trie is searched; see
+        :meth:`Trie.build_prefilter`. Pass ``store_weights=True`` to keep
+        the weights (summed over duplicate keys) with the trie for
+        :meth:`top_k`; neither libmarisa nor marisa-trie before 1.4.2 can
+        read a trie saved with stored weights.
         """
 
         if self._trie:
@@ -112,7 +2177,9 @@ cdef class _Trie:
             num_tries=num_tries,
             binary=binary,
             cache_size=cache_size,
-            order=order
+            order=order,
+            prefilter=prefilter,
+            store_weights=store_weights,
         )
 
     def __dealloc__(self):
@@ -129,29 +2196,84 @@ cdef class _Trie:
         binary_flag = BINARY_TAIL if binary else TEXT_TAIL
         return num_tries | binary_flag | cache_size | order
 
-    def _build(self, byte_keys, weights=None, **options):
+    def _build(self, byte_keys, weights=None, bint with_ids=False, prefilter=False,
+               bint store_weights=False, **options):
         if weights is None:
             weights = itertools.repeat(1.0)
 
         cdef char* data
         cdef float weight
+        cdef int config_flags = self._config_flags(**options)
         cdef keyset.Keyset *ks = new keyset.Keyset()
+        cdef array.array ids = None
+        cdef int* ids_ptr
+        cdef bytes stored_weights = None
+        cdef unsigned char* weights_ptr
+        # libmarisa overwrites the weights in the keyset with the key IDs
+        cdef vector[float] key_weights
+        cdef vector[double] sums
+        cdef _Number64 num
+        cdef Py_ssize_t i, num_keys
 
         try:
             for key, weight in zip(byte_keys, weights):
+                if len(key) > _MAX_KEY_LENGTH:
+                    raise ValueError(
+                        "key is too long (%d bytes): libmarisa supports keys "
+                        "of up to %d bytes" % (len(key), _MAX_KEY_LENGTH))
                 ks.push_back(<char *>key, len(key), weight)
-            self._trie.build(ks[0], self._config_flags(**options))
+                if store_weights:
+                    key_weights.push_back(weight)
+            num_keys = ks.size()
+            if num_keys > _MAX_NUM_KEYS:
+                raise ValueError("too many keys (%d): libmarisa supports up to "
+                                 "%d keys" % (num_keys, _MAX_NUM_KEYS))
+            if with_ids:
+                ids = array.clone(_ID_ARRAY_TEMPLATE, num_keys, False)
+                ids_ptr = ids.data.as_ints
+            self._lex_order = None
+            with nogil:
+                self._trie.build(ks[0], config_flags)
+                # libmarisa stores the final key IDs in the keyset.
+                if with_ids:
+                    for i in range(num_keys):
+                        ids_ptr[i] = ks[0][i].id()
+            if store_weights:
+                stored_weights = PyBytes_FromStringAndSize(
+                    NULL, self._trie.num_keys() * 8)
+                weights_ptr = <unsigned char*>PyBytes_AS_STRING(stored_weights)
+                with nogil:
+                    # duplicate keys share an ID, and their weights add up
+                    sums.resize(self._trie.num_keys())
+                    for i in range(num_keys):
+                        sums[ks[0][i].id()] += key_weights[i]
+                    for i in range(<Py_ssize_t>sums.size()):
+                        num.d = sums[i]
+                        _write_u64le(weights_ptr + i * 8, num.u)
         finally:
             del ks
+        self._set_weights(stored_weights)
+        self._build_prefilter(prefilter)
+        return ids
+
+    @classmethod
+    def _build_with_ids(cls, keys, weights=None, **options):
+        cdef _Trie res = cls()
+        ids = res._build(
+            (res._encode_key(key) for key in keys), weights, True, **options)
+        return res, ids
 
     def __richcmp__(self, other, int op):
+        cdef bint res
         if op == 2:    # ==
             if other is self:
                 return True
             elif not isinstance(other, _Trie):
                 return False
 
-            return (<_Trie>self)._equals(other)
+            with nogil:
+                res = (<_Trie>self)._equals(<_Trie>other)
+            return res
         elif op == 3:  # !=
             return not (self == other)
 
@@ -159,7 +2281,7 @@ cdef class _Trie:
             self.__class__, other.__class__))
 
     cdef bint _equals(self, _Trie other) nogil:
-        cdef int num_keys = self._trie.num_keys()
+        cdef size_t num_keys = self._trie.num_keys()
         cdef base.NodeOrder node_order = self._trie.node_order()
         if (other._trie.num_keys() != num_keys or
             other._trie.node_order() != node_order):
@@ -168,7 +2290,7 @@ cdef class _Trie:
         cdef agent.Agent ag1, ag2
         ag1.set_query(b"")
         ag2.set_query(b"")
-        cdef int i
+        cdef size_t i
         cdef key.Key key1, key2
         for i in range(num_keys):
             self._trie.predictive_search(ag1)
@@ -192,8 +2314,13 @@ cdef class _Trie:
 
     cdef bint _contains(self, bytes key):
         cdef agent.Agent ag
-        ag.set_query(key, len(key))
-        return self._trie.lookup(ag)
+        cdef bint res
+        cdef const char* ptr = PyBytes_AS_STRING(key)
+        cdef size_t length = PyBytes_GET_SIZE(key)
+        ag.set_query(ptr, length)
+        with nogil:
+            res = self._may_contain(ptr, length) and self._trie.lookup(ag)
+        return res
 
     def read(self, f):
         """Read a trie from an open file.
@@ -209,7 +2336,10 @@ cdef class _Trie:
         warnings.warn("Trie.read is deprecated and will "
                       "be removed in marisa_trie 0.8.0. Please use "
                       "Trie.load instead.", DeprecationWarning)
+        self._lex_order = None
         self._trie.read(f.fileno())
+        self._set_sections({})
+        self._release_buffer()
         return self
 
     def write(self, f):
@@ -229,59 +2359,120 @@ cdef class _Trie:
         self._trie.write(f.fileno())
 
     def save(self, path):
-        """Save a trie to a specified path."""
-        with open(path, 'w') as f:
+        """Save a trie to a specified path or a binary file-like object.
+
+        A file-like object only needs a ``write`` method. The trie is
+        written to it in chunks, without serializing it in memory first.
+        The prefilter and the stored weights, if any, are written in front
+        of the trie; neither libmarisa nor marisa-trie before 1.4.2 can read
+        such a file.
+        """
+        cdef bytes sections = self._sections_bytes()
+        if hasattr(path, "write"):
+            stream = _FileStream(path)
+            stream.write(sections, len(sections))
+            try:
+                marisa_trie_write_stream(self._trie[0], <void*>stream, _stream_write,
+                                         _STREAM_CHUNK_SIZE)
+            except RuntimeError:
+                stream.check()
+                raise
+            return
+        with open(path, 'wb') as f:
+            f.write(sections)
+            f.flush()
             self._trie.write(f.fileno())
 
+    cdef int _read_stream(self, _FileStream stream) except -1:
+        """Read the trie, with its prefilter and weights, from ``stream``."""
+        sections = _read_sections(stream)
+        self._lex_order = None
+        try:
+            marisa_trie_read_stream(self._trie, <void*>stream, _stream_readinto)
+        except RuntimeError:
+            stream.check()
+            raise
+        self._release_buffer()
+        self._set_sections(sections)
+        return 0
+
     def load(self, path):
-        """Load a trie from a specified path."""
-        with open(path, 'r') as f:
+        """Load a trie from a specified path or a binary file-like object.
+
+        A file-like object needs a ``readinto`` or a ``read`` method; only
+        the bytes of the trie (and of its prefilter and weights) are read
+        from it, so several tries can be loaded from one stream in turn.
+        """
+        cdef _FileStream stream
+        if hasattr(path, "readinto") or hasattr(path, "read"):
+            self._read_stream(_FileStream(path))
+            return self
+        # unbuffered, so the descriptor is where the trie starts
+        with open(path, 'rb', buffering=0) as f:
+            stream = _FileStream(f)
+            sections = _read_sections(stream)
+            # rewind past the bytes read after the sections
+            f.seek(-len(stream._pending), 1)
+            self._lex_order = None
             self._trie.read(f.fileno())
+            self._release_buffer()
+            self._set_sections(sections)
         return self
 
     cpdef bytes tobytes(self) except +:
-        """Return raw trie content as bytes."""
-        cdef stringstream stream
-        iostream.write((<ostream *> &stream)[0], self._trie[0])
-        cdef bytes res = stream.str()
+        """Return raw trie content (preceded by the prefilter and the
+        stored weights, which libmarisa and marisa-trie before 1.4.2 can't
+        read) as bytes."""
+        cdef bytes sections = self._sections_bytes()
+        cdef size_t offset = len(sections)
+        cdef size_t size = self._trie.io_size()
+        cdef bytes res = PyBytes_FromStringAndSize(NULL, offset + size)
+        cdef char* data = PyBytes_AS_STRING(res)
+        memcpy(data, PyBytes_AS_STRING(sections), offset)
+        with nogil:
+            size = marisa_trie_write_memory(self._trie[0], data + offset, size)
+        if offset + size != <size_t>PyBytes_GET_SIZE(res):
+            raise RuntimeError("trie size does not match io_size()")
         return res
 
     cpdef frombytes(self, bytes data) except +:
         """Load a trie from raw bytes generated by :meth:`tobytes`."""
-        cdef stringstream* stream = new stringstream(data)
-        try:
-            iostream.read((<istream *> stream)[0], self._trie)
-        finally:
-            del stream
+        sections, offset = _split_sections(data)
+        cdef const char* ptr = PyBytes_AS_STRING(data) + <Py_ssize_t>offset
+        cdef size_t size = PyBytes_GET_SIZE(data) - <Py_ssize_t>offset
+        self._lex_order = None
+        with nogil:
+            marisa_trie_read_memory(self._trie, ptr, size)
+        self._release_buffer()
+        self._set_sections(sections)
         return self
 
-    def __reduce__(self):
-        return self.__class__, (), self.tobytes()
-
-    __setstate__ = frombytes
-
-    def mmap(self, path):
-        """Memory map the content of a trie stored in a file.
+    def map(self, buffer):
+        """Load the trie from an object exposing the buffer protocol.
 
-        This allows to query trie without loading it fully in memory.
+        ``buffer`` is used in place and a view of it is kept while the
+        trie is alive, so it can't be resized or closed in the meantime.
         """
-        import sys
-        str_path = path.encode(sys.getfilesystemencoding())
-        cdef char* c_path = str_path
-        self._trie.mmap(c_path)
-        return self
-
-    def map(self, buffer):
-        """Load the trie from an object exposing the buffer protocol."""
 
         cdef char *ptr = NULL
         cdef Py_ssize_t size = 0
         cdef Py_buffer buf
-        result = getbufptr(buffer, &ptr, &size, &buf)
+        try:
+            view = memoryview(buffer)
+        except TypeError:
+            raise ValueError("Invalid buffer.")
+        result = getbufptr(view, &ptr, &size, &buf)
         if result != 0:
             raise ValueError("Invalid buffer.")
-        self._trie.map(ptr, size)
+        # ``view`` keeps the underlying buffer exported after ``buf``
+        # is released.
         releasebuf(&buf)
+        sections, offset = _split_sections(view.cast("B"))
+        self._lex_order = None
+        self._trie.map(ptr + <Py_ssize_t>offset, size - <Py_ssize_t>offset)
+        self._buffer = view
+        self._shm = None
+        self._set_sections(sections)
         return self
 
     def iterkeys(self, prefix=None):
@@ -299,16 +2490,26 @@ cdef class _Trie:
 
     cpdef list keys(self, prefix=None):
         """Return a list of trie keys starting with a given ``prefix``."""
-        # non-generator inlined version of iterkeys()
+        # non-generator version of iterkeys(); keys are collected in
+        # batches with the GIL released.
         cdef list res = []
         cdef bytes b_prefix = b''
         if prefix is not None:
             b_prefix = self._encode_key(prefix)
         cdef agent.Agent ag
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef size_t i, start
+        cdef int more = 1
         ag.set_query(b_prefix, len(b_prefix))
 
-        while self._trie.predictive_search(ag):
-            res.append(self._get_key(ag))
+        while more:
+            with nogil:
+                more = _predictive_batch(self._trie, ag, buf, ends, NULL)
+            start = 0
+            for i in range(ends.size()):
+                res.append(self._decode_key(buf.data() + start, ends[i] - start))
+                start = ends[i]
 
         return res
 
@@ -319,11 +2520,11 @@ cdef class _Trie:
         .. deprecated:: 0.7.3
 
            The method will be removed in version 0.8.0. Please use
-           :meth:`iterkeys` instead.
+           :meth:`has_prefix` instead.
         """
         warnings.warn("Trie.has_keys_with_prefix is deprecated and will "
                       "be removed in marisa_trie 0.8.0. Please use "
-                      "Trie.iterkeys instead.", DeprecationWarning)
+                      "Trie.has_prefix instead.", DeprecationWarning)
 
         cdef agent.Agent ag
         cdef bytes b_prefix = self._encode_key(prefix)
@@ -345,11 +2546,12 @@ cdef class BinaryTrie(_Trie):
             raise KeyError(key)
         return res
 
-    cdef int _key_id(self, char* key, int len):
+    cdef int _key_id(self, char* key, Py_ssize_t length):
         cdef bint res
         cdef agent.Agent ag
-        ag.set_query(key, len)
-        res = self._trie.lookup(ag)
+        ag.set_query(key, length)
+        with nogil:
+            res = self._may_contain(key, length) and self._trie.lookup(ag)
         if not res:
             return -1
         return ag.key().id()
@@ -359,14 +2561,54 @@ cdef class BinaryTrie(_Trie):
         cdef agent.Agent ag
         ag.set_query(index)
         try:
-            self._trie.reverse_lookup(ag)
+            with nogil:
+                self._trie.reverse_lookup(ag)
         except KeyError:
             raise KeyError(index)
         return self._get_key(ag)
 
+    def restore_keys(self, ids, joined=False):
+        """
+        Return a list with keys corresponding to the given IDs.
+
+        ``ids`` may be any sequence of integers or a buffer of C ints
+        or 64-bit integers (e.g. ``array.array`` or a NumPy array); the
+        reverse lookups run in a single C loop. If ``joined`` is true,
+        return ``(data, offsets)`` instead: all keys concatenated into
+        one bytes object and an ``array.array('q')`` of ``len(ids) + 1``
+        offsets, so that key ``i`` is ``data[offsets[i]:offsets[i + 1]]``.
+        """
+        return self._restore_keys(ids, joined)
+
     def __getitem__(self, bytes key):
         return self.key_id(key)
 
+    @classmethod
+    def build_with_ids(cls, keys, weights=None, **options):
+        """
+        Build a trie from ``keys`` and return it together with the
+        ID of every key as an ``array.array('i')`` in input order.
+
+        The IDs are the ones libmarisa assigns while building, so no
+        lookups are needed to map the input to IDs. Duplicate keys get
+        the same ID. ``weights`` and other options are as in the
+        constructor.
+        """
+        return cls._build_with_ids(keys, weights, **options)
+
+    def key_ids(self, keys, int default=-1, out=None):
+        """
+        Return IDs for all ``keys`` as an ``array.array('i')``.
+
+        This is a batched version of :meth:`get`: the lookups run in a
+        single C loop and keys which are not present in this trie get
+        ``default`` instead of raising :class:`KeyError`. If ``out`` is
+        given, it must be a writable buffer of C ints (e.g. a NumPy
+        ``int32`` array) with room for all IDs; it is filled in place
+        and returned.
+        """
+        return self._key_ids(keys, default, out)
+
     def get(self, bytes key, default=None):
         """
         Return an ID for a given ``key`` or ``default`` if ``key`` is
@@ -379,6 +2621,63 @@ cdef class BinaryTrie(_Trie):
             return default
         return res
 
+    def range(self, bytes lo=None, bytes hi=None, limit=None):
+        """
+        Return a list of trie keys ``key`` with ``lo <= key < hi`` in
+        lexicographic order, at most ``limit`` of them; a bound of
+        ``None`` leaves the range open. See :meth:`Trie.range`.
+        """
+        return self._range(lo, hi, limit)
+
+    def iter_range(self, bytes lo=None, bytes hi=None, limit=None):
+        """
+        Return an iterator over trie keys ``key`` with ``lo <= key < hi``;
+        see :meth:`range`.
+        """
+        return self._iter_range(lo, hi, limit)
+
+    def cursor(self):
+        """
+        Return a :class:`TrieCursor` positioned at the empty prefix, for
+        extending (and shortening) a prefix one step at a time.
+        """
+        return TrieCursor(self)
+
+    def fuzzy(self, bytes query, int max_distance=1):
+        """
+        Return a list of ``(key, key_id, distance)`` for all keys within
+        Levenshtein distance ``max_distance`` of ``query``, measured in
+        bytes, ordered by distance and then by key.
+
+        See :meth:`Trie.fuzzy` for the cost of the first call.
+        """
+        return self._fuzzy(query, False, max_distance)
+
+    def scan(self, bytes data, longest=False, overlapping=True):
+        """
+        Find keys occurring anywhere in ``data``.
+
+        Return a list of ``(start, end, key_id)`` tuples, ordered by
+        ``start`` then ``end``, where ``data[start:end]`` is a key;
+        offsets are byte offsets.
+        If ``longest`` is true, only the longest match at every start
+        position is reported. If ``overlapping`` is false, the scan
+        continues at the end of each reported match, so matches do not
+        overlap (with ``longest`` this is leftmost-longest matching).
+        Empty keys never match.
+        """
+        return self._scan(data, False, longest, overlapping)
+
+    def iter_scan(self, bytes data, longest=False, overlapping=True):
+        """
+        Return an iterator over the matches of :meth:`scan`.
+
+        ``data`` is searched in chunks, so the matches of a large input
+        are not all collected in memory and the first ones are available
+        before the whole input is searched.
+        """
+        return self._iter_scan(data, False, longest, overlapping)
+
     def iter_prefixes(self, bytes key):
         """
         Return an iterator of all prefixes of a given key.
@@ -394,23 +2693,91 @@ cdef class BinaryTrie(_Trie):
         Return a list with all prefixes of a given key.
         """
         # this an inlined version of ``list(self.iter_prefixes(key))``
+        # which releases the GIL while searching.
 
         cdef list res = []
         cdef agent.Agent ag
+        cdef vector[size_t] lengths
+        cdef size_t length
         ag.set_query(key, len(key))
 
-        while self._trie.common_prefix_search(ag):
-            res.append(self._get_key(ag))
+        with nogil:
+            while self._trie.common_prefix_search(ag):
+                lengths.push_back(ag.key().length())
+        for length in lengths:
+            res.append(key[:length])
         return res
 
+    def count(self, bytes prefix=b""):
+        """
+        Return the number of keys starting with ``prefix``.
+        See :meth:`Trie.count`.
+        """
+        return _Trie.count(self, prefix)
+
+    def has_prefix(self, bytes prefix=b""):
+        """Return ``True`` if any key starts with ``prefix``."""
+        return _Trie.has_prefix(self, prefix)
+
+    def sorted_keys(self, bytes prefix=b"", limit=None, after=None):
+        """
+        Return a list of trie keys starting with ``prefix`` in
+        lexicographic order, at most ``limit`` of them, starting right
+        after the key ``after``. See :meth:`Trie.sorted_keys`.
+        """
+        return self._page(prefix, limit, after, False)
+
+    def sorted_items(self, bytes prefix=b"", limit=None, after=None):
+        """
+        Return a list of ``(key, ID)`` pairs for keys starting with
+        ``prefix``, paginated as in :meth:`sorted_keys`.
+        """
+        return self._page(prefix, limit, after, True)
+
+    def iter_batches(self, bytes prefix=b"", Py_ssize_t batch_size=1000):
+        """
+        Return an iterator over lists of up to ``batch_size`` trie keys
+        starting with a given ``prefix``, in the order of :meth:`keys`.
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        cdef agent.Agent ag
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef size_t i, start
+        cdef int more = 1
+        ag.set_query(prefix, len(prefix))
+
+        while more:
+            with nogil:
+                more = _predictive_batch(self._trie, ag, buf, ends, NULL, batch_size)
+            if ends.empty():
+                break
+            start = 0
+            batch = []
+            for i in range(ends.size()):
+                batch.append(self._decode_key(buf.data() + start, ends[i] - start))
+                start = ends[i]
+            yield batch
+
     def items(self, bytes prefix=b""):
         # inlined for speed
         cdef list res = []
         cdef agent.Agent ag
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef vector[int] ids
+        cdef size_t i, start
+        cdef int more = 1
         ag.set_query(prefix, len(prefix))
 
-        while self._trie.predictive_search(ag):
-            res.append((self._get_key(ag), ag.key().id()))
+        while more:
+            with nogil:
+                more = _predictive_batch(self._trie, ag, buf, ends, &ids)
+            start = 0
+            for i in range(ends.size()):
+                res.append((self._decode_key(buf.data() + start, ends[i] - start), ids[i]))
+                start = ends[i]
 
         return res
 
@@ -432,8 +2799,15 @@ cdef class _UnicodeKeyedTrie(_Trie):
     cdef bytes _encode_key(self, key):
         return key.encode('utf8')
 
-    cdef _get_key(self, agent.Agent& ag):
-        return <unicode>_Trie._get_key(self, ag).decode('utf8')
+    cdef _decode_key(self, const char* ptr, Py_ssize_t length):
+        return <unicode>ptr[:length].decode('utf8')
+
+    cdef const char* _key_ptr(self, object key, Py_ssize_t* size) except NULL:
+        if isinstance(key, unicode):
+            return PyUnicode_AsUTF8AndSize(key, size)
+        elif isinstance(key, bytes):
+            return _Trie._key_ptr(self, key, size)
+        raise TypeError("key must be str, not %s" % type(key).__name__)
 
 
 cdef class Trie(_UnicodeKeyedTrie):
@@ -454,6 +2828,32 @@ cdef class Trie(_UnicodeKeyedTrie):
     def __getitem__(self, unicode key):
         return self.key_id(key)
 
+    @classmethod
+    def build_with_ids(cls, keys, weights=None, **options):
+        """
+        Build a trie from ``keys`` and return it together with the
+        ID of every key as an ``array.array('i')`` in input order.
+
+        The IDs are the ones libmarisa assigns while building, so no
+        lookups are needed to map the input to IDs. Duplicate keys get
+        the same ID. ``weights`` and other options are as in the
+        constructor.
+        """
+        return cls._build_with_ids(keys, weights, **options)
+
+    def key_ids(self, keys, int default=-1, out=None):
+        """
+        Return IDs for all ``keys`` as an ``array.array('i')``.
+
+        This is a batched version of :meth:`get`: the lookups run in a
+        single C loop and keys which are not present in this trie get
+        ``default`` instead of raising :class:`KeyError`. If ``out`` is
+        given, it must be a writable buffer of C ints (e.g. a NumPy
+        ``int32`` array) with room for all IDs; it is filled in place
+        and returned.
+        """
+        return self._key_ids(keys, default, out)
+
     def get(self, key, default=None):
         """
         Return an ID for a given ``key`` or ``default`` if ``key`` is
@@ -477,23 +2877,157 @@ cdef class Trie(_UnicodeKeyedTrie):
         cdef agent.Agent ag
         ag.set_query(index)
         try:
-            self._trie.reverse_lookup(ag)
+            with nogil:
+                self._trie.reverse_lookup(ag)
         except KeyError:
             raise KeyError(index)
         return self._get_key(ag)
 
+    def restore_keys(self, ids, joined=False):
+        """
+        Return a list with keys corresponding to the given IDs.
+
+        ``ids`` may be any sequence of integers or a buffer of C ints
+        or 64-bit integers (e.g. ``array.array`` or a NumPy array); the
+        reverse lookups run in a single C loop. If ``joined`` is true,
+        return ``(data, offsets)`` instead: all keys concatenated into
+        one bytes object and an ``array.array('q')`` of ``len(ids) + 1``
+        offsets, so that key ``i`` is ``data[offsets[i]:offsets[i + 1]]``.
+        """
+        return self._restore_keys(ids, joined)
+
     cdef int _key_id(self, char* key):
         cdef bint res
         cdef agent.Agent ag
-        ag.set_query(key)
-        res = self._trie.lookup(ag)
+        cdef size_t length = strlen(key)
+        ag.set_query(key, length)
+        with nogil:
+            res = self._may_contain(key, length) and self._trie.lookup(ag)
         if not res:
             return -1
         return ag.key().id()
 
-    def iter_prefixes(self, unicode key):
+    def sorted_keys(self, unicode prefix="", limit=None, after=None):
         """
-        Return an iterator of all prefixes of a given key.
+        Return a list of trie keys starting with ``prefix`` in
+        lexicographic order of their UTF-8 encoding, at most ``limit``
+        of them, starting right after the key ``after``.
+
+        Passing the last key of a page as ``after`` fetches the next page
+        with a binary search, without walking the previous pages.
+        :meth:`keys` and :meth:`iter_batches` follow the node order of the
+        trie instead, which is the same only for ``order=LABEL_ORDER``
+        tries.
+        """
+        return self._page(prefix, limit, after, False)
+
+    def sorted_items(self, unicode prefix="", limit=None, after=None):
+        """
+        Return a list of ``(key, ID)`` pairs for keys starting with
+        ``prefix``, paginated as in :meth:`sorted_keys`.
+        """
+        return self._page(prefix, limit, after, True)
+
+    def iter_batches(self, unicode prefix="", Py_ssize_t batch_size=1000):
+        """
+        Return an iterator over lists of up to ``batch_size`` trie keys
+        starting with a given ``prefix``, in the order of :meth:`keys`.
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef size_t i, start
+        cdef int more = 1
+        ag.set_query(b_prefix, len(b_prefix))
+
+        while more:
+            with nogil:
+                more = _predictive_batch(self._trie, ag, buf, ends, NULL, batch_size)
+            if ends.empty():
+                break
+            start = 0
+            batch = []
+            for i in range(ends.size()):
+                batch.append(self._decode_key(buf.data() + start, ends[i] - start))
+                start = ends[i]
+            yield batch
+
+    def range(self, unicode lo=None, unicode hi=None, limit=None):
+        """
+        Return a list of trie keys ``key`` with ``lo <= key < hi`` in
+        lexicographic order of their UTF-8 encoding, at most ``limit``
+        of them; a bound of ``None`` leaves the range open.
+
+        ``order=LABEL_ORDER`` tries enumerate their keys in this order,
+        so the keys are read from the trie starting at ``lo``, without
+        an index. For ``WEIGHT_ORDER`` tries an index of the key order
+        is sorted on first use and both bounds are found by binary
+        search over it; either way the cost does not depend on the
+        number of keys before ``lo``.
+        """
+        return self._range(lo, hi, limit)
+
+    def iter_range(self, unicode lo=None, unicode hi=None, limit=None):
+        """
+        Return an iterator over trie keys ``key`` with ``lo <= key < hi``;
+        see :meth:`range`.
+        """
+        return self._iter_range(lo, hi, limit)
+
+    def cursor(self):
+        """
+        Return a :class:`TrieCursor` positioned at the empty prefix, for
+        extending (and shortening) a prefix one step at a time.
+        """
+        return TrieCursor(self)
+
+    def fuzzy(self, unicode query, int max_distance=1):
+        """
+        Return a list of ``(key, key_id, distance)`` for all keys within
+        Levenshtein distance ``max_distance`` of ``query``, measured in
+        characters, ordered by distance and then by key.
+
+        The first call enumerates all keys to build an index of their
+        lexicographic order, which is sorted unless the trie uses
+        ``LABEL_ORDER``. The index takes about 13 bytes per key and is
+        kept for the lifetime of the trie (:meth:`count` shares it).
+        After that the keys are walked in order and branches are pruned
+        as soon as no key below them can be close enough, so a query only
+        visits the prefixes within ``max_distance`` edits of ``query``.
+        """
+        return self._fuzzy(query, True, max_distance)
+
+    def scan(self, unicode text, longest=False, overlapping=True):
+        """
+        Find keys occurring anywhere in ``text``.
+
+        Return a list of ``(start, end, key_id)`` tuples, ordered by
+        ``start`` then ``end``, where ``text[start:end]`` is a key;
+        offsets are character offsets.
+        If ``longest`` is true, only the longest match at every start
+        position is reported. If ``overlapping`` is false, the scan
+        continues at the end of each reported match, so matches do not
+        overlap (with ``longest`` this is leftmost-longest matching).
+        Empty keys never match.
+        """
+        return self._scan(text.encode('utf8'), True, longest, overlapping)
+
+    def iter_scan(self, unicode text, longest=False, overlapping=True):
+        """
+        Return an iterator over the matches of :meth:`scan`.
+
+        ``text`` is searched in chunks, so the matches of a large input
+        are not all collected in memory and the first ones are available
+        before the whole input is searched.
+        """
+        return self._iter_scan(text.encode('utf8'), True, longest, overlapping)
+
+    def iter_prefixes(self, unicode key):
+        """
+        Return an iterator of all prefixes of a given key.
         """
         cdef bytes b_key = <bytes>key.encode('utf8')
         cdef agent.Agent ag
@@ -507,66 +3041,1407 @@ cdef class Trie(_UnicodeKeyedTrie):
         Return a list with all prefixes of a given key.
         """
         # this an inlined version of ``list(self.iter_prefixes(key))``
+        # which releases the GIL while searching.
 
         cdef list res = []
         cdef bytes b_key = <bytes>key.encode('utf8')
         cdef agent.Agent ag
+        cdef vector[size_t] lengths
+        cdef size_t length
         ag.set_query(b_key)
 
-        while self._trie.common_prefix_search(ag):
-            res.append(self._get_key(ag))
+        with nogil:
+            while self._trie.common_prefix_search(ag):
+                lengths.push_back(ag.key().length())
+        for length in lengths:
+            res.append(self._decode_key(b_key, length))
         return res
 
     def iter_prefixes_with_ids(self, unicode key):
         """
-        Return an iterator of (prefix, id) pairs of all prefixes of a given key.
+        Return an iterator of (prefix, id) pairs of all prefixes of a given key.
+        """
+        cdef bytes b_key = <bytes>key.encode('utf8')
+        cdef agent.Agent ag
+        ag.set_query(b_key, len(b_key))
+
+        while self._trie.common_prefix_search(ag):
+            yield (self._get_key(ag), ag.key().id())
+
+    def iteritems(self, unicode prefix=""):
+        """
+        Return an iterator over items that have a prefix ``prefix``.
+        """
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        ag.set_query(b_prefix)
+
+        while self._trie.predictive_search(ag):
+            yield self._get_key(ag), ag.key().id()
+
+    def items(self, unicode prefix=""):
+        # inlined for speed
+        cdef list res = []
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef vector[int] ids
+        cdef size_t i, start
+        cdef int more = 1
+        ag.set_query(b_prefix)
+
+        while more:
+            with nogil:
+                more = _predictive_batch(self._trie, ag, buf, ends, &ids)
+            start = 0
+            for i in range(ends.size()):
+                res.append((self._decode_key(buf.data() + start, ends[i] - start), ids[i]))
+                start = ends[i]
+
+        return res
+
+
+cdef class TrieCursor:
+    """A prefix of the keys of a :class:`Trie` or :class:`BinaryTrie`
+    which can be extended and shortened incrementally.
+
+    The cursor keeps the range of keys starting with the current prefix
+    in the lexicographic order of the keys (the index :meth:`Trie.count`
+    uses, built on the first step if the trie doesn't have it yet), so
+    :meth:`push` only walks the branches below the current prefix,
+    looking up at most one key per byte, and :meth:`pop` restores the
+    previous range without a search.
+    A cursor is not thread-safe; use one per thread (or per user).
+
+    :param trie: a :class:`Trie` or :class:`BinaryTrie`.
+    """
+    cdef _Trie _trie
+    # the key order the ranges refer to, or None before the first step
+    cdef _LexOrder _order
+    cdef string _prefix
+    # prefix length and range of ranks before each push
+    cdef vector[size_t] _lengths, _los, _his
+    cdef size_t _lo, _hi
+    # the key at rank ``_key_rank``, cached between steps
+    cdef string _key
+    cdef size_t _key_rank
+
+    def __init__(self, trie):
+        if not isinstance(trie, (Trie, BinaryTrie)):
+            raise TypeError("trie must be a Trie or a BinaryTrie, not %s"
+                            % type(trie).__name__)
+        self._trie = trie
+
+    cdef _LexOrder _sync(self):
+        """Return the key order of the trie, computing the ranges of the
+        pushed prefixes again if the trie was built or loaded since the
+        last step."""
+        cdef _LexOrder order = self._trie._get_lex_order()
+        if order is self._order:
+            return order
+        cdef size_t i, depth, end, lo = 0, hi = order.ids.size()
+        self._key_rank = hi
+        for i in range(self._lengths.size()):
+            self._los[i], self._his[i] = lo, hi
+            depth = self._lengths[i]
+            end = (self._lengths[i + 1] if i + 1 < self._lengths.size()
+                   else self._prefix.size())
+            if not order.narrow(self._trie._trie, &lo, &hi, depth,
+                                self._prefix.data() + depth, end - depth,
+                                &self._key, &self._key_rank):
+                lo = hi  # the prefix is gone from the reloaded trie
+        self._lo, self._hi = lo, hi
+        self._order = order
+        return order
+
+    def push(self, part):
+        """Extend the prefix with ``part``.
+
+        Return ``True`` if some key starts with the extended prefix;
+        otherwise return ``False`` and leave the cursor unchanged.
+        """
+        cdef _LexOrder order = self._sync()
+        cdef Py_ssize_t size
+        cdef const char* ptr = self._trie._key_ptr(part, &size)
+        cdef size_t lo = self._lo, hi = self._hi, depth = self._prefix.size()
+        cdef bint found
+        with nogil:
+            found = order.narrow(self._trie._trie, &lo, &hi, depth, ptr, size,
+                                 &self._key, &self._key_rank)
+        if not found:
+            return False
+        self._lengths.push_back(depth)
+        self._los.push_back(self._lo)
+        self._his.push_back(self._hi)
+        self._prefix.append(ptr, size)
+        self._lo, self._hi = lo, hi
+        return True
+
+    def pop(self):
+        """Undo the last successful :meth:`push` and return its ``part``.
+
+        :raises IndexError: if the cursor is at the empty prefix.
+        """
+        if self._lengths.empty():
+            raise IndexError("pop from a cursor at the empty prefix")
+        cdef size_t length = self._lengths.back()
+        part = self._trie._decode_key(self._prefix.data() + length,
+                                      self._prefix.size() - length)
+        self._prefix.resize(length)
+        self._lo, self._hi = self._los.back(), self._his.back()
+        self._lengths.pop_back()
+        self._los.pop_back()
+        self._his.pop_back()
+        return part
+
+    cdef int _key_id(self) except -2:
+        cdef _LexOrder order = self._sync()
+        # the prefix itself sorts first among the keys starting with it
+        if (self._lo < self._hi and
+                order.key_at(self._trie._trie, self._lo, &self._key,
+                             &self._key_rank).size() == self._prefix.size()):
+            return order.ids[self._lo]
+        return -1
+
+    @property
+    def prefix(self):
+        """The current prefix."""
+        return self._trie._decode_key(self._prefix.data(), self._prefix.size())
+
+    @property
+    def is_key(self):
+        """Whether the current prefix is itself a key."""
+        return self._key_id() != -1
+
+    @property
+    def key_id(self):
+        """The ID of the current prefix.
+
+        :raises KeyError: if the current prefix is not a key.
+        """
+        cdef int key_id = self._key_id()
+        if key_id == -1:
+            raise KeyError(self.prefix)
+        return key_id
+
+    @property
+    def has_children(self):
+        """Whether some key is longer than the current prefix and starts
+        with it."""
+        cdef bint is_key = self._key_id() != -1
+        return self._hi - self._lo > is_key
+
+    def __len__(self):
+        self._sync()
+        return self._hi - self._lo
+
+    def iter_keys(self, limit=None):
+        """Yield keys starting with the current prefix, in the order of
+        :meth:`Trie.keys`, at most ``limit`` of them if it is given."""
+        self._sync()
+        cdef agent.Agent ag
+        cdef bytes prefix = self._prefix
+        cdef size_t count = self._hi - self._lo
+        cdef bint found
+        if limit is not None:
+            count = min(count, <size_t>max(limit, 0))
+        ag.set_query(prefix, len(prefix))
+        while count:
+            with nogil:
+                found = self._trie._trie.predictive_search(ag)
+            if not found:
+                break
+            yield self._trie._get_key(ag)
+            count -= 1
+
+    def keys(self, limit=None):
+        """Return a list of keys starting with the current prefix, in the
+        order of :meth:`Trie.keys`, at most ``limit`` of them if it is
+        given."""
+        self._sync()
+        cdef agent.Agent ag
+        cdef bytes prefix = self._prefix
+        cdef size_t i, start = 0, count = self._hi - self._lo
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef list res = []
+        if limit is not None:
+            count = min(count, <size_t>max(limit, 0))
+        ag.set_query(prefix, len(prefix))
+        with nogil:
+            while ends.size() < count and self._trie._trie.predictive_search(ag):
+                buf.append(ag.key().ptr(), ag.key().length())
+                ends.push_back(buf.size())
+        for i in range(ends.size()):
+            res.append(self._trie._decode_key(buf.data() + start, ends[i] - start))
+            start = ends[i]
+        return res
+
+
+cdef class StringTrie(_Mappable):
+    """An immutable mapping from unicode keys to unicode values.
+
+    The mapping is represented by two internal tries and a fixed-width
+    key-id to value-id table.
+    """
+    cdef Trie _key_trie
+    cdef Trie _value_trie
+    cdef object _id_map
+    cdef const unsigned char[::1] _id_map_view
+
+    def __init__(self, arg=None, num_tries=DEFAULT_NUM_TRIES, binary=False,
+                 cache_size=DEFAULT_CACHE, order=DEFAULT_ORDER, weights=None,
+                 prefilter=False):
+        self._key_trie = Trie()
+        self._value_trie = Trie()
+        self._set_id_map(b"")
+        if arg is not None:
+            self._build(
+                arg,
+                weights=weights,
+                prefilter=prefilter,
+                num_tries=num_tries,
+                binary=binary,
+                cache_size=cache_size,
+                order=order,
+            )
+
+    def _build(self, arg, weights=None, prefilter=False, **options):
+        cdef list keys = []
+        cdef list values = []
+        cdef object item
+        cdef Trie key_trie, value_trie
+        cdef int[:] key_ids, value_ids
+        cdef bytes id_map
+        cdef unsigned char* id_map_ptr
+        cdef bytearray seen
+        cdef Py_ssize_t i, num_keys
+
+        for item in arg:
+            try:
+                key, value = item
+            except Exception:
+                raise TypeError("StringTrie expects (key, value) pairs")
+
+            if not isinstance(key, unicode):
+                raise TypeError("key must be str")
+            if not isinstance(value, unicode):
+                raise TypeError("value must be str")
+
+            keys.append(key)
+            values.append(value)
+
+        num_keys = len(keys)
+        if num_keys > _STRING_TRIE_U32_MAX:
+            raise ValueError("too many keys for 4-byte key-id mapping")
+
+        # The IDs assigned while building map every input pair to its key
+        # and value IDs without looking the keys and values up again.
+        key_trie, key_ids = Trie.build_with_ids(
+            keys, weights=weights, prefilter=prefilter, **options)
+        if len(key_trie) != num_keys:
+            seen = bytearray(num_keys)
+            for i in range(num_keys):
+                if seen[key_ids[i]]:
+                    raise ValueError("duplicate key: %r" % keys[i])
+                seen[key_ids[i]] = 1
+        value_trie, value_ids = Trie.build_with_ids(values, **options)
+
+        id_map = PyBytes_FromStringAndSize(NULL, num_keys * 4)
+        id_map_ptr = <unsigned char*>PyBytes_AS_STRING(id_map)
+        with nogil:
+            for i in range(num_keys):
+                _write_u32le(id_map_ptr + key_ids[i] * 4, value_ids[i])
+
+        self._key_trie = key_trie
+        self._value_trie = value_trie
+        self._set_id_map(id_map)
+
+    cdef _set_id_map(self, id_map):
+        self._id_map = id_map
+        self._id_map_view = id_map
+
+    cdef int _clear(self) except -1:
+        self._key_trie = Trie()
+        self._value_trie = Trie()
+        self._set_id_map(b"")
+        return 0
+
+    cdef long long _value_id_from_key_id(self, size_t key_id) except -1 nogil:
+        cdef unsigned int value_id = _read_u32le(&self._id_map_view[key_id * 4])
+        # mapped data is not validated upfront, so check ids on access
+        if value_id >= self._value_trie._trie.num_keys():
+            with gil:
+                raise ValueError("Invalid StringTrie data: value id out of range")
+        return value_id
+
+    cdef unicode _value_for_key_id(self, size_t key_id, agent.Agent& ag):
+        """Return the value of ``key_id`` using ``ag`` for the reverse lookup."""
+        with nogil:
+            ag.set_query(<size_t>self._value_id_from_key_id(key_id))
+            self._value_trie._trie.reverse_lookup(ag)
+        return ag.key().ptr()[:ag.key().length()].decode('utf8')
+
+    cdef object _value_for_key(self, unicode key):
+        """Return the value stored for ``key`` or None if it is missing."""
+        cdef Py_ssize_t length
+        cdef const char* ptr = PyUnicode_AsUTF8AndSize(key, &length)
+        cdef agent.Agent ag
+        cdef bint found
+        ag.set_query(<char *>ptr, length)
+        with nogil:
+            found = (self._key_trie._may_contain(ptr, length) and
+                     self._key_trie._trie.lookup(ag))
+            if found:
+                ag.set_query(<size_t>self._value_id_from_key_id(ag.key().id()))
+                self._value_trie._trie.reverse_lookup(ag)
+        if not found:
+            return None
+        return ag.key().ptr()[:ag.key().length()].decode('utf8')
+
+    cdef int _restore_values(self, vector[int]& key_ids, string& buf,
+                             vector[size_t]& ends) except -1 nogil:
+        """Concatenate values of ``key_ids`` into ``buf``.
+
+        End offsets of the values are stored in ``ends``."""
+        cdef agent.Agent ag
+        cdef size_t i
+        buf.clear()
+        ends.clear()
+        for i in range(key_ids.size()):
+            ag.set_query(<size_t>self._value_id_from_key_id(key_ids[i]))
+            self._value_trie._trie.reverse_lookup(ag)
+            buf.append(ag.key().ptr(), ag.key().length())
+            ends.push_back(buf.size())
+        return 0
+
+    cdef list _items(self, unicode prefix, bint with_keys, bint with_values):
+        # One predictive search over the key trie; values are resolved
+        # by key ID in batches with the GIL released.
+        cdef list res = []
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        cdef string key_buf, value_buf
+        cdef vector[size_t] key_ends, value_ends
+        cdef vector[int] ids
+        cdef size_t i, key_start, value_start
+        cdef int more = 1
+        ag.set_query(b_prefix, len(b_prefix))
+
+        while more:
+            with nogil:
+                more = _predictive_batch(self._key_trie._trie, ag, key_buf, key_ends, &ids)
+                if with_values:
+                    self._restore_values(ids, value_buf, value_ends)
+            key_start = value_start = 0
+            for i in range(ids.size()):
+                if with_keys and with_values:
+                    res.append((
+                        key_buf.data()[key_start:key_ends[i]].decode('utf8'),
+                        value_buf.data()[value_start:value_ends[i]].decode('utf8'),
+                    ))
+                elif with_keys:
+                    res.append(key_buf.data()[key_start:key_ends[i]].decode('utf8'))
+                else:
+                    res.append(value_buf.data()[value_start:value_ends[i]].decode('utf8'))
+                key_start = key_ends[i]
+                if with_values:
+                    value_start = value_ends[i]
+        return res
+
+    def __richcmp__(self, other, int op):
+        if op == 2:  # ==
+            if other is self:
+                return True
+            elif not isinstance(other, StringTrie):
+                return False
+            return (self._key_trie == (<StringTrie>other)._key_trie and
+                    self._value_trie == (<StringTrie>other)._value_trie and
+                    self._id_map == (<StringTrie>other)._id_map)
+        elif op == 3:  # !=
+            return not (self == other)
+
+        raise TypeError("unorderable types: {0} and {1}".format(
+            self.__class__, other.__class__))
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return len(self._key_trie)
+
+    def __contains__(self, key):
+        if not isinstance(key, unicode):
+            return False
+        return key in self._key_trie
+
+    def __getitem__(self, key):
+        if not isinstance(key, unicode):
+            raise TypeError("key must be str")
+        value = self._value_for_key(<unicode>key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if not isinstance(key, unicode):
+            raise TypeError("key must be str")
+        value = self._value_for_key(<unicode>key)
+        if value is None:
+            return default
+        return value
+
+    @property
+    def key_trie(self):
+        """Read-only accessor for internal key trie."""
+        return self._key_trie
+
+    @property
+    def value_trie(self):
+        """Read-only accessor for internal value trie."""
+        return self._value_trie
+
+    @property
+    def has_prefilter(self):
+        """Whether lookups are checked against a prefilter of the key trie
+        (built with ``prefilter=True``) first."""
+        return self._key_trie.has_prefilter
+
+    def iter_prefixes(self, unicode key):
+        return self._key_trie.iter_prefixes(key)
+
+    def prefixes(self, unicode key):
+        return self._key_trie.prefixes(key)
+
+    def count(self, unicode prefix=""):
+        """Return the number of keys starting with ``prefix``.
+        See :meth:`Trie.count`."""
+        return self._key_trie.count(prefix)
+
+    def has_prefix(self, unicode prefix=""):
+        """Return ``True`` if any key starts with ``prefix``."""
+        return self._key_trie.has_prefix(prefix)
+
+    def fuzzy(self, unicode query, int max_distance=1):
+        """
+        Return a list of ``(key, value, distance)`` for all keys within
+        Levenshtein distance ``max_distance`` of ``query``, ordered by
+        distance and then by key. See :meth:`Trie.fuzzy`.
+        """
+        cdef agent.Agent value_ag
+        return [
+            (key, self._value_for_key_id(key_id, value_ag), distance)
+            for key, key_id, distance in self._key_trie._fuzzy(query, True, max_distance)
+        ]
+
+    def iterkeys(self, unicode prefix=""):
+        return self._key_trie.iterkeys(prefix)
+
+    cpdef list keys(self, unicode prefix=""):
+        return self._key_trie.keys(prefix)
+
+    def itervalues(self, unicode prefix=""):
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag, value_ag
+        ag.set_query(b_prefix, len(b_prefix))
+
+        while self._key_trie._trie.predictive_search(ag):
+            yield self._value_for_key_id(ag.key().id(), value_ag)
+
+    cpdef list values(self, unicode prefix=""):
+        return self._items(prefix, False, True)
+
+    def iteritems(self, unicode prefix=""):
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag, value_ag
+        ag.set_query(b_prefix, len(b_prefix))
+
+        while self._key_trie._trie.predictive_search(ag):
+            yield (self._key_trie._get_key(ag),
+                   self._value_for_key_id(ag.key().id(), value_ag))
+
+    cpdef list items(self, unicode prefix=""):
+        return self._items(prefix, True, True)
+
+    def iter_prefix_items(self, unicode key):
+        cdef bytes b_key = <bytes>key.encode('utf8')
+        cdef agent.Agent ag, value_ag
+        ag.set_query(b_key, len(b_key))
+
+        while self._key_trie._trie.common_prefix_search(ag):
+            yield (self._key_trie._get_key(ag),
+                   self._value_for_key_id(ag.key().id(), value_ag))
+
+    cpdef list prefix_items(self, unicode key):
+        cdef list res = []
+        cdef bytes b_key = <bytes>key.encode('utf8')
+        cdef agent.Agent ag, value_ag
+        ag.set_query(b_key, len(b_key))
+
+        while self._key_trie._trie.common_prefix_search(ag):
+            res.append((self._key_trie._get_key(ag),
+                        self._value_for_key_id(ag.key().id(), value_ag)))
+        return res
+
+    cdef bytes _header(self):
+        return _STRING_TRIE_HEADER.pack(
+            _STRING_TRIE_MAGIC,
+            _STRING_TRIE_VERSION,
+            _STRING_TRIE_FLAGS,
+            self._key_trie._image_size(),
+            self._value_trie._image_size(),
+            len(self._id_map),
+        )
+
+    cpdef bytes tobytes(self) except +:
+        return (self._header() + self._key_trie.tobytes() +
+                self._value_trie.tobytes() + self._id_map)
+
+    cdef _write(self, f):
+        f.write(self._header())
+        self._key_trie.save(f)
+        self._value_trie.save(f)
+        f.write(self._id_map)
+
+    cdef tuple _unpack_header(self, data):
+        """Validate the header at the start of serialized StringTrie ``data``.
+
+        Return its length and the lengths of the key trie, the value trie
+        and the ID table."""
+        cdef Py_ssize_t header_len
+        cdef bytes magic
+        cdef int version
+        cdef int flags
+
+        if len(data) < _STRING_TRIE_PREFIX.size:
+            raise ValueError("Invalid StringTrie data: truncated header")
+        magic, version = _STRING_TRIE_PREFIX.unpack_from(data)
+        if magic != _STRING_TRIE_MAGIC:
+            raise ValueError("Invalid StringTrie data: bad magic")
+        if version == _STRING_TRIE_VERSION:
+            header = _STRING_TRIE_HEADER
+        elif version == 1:
+            header = _STRING_TRIE_HEADER_V1
+        else:
+            raise ValueError("Unsupported StringTrie version: %d" % version)
+
+        header_len = header.size
+        if len(data) < header_len:
+            raise ValueError("Invalid StringTrie data: truncated header")
+        magic, version, flags, key_len, value_len, id_map_len = header.unpack_from(data)
+        if flags != _STRING_TRIE_FLAGS:
+            raise ValueError("Unsupported StringTrie flags: %d" % flags)
+        if id_map_len % 4 != 0:
+            raise ValueError("Invalid StringTrie data: id map length is not a multiple of 4")
+        return header_len, key_len, value_len, id_map_len
+
+    cdef tuple _parse_header(self, data):
+        """Validate the header of serialized StringTrie ``data``.
+
+        Return offsets of the key trie, the value trie and the ID table."""
+        cdef Py_ssize_t key_offset, value_offset, id_map_offset
+        header_len, key_len, value_len, id_map_len = self._unpack_header(data)
+        if header_len + key_len + value_len + id_map_len != len(data):
+            raise ValueError("Invalid StringTrie data: invalid payload length")
+
+        key_offset = header_len
+        value_offset = key_offset + key_len
+        id_map_offset = value_offset + value_len
+        return key_offset, value_offset, id_map_offset
+
+    cdef _load_sections(self, Trie key_trie, Trie value_trie, bytes id_map):
+        cdef Py_ssize_t key_id
+        if len(key_trie) != len(id_map) // 4:
+            raise ValueError("Invalid StringTrie data: key trie and id map length mismatch")
+        cdef const unsigned char* ids = <const unsigned char*>PyBytes_AS_STRING(id_map)
+        for key_id in range(len(key_trie)):
+            if _read_u32le(ids + key_id * 4) >= len(value_trie):
+                raise ValueError("Invalid StringTrie data: value id out of range")
+
+        # nothing is changed until all checks have passed
+        self._key_trie = key_trie
+        self._value_trie = value_trie
+        self._set_id_map(id_map)
+        self._buffer = None
+        self._shm = None
+        return self
+
+    cpdef frombytes(self, bytes data) except +:
+        cdef Py_ssize_t key_offset, value_offset, id_map_offset
+        key_offset, value_offset, id_map_offset = self._parse_header(data)
+        return self._load_sections(
+            Trie().frombytes(data[key_offset:value_offset]),
+            Trie().frombytes(data[value_offset:id_map_offset]),
+            data[id_map_offset:],
+        )
+
+    def map(self, buffer):
+        """Load a StringTrie from an object exposing the buffer protocol.
+
+        The internal tries and the ID table are used in place, without
+        copying ``buffer``; a reference to it is kept while the StringTrie
+        is alive.
+        """
+        cdef object view = memoryview(buffer).cast("B")
+        cdef Py_ssize_t key_offset, value_offset, id_map_offset
+
+        key_offset, value_offset, id_map_offset = self._parse_header(view)
+
+        key_trie = Trie().map(view[key_offset:value_offset])
+        value_trie = Trie().map(view[value_offset:id_map_offset])
+        id_map = view[id_map_offset:]
+        if len(key_trie) != len(id_map) // 4:
+            raise ValueError("Invalid StringTrie data: key trie and id map length mismatch")
+
+        self._key_trie = key_trie
+        self._value_trie = value_trie
+        self._set_id_map(id_map)
+        self._buffer = view
+        self._shm = None
+        return self
+
+    def save(self, path):
+        """Save a StringTrie to a specified path or a binary file-like object.
+
+        The sections are written one by one, without serializing the
+        StringTrie in memory first.
+        """
+        if hasattr(path, "write"):
+            self._write(path)
+            return
+        with open(path, "wb") as f:
+            self._write(f)
+
+    def load(self, path):
+        """Load a StringTrie from a specified path or a binary file-like object.
+
+        Only the bytes of the StringTrie are read from a file-like object, so
+        several tries can be loaded from one stream in turn. The internal
+        tries and the ID table are read into place, without a copy of the
+        whole StringTrie.
+        """
+        cdef _FileStream stream
+        if hasattr(path, "readinto") or hasattr(path, "read"):
+            stream = _FileStream(path)
+            head = stream.read(_STRING_TRIE_PREFIX.size)
+            header = _STRING_TRIE_HEADER
+            if (len(head) == _STRING_TRIE_PREFIX.size and
+                    _STRING_TRIE_PREFIX.unpack(head)[1] == 1):
+                header = _STRING_TRIE_HEADER_V1
+            _, key_len, value_len, id_map_len = self._unpack_header(
+                _read_header(stream, head, header, _STRING_TRIE_MAGIC, "StringTrie"))
+            key_trie = _read_trie(stream, key_len, "StringTrie")
+            value_trie = _read_trie(stream, value_len, "StringTrie")
+            if len(key_trie) != id_map_len // 4:
+                raise ValueError("Invalid StringTrie data: key trie and id map length mismatch")
+            return self._load_sections(
+                key_trie, value_trie, _read_table(stream, id_map_len, "StringTrie"))
+        with open(path, "rb") as f:
+            self.frombytes(f.read())
+        return self
+
+
+def _iter_run(f):
+    """Iterate over (a, b) pairs stored in a StringTrieBuilder run file."""
+    cdef unsigned int a_len, b_len
+    read = f.read
+    unpack = _RUN_RECORD_HEADER.unpack
+    f.seek(0)
+    while True:
+        header = read(_RUN_RECORD_HEADER.size)
+        if not header:
+            return
+        a_len, b_len = unpack(header)
+        yield read(a_len), read(b_len)
+
+
+def _peak_rss():
+    """Return the peak resident set size of the process in bytes, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+cdef class StringTrieBuilder:
+    """Build a StringTrie from (key, value) pairs in bounded memory.
+
+    Pairs are buffered until they take about ``memory_limit`` bytes, then
+    sorted and spilled to a temporary file. :meth:`build` merges the sorted
+    runs, so memory usage is bounded by the final tries rather than by the
+    number of Python objects created for the input.
+
+    ``progress``, if given, is called as ``progress(stage, count)`` every
+    ``progress_every`` records of a stage; stages are ``"add"``,
+    ``"keys"`` and ``"values"``. Other keyword arguments are trie options
+    as accepted by :class:`StringTrie`, ``prefilter`` included.
+    """
+    cdef Py_ssize_t _memory_limit
+    cdef object _tmpdir
+    cdef object _progress
+    cdef Py_ssize_t _progress_every
+    cdef int _config_flags
+    cdef object _prefilter
+    cdef list _buffer
+    cdef Py_ssize_t _buffer_size
+    cdef list _runs
+    cdef dict _stats
+
+    def __init__(self, memory_limit=64 * 1024 * 1024, tmpdir=None,
+                 progress=None, progress_every=1000000, prefilter=False, **options):
+        if memory_limit <= 0:
+            raise ValueError("memory_limit must be positive")
+        self._memory_limit = memory_limit
+        self._tmpdir = tmpdir
+        self._progress = progress
+        self._progress_every = progress_every
+        self._config_flags = Trie()._config_flags(**options)
+        self._prefilter = prefilter
+        self._buffer = []
+        self._buffer_size = 0
+        self._runs = []
+        self._stats = {
+            "records": 0,
+            "runs": 0,
+            "keys": 0,
+            "values": 0,
+            "peak_buffer_bytes": 0,
+            "peak_rss": None,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # __del__ (unlike __dealloc__) runs while the object is intact,
+        # so closing the run files may use Python-level code safely.
+        if self._runs:
+            self.close()
+
+    @property
+    def stats(self):
+        """A dict with the number of records, runs, keys and values seen,
+        the peak size of the in-memory buffer and the peak resident set size
+        of the process (``None`` where it is unavailable)."""
+        return dict(self._stats)
+
+    def close(self):
+        """Remove the temporary files of spilled runs."""
+        cdef object f
+        for f in self._runs:
+            f.close()
+        self._runs = []
+        self._buffer = []
+        self._buffer_size = 0
+
+    def add(self, key, value):
+        """Add a (key, value) pair."""
+        if not isinstance(key, unicode):
+            raise TypeError("key must be str")
+        if not isinstance(value, unicode):
+            raise TypeError("value must be str")
+        cdef bytes b_key = (<unicode>key).encode('utf8')
+        cdef bytes b_value = (<unicode>value).encode('utf8')
+        self._buffer.append((b_key, b_value))
+        self._buffer_size += len(b_key) + len(b_value) + _RUN_RECORD_OVERHEAD
+        self._stats["records"] += 1
+        self._report("add", self._stats["records"])
+        if self._buffer_size >= self._memory_limit:
+            self._spill()
+
+    def update(self, pairs):
+        """Add (key, value) pairs from an iterable."""
+        for item in pairs:
+            try:
+                key, value = item
+            except Exception:
+                raise TypeError("StringTrieBuilder expects (key, value) pairs")
+            self.add(key, value)
+
+    cdef _report(self, stage, Py_ssize_t count):
+        if (self._progress is not None and self._progress_every > 0 and
+                count % self._progress_every == 0):
+            self._progress(stage, count)
+
+    cdef _spill(self):
+        """Sort the buffered records and write them to a new run file."""
+        self._stats["peak_buffer_bytes"] = max(
+            self._stats["peak_buffer_bytes"], self._buffer_size)
+        if self._buffer:
+            self._buffer.sort()
+            self._runs.append(self._write_run(self._buffer))
+            self._stats["runs"] += 1
+        self._buffer = []
+        self._buffer_size = 0
+        if len(self._runs) >= _MAX_MERGE_RUNS:
+            runs = self._runs
+            self._runs = [self._write_run(heapq.merge(*[_iter_run(f) for f in runs]))]
+            for f in runs:
+                f.close()
+
+    cdef _write_run(self, records):
+        f = tempfile.TemporaryFile(dir=self._tmpdir)
+        write = f.write
+        pack = _RUN_RECORD_HEADER.pack
+        for a, b in records:
+            write(pack(len(a), len(b)))
+            write(a)
+            write(b)
+        return f
+
+    def build(self):
+        """Merge the added pairs and return a new :class:`StringTrie`.
+
+        Raise ValueError if a key was added more than once. The builder
+        is empty afterwards.
+        """
+        cdef StringTrie res = StringTrie()
+        cdef Trie key_trie = Trie()
+        cdef Trie value_trie = Trie()
+        cdef keyset.Keyset* ks = NULL
+        cdef vector[unsigned int] key_ids
+        cdef bytes id_map
+        cdef unsigned char* id_map_ptr
+        cdef bytes b_key, b_value, prev = None
+        cdef Py_ssize_t num_keys = 0, num_values = 0, i
+        cdef unsigned int value_index
+        cdef list key_runs = [], value_runs = []
+
+        try:
+            self._spill()
+            key_runs, self._runs = self._runs, []
+
+            # Pass 1: merge the runs by key into the key keyset and spill
+            # (value, key index) pairs for the value pass.
+            ks = new keyset.Keyset()
+            for b_key, b_value in heapq.merge(*[_iter_run(f) for f in key_runs]):
+                if b_key == prev:
+                    raise ValueError("duplicate key: %r" % b_key.decode('utf8'))
+                prev = b_key
+                if num_keys >= _STRING_TRIE_U32_MAX:
+                    raise ValueError("too many keys for 4-byte key-id mapping")
+                ks.push_back(<char *>b_key, len(b_key))
+                self._buffer.append((b_value, _U32.pack(num_keys)))
+                self._buffer_size += len(b_value) + _RUN_RECORD_OVERHEAD
+                if self._buffer_size >= self._memory_limit:
+                    self._spill()
+                num_keys += 1
+                self._report("keys", num_keys)
+            for f in key_runs:
+                f.close()
+            key_runs = []
+
+            with nogil:
+                key_trie._trie.build(ks[0], self._config_flags)
+                # libmarisa stores the final key IDs in the keyset.
+                key_ids.resize(num_keys)
+                for i in range(num_keys):
+                    key_ids[i] = ks[0][i].id()
+            del ks
+            ks = NULL
+
+            # Pass 2: merge the (value, key index) runs by value. Unique
+            # values go to the value keyset and the ID table temporarily
+            # stores value keyset indices.
+            self._spill()
+            value_runs, self._runs = self._runs, []
+            id_map = PyBytes_FromStringAndSize(NULL, num_keys * 4)
+            id_map_ptr = <unsigned char*>PyBytes_AS_STRING(id_map)
+            ks = new keyset.Keyset()
+            prev = None
+            for b_value, b_index in heapq.merge(*[_iter_run(f) for f in value_runs]):
+                if b_value != prev:
+                    ks.push_back(<char *>b_value, len(b_value))
+                    prev = b_value
+                    num_values += 1
+                    self._report("values", num_values)
+                else:
+                    # weigh values by the number of keys, as StringTrie does
+                    ks[0][num_values - 1].set_weight(ks[0][num_values - 1].weight() + 1)
+                _write_u32le(id_map_ptr + key_ids[_U32.unpack(b_index)[0]] * 4,
+                             num_values - 1)
+            with nogil:
+                value_trie._trie.build(ks[0], self._config_flags)
+                for i in range(num_keys):
+                    value_index = _read_u32le(id_map_ptr + i * 4)
+                    _write_u32le(id_map_ptr + i * 4, ks[0][value_index].id())
+        finally:
+            del ks
+            for f in key_runs + value_runs:
+                f.close()
+            self.close()
+
+        key_trie._build_prefilter(self._prefilter)
+        res._key_trie = key_trie
+        res._value_trie = value_trie
+        res._set_id_map(id_map)
+        self._stats["keys"] = num_keys
+        self._stats["values"] = num_values
+        self._stats["peak_rss"] = _peak_rss()
+        return res
+
+
+cdef class NumericTrie(_Mappable):
+    """An immutable mapping from unicode keys to 64-bit numbers.
+
+    Keys are stored in a :class:`Trie` and values in a contiguous array
+    of signed integers (``typecode="q"``) or doubles (``typecode="d"``)
+    indexed by key ID, so a lookup is one exact trie lookup followed by
+    one array read.
+    """
+    cdef Trie _key_trie
+    cdef bint _is_float
+    cdef object _values
+    cdef const unsigned char[::1] _values_view
+    # built on demand by _get_top_k_index
+    cdef _TopKIndex _top_k_index
+
+    def __init__(self, arg=None, typecode="q", num_tries=DEFAULT_NUM_TRIES,
+                 binary=False, cache_size=DEFAULT_CACHE, order=DEFAULT_ORDER,
+                 weights=None):
+        if typecode not in ("q", "d"):
+            raise ValueError("typecode must be 'q' or 'd', not %r" % (typecode, ))
+        self._is_float = typecode == "d"
+        self._key_trie = Trie()
+        self._set_values(b"")
+        if arg is not None:
+            self._build(
+                arg,
+                weights=weights,
+                num_tries=num_tries,
+                binary=binary,
+                cache_size=cache_size,
+                order=order,
+            )
+
+    def _build(self, arg, weights=None, **options):
+        cdef list keys = []
+        cdef list values = []
+        cdef object item
+        cdef Trie key_trie
+        cdef int[:] key_ids
+        cdef bytearray seen
+        cdef bytes data
+        cdef unsigned char* ptr
+        cdef Py_ssize_t i, num_keys
+
+        for item in arg:
+            try:
+                key, value = item
+            except Exception:
+                raise TypeError("NumericTrie expects (key, value) pairs")
+            if not isinstance(key, unicode):
+                raise TypeError("key must be str")
+            keys.append(key)
+            values.append(value)
+
+        key_trie, key_ids = Trie.build_with_ids(keys, weights=weights, **options)
+        num_keys = len(keys)
+        if len(key_trie) != num_keys:
+            seen = bytearray(num_keys)
+            for i in range(num_keys):
+                if seen[key_ids[i]]:
+                    raise ValueError("duplicate key: %r" % keys[i])
+                seen[key_ids[i]] = 1
+
+        data = PyBytes_FromStringAndSize(NULL, num_keys * 8)
+        ptr = <unsigned char*>PyBytes_AS_STRING(data)
+        for i in range(num_keys):
+            self._write_value(ptr + key_ids[i] * 8, values[i])
+
+        self._key_trie = key_trie
+        self._set_values(data)
+
+    cdef _set_values(self, values):
+        self._values = values
+        self._values_view = values
+        self._top_k_index = None
+
+    cdef int _clear(self) except -1:
+        self._key_trie = Trie()
+        self._set_values(b"")
+        return 0
+
+    cdef int _write_value(self, unsigned char* ptr, object value) except -1:
+        cdef _Number64 num
+        if self._is_float:
+            num.d = value
+        else:
+            num.q = PyNumber_Index(value)
+        _write_u64le(ptr, num.u)
+        return 0
+
+    cdef inline _Number64 _read_value(self, size_t key_id) noexcept nogil:
+        cdef _Number64 num
+        num.u = _read_u64le(&self._values_view[key_id * 8])
+        return num
+
+    cdef object _to_python(self, _Number64 num):
+        if self._is_float:
+            return num.d
+        return num.q
+
+    cdef long long _key_id(self, key) except -2:
+        """Return the ID of ``key`` or -1 if it is missing."""
+        cdef Py_ssize_t length
+        cdef const char* ptr
+        cdef agent.Agent ag
+        cdef bint found
+        if not isinstance(key, unicode):
+            raise TypeError("key must be str")
+        ptr = PyUnicode_AsUTF8AndSize(key, &length)
+        ag.set_query(<char *>ptr, length)
+        with nogil:
+            found = self._key_trie._trie.lookup(ag)
+        if not found:
+            return -1
+        return ag.key().id()
+
+    @property
+    def typecode(self):
+        """The type of values: ``"q"`` (int64) or ``"d"`` (float64)."""
+        return "d" if self._is_float else "q"
+
+    @property
+    def key_trie(self):
+        """Read-only accessor for internal key trie."""
+        return self._key_trie
+
+    def __richcmp__(self, other, int op):
+        if op == 2:  # ==
+            if other is self:
+                return True
+            elif not isinstance(other, NumericTrie):
+                return False
+            return (self._is_float == (<NumericTrie>other)._is_float and
+                    self._key_trie == (<NumericTrie>other)._key_trie and
+                    self._values == (<NumericTrie>other)._values)
+        elif op == 3:  # !=
+            return not (self == other)
+
+        raise TypeError("unorderable types: {0} and {1}".format(
+            self.__class__, other.__class__))
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return len(self._key_trie)
+
+    def __contains__(self, key):
+        if not isinstance(key, unicode):
+            return False
+        return key in self._key_trie
+
+    def __getitem__(self, key):
+        cdef long long key_id = self._key_id(key)
+        if key_id == -1:
+            raise KeyError(key)
+        return self._to_python(self._read_value(key_id))
+
+    def get(self, key, default=None):
+        cdef long long key_id = self._key_id(key)
+        if key_id == -1:
+            return default
+        return self._to_python(self._read_value(key_id))
+
+    def get_many(self, keys, default=0, out=None):
+        """
+        Return values for all ``keys`` as an ``array.array`` of
+        :attr:`typecode`.
+
+        This is a batched version of :meth:`get`: keys which are not
+        present get ``default``. If ``out`` is given, it must be a
+        writable buffer of int64 or float64 items (e.g. a NumPy array
+        of the matching dtype) with room for all values; it is filled in
+        place and returned.
+        """
+        cdef int[:] ids = self._key_trie.key_ids(keys)
+        cdef Py_ssize_t i, num_keys = ids.shape[0]
+        cdef long long[:] q_res
+        cdef double[:] d_res
+        cdef long long q_default = 0
+        cdef double d_default = 0
+
+        if out is None:
+            out = array.array(self.typecode, bytes(num_keys * 8))
+        if self._is_float:
+            d_res = out
+            d_default = default
+            if d_res.shape[0] < num_keys:
+                raise ValueError(
+                    "out has room for %d values, but %d keys were given" %
+                    (d_res.shape[0], num_keys))
+            with nogil:
+                for i in range(num_keys):
+                    d_res[i] = self._read_value(ids[i]).d if ids[i] != -1 else d_default
+        else:
+            q_res = out
+            q_default = default
+            if q_res.shape[0] < num_keys:
+                raise ValueError(
+                    "out has room for %d values, but %d keys were given" %
+                    (q_res.shape[0], num_keys))
+            with nogil:
+                for i in range(num_keys):
+                    q_res[i] = self._read_value(ids[i]).q if ids[i] != -1 else q_default
+        return out
+
+    cdef _TopKIndex _get_top_k_index(self):
+        cdef _TopKIndex index = self._top_k_index
+        if index is not None:
+            return index
+
+        cdef _LexOrder lex_order = self._key_trie._get_lex_order()
+        index = _TopKIndex.__new__(_TopKIndex)
+        if lex_order.ids.size():
+            with nogil:
+                index._build(lex_order.ids, &self._values_view[0], self._is_float)
+
+        with _LEX_ORDER_LOCK:
+            if self._top_k_index is None:
+                self._top_k_index = index
+            return self._top_k_index
+
+    def top_k(self, unicode prefix, int k):
+        """
+        Return up to ``k`` ``(key, value)`` pairs with the largest values
+        among the keys starting with ``prefix``, ordered by value from the
+        largest (ties in lexicographic order of keys).
+
+        The first call builds an index over the key order (about 16 bytes
+        per key); after that the search is best-first over subtree maxima
+        and costs ``O(k log n)`` regardless of how many keys match.
         """
-        cdef bytes b_key = <bytes>key.encode('utf8')
+        if k < 0:
+            raise ValueError("k must be non-negative")
+        cdef _TopKIndex index = self._get_top_k_index()
+        cdef _LexOrder lex_order = self._key_trie._get_lex_order()
+        cdef Py_ssize_t length
+        cdef const char* ptr = PyUnicode_AsUTF8AndSize(prefix, &length)
+        cdef size_t rank
+        cdef vector[size_t] ranks
         cdef agent.Agent ag
-        ag.set_query(b_key, len(b_key))
+        cdef list res = []
+        with nogil:
+            index.top_k(lex_order, self._key_trie._trie, ptr, length, k, ranks)
+
+        for rank in ranks:
+            ag.set_query(<size_t>lex_order.ids[rank])
+            self._key_trie._trie.reverse_lookup(ag)
+            res.append((self._key_trie._get_key(ag),
+                        self._to_python(self._read_value(lex_order.ids[rank]))))
+        return res
 
-        while self._trie.common_prefix_search(ag):
-            yield (self._get_key(ag), ag.key().id())
+    def iterkeys(self, unicode prefix=""):
+        return self._key_trie.iterkeys(prefix)
+
+    cpdef list keys(self, unicode prefix=""):
+        return self._key_trie.keys(prefix)
+
+    def itervalues(self, unicode prefix=""):
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        ag.set_query(b_prefix, len(b_prefix))
+
+        while self._key_trie._trie.predictive_search(ag):
+            yield self._to_python(self._read_value(ag.key().id()))
+
+    cpdef list values(self, unicode prefix=""):
+        return [value for _, value in self.items(prefix)]
 
     def iteritems(self, unicode prefix=""):
-        """
-        Return an iterator over items that have a prefix ``prefix``.
-        """
         cdef bytes b_prefix = <bytes>prefix.encode('utf8')
         cdef agent.Agent ag
-        ag.set_query(b_prefix)
+        ag.set_query(b_prefix, len(b_prefix))
 
-        while self._trie.predictive_search(ag):
-            yield self._get_key(ag), ag.key().id()
+        while self._key_trie._trie.predictive_search(ag):
+            yield (self._key_trie._get_key(ag),
+                   self._to_python(self._read_value(ag.key().id())))
 
-    def items(self, unicode prefix=""):
-        # inlined for speed
+    cpdef list items(self, unicode prefix=""):
         cdef list res = []
         cdef bytes b_prefix = <bytes>prefix.encode('utf8')
         cdef agent.Agent ag
-        ag.set_query(b_prefix)
-
-        while self._trie.predictive_search(ag):
-            res.append((self._get_key(ag), ag.key().id()))
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef vector[int] ids
+        cdef size_t i, start
+        cdef int more = 1
+        ag.set_query(b_prefix, len(b_prefix))
 
+        while more:
+            with nogil:
+                more = _predictive_batch(self._key_trie._trie, ag, buf, ends, &ids)
+            start = 0
+            for i in range(ids.size()):
+                res.append((buf.data()[start:ends[i]].decode('utf8'),
+                            self._to_python(self._read_value(ids[i]))))
+                start = ends[i]
         return res
 
+    cdef bytes _header(self):
+        return _NUMERIC_TRIE_HEADER.pack(
+            _NUMERIC_TRIE_MAGIC,
+            _NUMERIC_TRIE_VERSION,
+            _NUMERIC_TRIE_FLOAT if self._is_float else 0,
+            self._key_trie._image_size(),
+            len(self._values),
+        )
 
-cdef class StringTrie:
-    """An immutable mapping from unicode keys to unicode values.
+    cpdef bytes tobytes(self) except +:
+        return self._header() + self._key_trie.tobytes() + bytes(self._values)
 
-    The mapping is represented by two internal tries and a fixed-width
-    key-id to value-id table.
+    cdef _write(self, f):
+        f.write(self._header())
+        self._key_trie.save(f)
+        f.write(self._values)
+
+    cdef tuple _unpack_header(self, data):
+        """Validate the header at the start of serialized NumericTrie ``data``.
+
+        Return the lengths of the key trie and the values and whether the
+        values are floats."""
+        cdef Py_ssize_t header_len = _NUMERIC_TRIE_HEADER.size
+        cdef bytes magic
+        cdef int version, flags
+        cdef unsigned long long key_len, values_len
+
+        if len(data) < header_len:
+            raise ValueError("Invalid NumericTrie data: truncated header")
+
+        magic, version, flags, key_len, values_len = _NUMERIC_TRIE_HEADER.unpack_from(data)
+        if magic != _NUMERIC_TRIE_MAGIC:
+            raise ValueError("Invalid NumericTrie data: bad magic")
+        if version != _NUMERIC_TRIE_VERSION:
+            raise ValueError("Unsupported NumericTrie version: %d" % version)
+        if flags & ~_NUMERIC_TRIE_FLOAT:
+            raise ValueError("Unsupported NumericTrie flags: %d" % flags)
+        return key_len, values_len, bool(flags & _NUMERIC_TRIE_FLOAT)
+
+    cdef tuple _parse_header(self, data):
+        """Validate the header of serialized NumericTrie ``data``.
+
+        Return the offset of the values and whether they are floats."""
+        cdef unsigned long long key_len, values_len
+        key_len, values_len, is_float = self._unpack_header(data)
+        if (_NUMERIC_TRIE_HEADER.size + key_len + values_len !=
+                <unsigned long long>len(data)):
+            raise ValueError("Invalid NumericTrie data: invalid payload length")
+        return _NUMERIC_TRIE_HEADER.size + key_len, is_float
+
+    cdef _check_length(self, Trie key_trie, values):
+        if len(key_trie) * 8 != len(values):
+            raise ValueError("Invalid NumericTrie data: key trie and values length mismatch")
+
+    cdef _load_sections(self, Trie key_trie, bytes values, bint is_float):
+        self._check_length(key_trie, values)
+
+        # nothing is changed until all checks have passed
+        self._is_float = is_float
+        self._key_trie = key_trie
+        self._set_values(values)
+        self._buffer = None
+        self._shm = None
+        return self
+
+    cpdef frombytes(self, bytes data) except +:
+        cdef Py_ssize_t values_offset
+        values_offset, is_float = self._parse_header(data)
+        return self._load_sections(
+            Trie().frombytes(data[_NUMERIC_TRIE_HEADER.size:values_offset]),
+            data[values_offset:],
+            is_float,
+        )
+
+    def map(self, buffer):
+        """Load a NumericTrie from an object exposing the buffer protocol.
+
+        The key trie and the values are used in place, without copying
+        ``buffer``; a reference to it is kept while the NumericTrie is
+        alive.
+        """
+        cdef object view = memoryview(buffer).cast("B")
+        cdef Py_ssize_t values_offset
+        values_offset, is_float = self._parse_header(view)
+        cdef Trie key_trie = Trie().map(view[_NUMERIC_TRIE_HEADER.size:values_offset])
+        values = view[values_offset:]
+        self._check_length(key_trie, values)
+
+        self._is_float = is_float
+        self._key_trie = key_trie
+        self._set_values(values)
+        self._buffer = view
+        self._shm = None
+        return self
+
+    def save(self, path):
+        """Save a NumericTrie to a specified path or a binary file-like object.
+
+        The sections are written one by one, without serializing the
+        NumericTrie in memory first.
+        """
+        if hasattr(path, "write"):
+            self._write(path)
+            return
+        with open(path, "wb") as f:
+            self._write(f)
+
+    def load(self, path):
+        """Load a NumericTrie from a specified path or a binary file-like object.
+
+        Only the bytes of the NumericTrie are read from a file-like object, so
+        several tries can be loaded from one stream in turn. The key trie
+        and the values are read into place, without a copy of the whole
+        NumericTrie.
+        """
+        cdef _FileStream stream
+        cdef unsigned long long key_len, values_len
+        if hasattr(path, "readinto") or hasattr(path, "read"):
+            stream = _FileStream(path)
+            key_len, values_len, is_float = self._unpack_header(_read_header(
+                stream, b"", _NUMERIC_TRIE_HEADER, _NUMERIC_TRIE_MAGIC, "NumericTrie"))
+            key_trie = _read_trie(stream, key_len, "NumericTrie")
+            if <unsigned long long>len(key_trie) * 8 != values_len:
+                raise ValueError("Invalid NumericTrie data: key trie and values length mismatch")
+            return self._load_sections(
+                key_trie, _read_table(stream, values_len, "NumericTrie"), is_float)
+        with open(path, "rb") as f:
+            self.frombytes(f.read())
+        return self
+
+
+cdef class PayloadTrie(_Mappable):
+    """An immutable mapping from unicode keys to lists of bytes payloads.
+
+    Unlike :class:`BytesTrie`, payloads are not encoded into the trie.
+    Keys are stored once in a :class:`Trie` and payloads are concatenated
+    into a blob in a CSR layout: a key offsets array indexed by key ID
+    gives the range of payloads of a key and a payload offsets array
+    gives the range of bytes of a payload. A lookup is one exact trie
+    lookup followed by slicing the blob.
     """
     cdef Trie _key_trie
-    cdef Trie _value_trie
-    cdef bytes _id_map
+    cdef object _key_offsets
+    cdef object _payload_offsets
+    cdef object _blob
+    cdef const unsigned char[::1] _key_offsets_view
+    cdef const unsigned char[::1] _payload_offsets_view
+    cdef const unsigned char[::1] _blob_view
 
     def __init__(self, arg=None, num_tries=DEFAULT_NUM_TRIES, binary=False,
                  cache_size=DEFAULT_CACHE, order=DEFAULT_ORDER, weights=None):
+        """
+        ``arg`` must be an iterable of tuples (unicode_key, bytes_payload).
+        A key may occur several times; its payloads are kept in input order.
+        """
         self._key_trie = Trie()
-        self._value_trie = Trie()
-        self._id_map = b""
+        self._set_sections(_EMPTY_OFFSETS, _EMPTY_OFFSETS, b"")
         if arg is not None:
             self._build(
                 arg,
@@ -579,74 +4454,127 @@ cdef class StringTrie:
 
     def _build(self, arg, weights=None, **options):
         cdef list keys = []
-        cdef set seen_keys = set()
-        cdef dict value_by_key = {}
-        cdef str key
-        cdef str value
+        cdef list payloads = []
         cdef object item
-        cdef list unique_values
-        cdef list value_ids
-        cdef int key_id
-        cdef int value_id
-        cdef int num_keys
+        cdef bytes payload
+        cdef Trie key_trie
+        cdef int[:] key_ids
+        cdef vector[unsigned long long] key_ends, payload_ends
+        cdef vector[size_t] slots
+        cdef bytes key_offsets, payload_offsets, blob
+        cdef char* blob_ptr
+        cdef Py_ssize_t i, num_keys, num_payloads
 
         for item in arg:
             try:
-                key, value = item
+                key, payload = item
             except Exception:
-                raise TypeError("StringTrie expects (key, value) pairs")
-
+                raise TypeError("PayloadTrie expects (key, payload) pairs")
             if not isinstance(key, unicode):
                 raise TypeError("key must be str")
-            if not isinstance(value, unicode):
-                raise TypeError("value must be str")
-
-            if key in seen_keys:
-                raise ValueError("duplicate key: %r" % key)
-
-            seen_keys.add(key)
+            if not isinstance(payload, bytes):
+                raise TypeError("payload must be bytes")
             keys.append(key)
-            value_by_key[key] = value
-
-        unique_values = list(dict.fromkeys(value_by_key.values()))
-
-        num_keys = len(keys)
-        if num_keys > _STRING_TRIE_U32_MAX:
-            raise ValueError("too many keys for 4-byte key-id mapping")
-        if len(unique_values) > _STRING_TRIE_U32_MAX:
-            raise ValueError("too many values for 4-byte value-id mapping")
+            payloads.append(payload)
 
-        self._key_trie = Trie(keys, weights=weights, **options)
-        self._value_trie = Trie(unique_values, **options)
+        key_trie, key_ids = Trie.build_with_ids(keys, weights=weights, **options)
+        num_keys = len(key_trie)
+        num_payloads = len(payloads)
 
-        if num_keys == 0:
-            self._id_map = b""
-            return
+        # Count payloads per key and turn the counts into offsets, then
+        # give every payload the next free slot of its key.
+        key_ends.resize(num_keys + 1)
+        for i in range(num_payloads):
+            key_ends[key_ids[i] + 1] += 1
+        for i in range(num_keys):
+            key_ends[i + 1] += key_ends[i]
+        key_offsets = _pack_offsets(key_ends)
+
+        slots.resize(num_payloads)
+        payload_ends.resize(num_payloads + 1)
+        for i in range(num_payloads):
+            slots[i] = key_ends[key_ids[i]]
+            key_ends[key_ids[i]] += 1
+            payload_ends[slots[i] + 1] = PyBytes_GET_SIZE(payloads[i])
+        for i in range(num_payloads):
+            payload_ends[i + 1] += payload_ends[i]
+        payload_offsets = _pack_offsets(payload_ends)
+
+        blob = PyBytes_FromStringAndSize(NULL, payload_ends[num_payloads])
+        blob_ptr = PyBytes_AS_STRING(blob)
+        for i in range(num_payloads):
+            payload = payloads[i]
+            memcpy(blob_ptr + payload_ends[slots[i]], PyBytes_AS_STRING(payload),
+                   PyBytes_GET_SIZE(payload))
+
+        self._key_trie = key_trie
+        self._set_sections(key_offsets, payload_offsets, blob)
+
+    cdef _set_sections(self, key_offsets, payload_offsets, blob):
+        self._key_offsets = key_offsets
+        self._payload_offsets = payload_offsets
+        self._blob = blob
+        self._key_offsets_view = key_offsets
+        self._payload_offsets_view = payload_offsets
+        self._blob_view = blob
+
+    cdef int _clear(self) except -1:
+        self._key_trie = Trie()
+        self._set_sections(_EMPTY_OFFSETS, _EMPTY_OFFSETS, b"")
+        return 0
 
-        value_ids = [0] * num_keys
-        for key in keys:
-            key_id = self._key_trie[key]
-            value_id = self._value_trie[value_by_key[key]]
-            value_ids[key_id] = value_id
-        self._id_map = struct.pack("<%dI" % num_keys, *value_ids)
+    cdef list _payloads(self, size_t key_id):
+        cdef list res = []
+        cdef unsigned long long num_payloads = self._payload_offsets_view.shape[0] // 8 - 1
+        cdef unsigned long long blob_len = self._blob_view.shape[0]
+        cdef unsigned long long first, last, start, end
+        cdef const char* blob_ptr = <const char*>&self._blob_view[0] if blob_len else NULL
+
+        first = _read_u64le(&self._key_offsets_view[key_id * 8])
+        last = _read_u64le(&self._key_offsets_view[key_id * 8 + 8])
+        # mapped data is not validated upfront, so check offsets on access
+        if first > last or last > num_payloads:
+            raise ValueError("Invalid PayloadTrie data: key offsets out of range")
+        while first < last:
+            start = _read_u64le(&self._payload_offsets_view[first * 8])
+            end = _read_u64le(&self._payload_offsets_view[first * 8 + 8])
+            if start > end or end > blob_len:
+                raise ValueError("Invalid PayloadTrie data: payload offsets out of range")
+            res.append(blob_ptr[start:end] if start < end else b"")
+            first += 1
+        return res
 
-    cdef int _value_id_from_key_id(self, int key_id) except -1:
-        return <int>_U32.unpack_from(self._id_map, key_id * 4)[0]
+    cdef long long _key_id(self, key) except -2:
+        """Return the ID of ``key`` or -1 if it is missing."""
+        cdef Py_ssize_t length
+        cdef const char* ptr
+        cdef agent.Agent ag
+        cdef bint found
+        if not isinstance(key, unicode):
+            raise TypeError("key must be str")
+        ptr = PyUnicode_AsUTF8AndSize(key, &length)
+        ag.set_query(<char *>ptr, length)
+        with nogil:
+            found = self._key_trie._trie.lookup(ag)
+        if not found:
+            return -1
+        return ag.key().id()
 
-    cdef unicode _value_for_key(self, unicode key):
-        cdef int key_id = self._key_trie[key]
-        cdef int value_id = self._value_id_from_key_id(key_id)
-        return self._value_trie.restore_key(value_id)
+    @property
+    def key_trie(self):
+        """Read-only accessor for internal key trie."""
+        return self._key_trie
 
     def __richcmp__(self, other, int op):
         if op == 2:  # ==
             if other is self:
                 return True
-            elif not isinstance(other, StringTrie):
+            elif not isinstance(other, PayloadTrie):
                 return False
-            return (self._key_trie == (<StringTrie>other)._key_trie and
-                    self._value_trie == (<StringTrie>other)._value_trie and
-                    self._id_map == (<StringTrie>other)._id_map)
+            return (self._key_trie == (<PayloadTrie>other)._key_trie and
+                    self._key_offsets == (<PayloadTrie>other)._key_offsets and
+                    self._payload_offsets == (<PayloadTrie>other)._payload_offsets and
+                    self._blob == (<PayloadTrie>other)._blob)
         elif op == 3:  # !=
             return not (self == other)
 
@@ -665,26 +4593,20 @@ cdef class StringTrie:
         return key in self._key_trie
 
     def __getitem__(self, key):
-        if not isinstance(key, unicode):
-            raise TypeError("key must be str")
-        return self._value_for_key(<unicode>key)
+        cdef long long key_id = self._key_id(key)
+        if key_id == -1:
+            raise KeyError(key)
+        return self._payloads(key_id)
 
     def get(self, key, default=None):
-        if not isinstance(key, unicode):
-            raise TypeError("key must be str")
-        if key not in self._key_trie:
+        """
+        Return a list of payloads (as byte objects) for a given key
+        or ``default`` if the key is not found.
+        """
+        cdef long long key_id = self._key_id(key)
+        if key_id == -1:
             return default
-        return self._value_for_key(<unicode>key)
-
-    @property
-    def key_trie(self):
-        """Read-only accessor for internal key trie."""
-        return self._key_trie
-
-    @property
-    def value_trie(self):
-        """Read-only accessor for internal value trie."""
-        return self._value_trie
+        return self._payloads(key_id)
 
     def iter_prefixes(self, unicode key):
         return self._key_trie.iter_prefixes(key)
@@ -698,121 +4620,197 @@ cdef class StringTrie:
     cpdef list keys(self, unicode prefix=""):
         return self._key_trie.keys(prefix)
 
-    def itervalues(self, unicode prefix=""):
-        cdef unicode key
-        for key in self._key_trie.iterkeys(prefix):
-            yield self._value_for_key(key)
-
-    cpdef list values(self, unicode prefix=""):
-        cdef unicode key
-        cdef list res = []
-        for key in self._key_trie.iterkeys(prefix):
-            res.append(self._value_for_key(key))
-        return res
-
     def iteritems(self, unicode prefix=""):
-        cdef unicode key
-        for key in self._key_trie.iterkeys(prefix):
-            yield key, self._value_for_key(key)
+        """
+        Yield ``(key, payload)`` pairs for every payload of the keys
+        starting with ``prefix``.
+        """
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        ag.set_query(b_prefix, len(b_prefix))
+
+        while self._key_trie._trie.predictive_search(ag):
+            key = self._key_trie._get_key(ag)
+            for payload in self._payloads(ag.key().id()):
+                yield key, payload
 
     cpdef list items(self, unicode prefix=""):
-        cdef unicode key
+        """
+        Return a list of ``(key, payload)`` pairs for every payload of
+        the keys starting with ``prefix``.
+        """
         cdef list res = []
-        for key in self._key_trie.iterkeys(prefix):
-            res.append((key, self._value_for_key(key)))
-        return res
-
-    def iter_prefix_items(self, unicode key):
-        cdef unicode prefix
-        for prefix in self._key_trie.iter_prefixes(key):
-            yield prefix, self._value_for_key(prefix)
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef agent.Agent ag
+        cdef string buf
+        cdef vector[size_t] ends
+        cdef vector[int] ids
+        cdef size_t i, start
+        cdef int more = 1
+        ag.set_query(b_prefix, len(b_prefix))
 
-    cpdef list prefix_items(self, unicode key):
-        cdef unicode prefix
-        cdef list res = []
-        for prefix in self._key_trie.iter_prefixes(key):
-            res.append((prefix, self._value_for_key(prefix)))
+        while more:
+            with nogil:
+                more = _predictive_batch(self._key_trie._trie, ag, buf, ends, &ids)
+            start = 0
+            for i in range(ids.size()):
+                key = buf.data()[start:ends[i]].decode('utf8')
+                for payload in self._payloads(ids[i]):
+                    res.append((key, payload))
+                start = ends[i]
         return res
 
-    cpdef bytes tobytes(self) except +:
-        cdef bytes key_blob = self._key_trie.tobytes()
-        cdef bytes value_blob = self._value_trie.tobytes()
-        cdef bytes header = _STRING_TRIE_HEADER.pack(
-            _STRING_TRIE_MAGIC,
-            _STRING_TRIE_VERSION,
-            _STRING_TRIE_FLAGS,
-            len(key_blob),
-            len(value_blob),
-            len(self._id_map),
+    cdef bytes _header(self):
+        return _PAYLOAD_TRIE_HEADER.pack(
+            _PAYLOAD_TRIE_MAGIC,
+            _PAYLOAD_TRIE_VERSION,
+            0,
+            self._key_trie._image_size(),
+            len(self._key_offsets),
+            len(self._payload_offsets),
+            len(self._blob),
         )
-        return header + key_blob + value_blob + self._id_map
 
-    cpdef frombytes(self, bytes data) except +:
-        cdef int header_len = _STRING_TRIE_HEADER.size
-        cdef int key_len, value_len, id_map_len
-        cdef int total_len
-        cdef int key_offset
-        cdef int value_offset
-        cdef int id_map_offset
+    cpdef bytes tobytes(self) except +:
+        return b"".join([self._header(), self._key_trie.tobytes(), self._key_offsets,
+                         self._payload_offsets, self._blob])
+
+    cdef _write(self, f):
+        f.write(self._header())
+        self._key_trie.save(f)
+        f.write(self._key_offsets)
+        f.write(self._payload_offsets)
+        f.write(self._blob)
+
+    cdef tuple _unpack_header(self, data):
+        """Validate the header at the start of serialized PayloadTrie ``data``.
+
+        Return the lengths of the key trie, the key offsets, the payload
+        offsets and the blob."""
+        cdef Py_ssize_t header_len = _PAYLOAD_TRIE_HEADER.size
         cdef bytes magic
-        cdef int version
-        cdef int flags
-        cdef int key_id
-        cdef int value_id
+        cdef int version, flags
+        cdef unsigned long long key_len, key_offsets_len, payload_offsets_len, blob_len
 
         if len(data) < header_len:
-            raise ValueError("Invalid StringTrie data: truncated header")
-
-        magic, version, flags, key_len, value_len, id_map_len = _STRING_TRIE_HEADER.unpack(
-            data[:header_len]
+            raise ValueError("Invalid PayloadTrie data: truncated header")
+
+        (magic, version, flags, key_len, key_offsets_len, payload_offsets_len,
+         blob_len) = _PAYLOAD_TRIE_HEADER.unpack_from(data)
+        if magic != _PAYLOAD_TRIE_MAGIC:
+            raise ValueError("Invalid PayloadTrie data: bad magic")
+        if version != _PAYLOAD_TRIE_VERSION:
+            raise ValueError("Unsupported PayloadTrie version: %d" % version)
+        if flags != 0:
+            raise ValueError("Unsupported PayloadTrie flags: %d" % flags)
+        if key_offsets_len % 8 or payload_offsets_len % 8 or not payload_offsets_len:
+            raise ValueError("Invalid PayloadTrie data: invalid offsets length")
+        return key_len, key_offsets_len, payload_offsets_len, blob_len
+
+    cdef tuple _parse_header(self, data):
+        """Validate the header of serialized PayloadTrie ``data``.
+
+        Return the offsets of all sections and the end of the data."""
+        cdef Py_ssize_t header_len = _PAYLOAD_TRIE_HEADER.size
+        cdef unsigned long long key_len, key_offsets_len, payload_offsets_len, blob_len
+        key_len, key_offsets_len, payload_offsets_len, blob_len = self._unpack_header(data)
+        if (header_len + key_len + key_offsets_len + payload_offsets_len + blob_len !=
+                <unsigned long long>len(data)):
+            raise ValueError("Invalid PayloadTrie data: invalid payload length")
+
+        return (
+            header_len,
+            header_len + key_len,
+            header_len + key_len + key_offsets_len,
+            header_len + key_len + key_offsets_len + payload_offsets_len,
+            len(data),
         )
-        if magic != _STRING_TRIE_MAGIC:
-            raise ValueError("Invalid StringTrie data: bad magic")
-        if version != _STRING_TRIE_VERSION:
-            raise ValueError("Unsupported StringTrie version: %d" % version)
-        if flags != _STRING_TRIE_FLAGS:
-            raise ValueError("Unsupported StringTrie flags: %d" % flags)
-
-        total_len = header_len + key_len + value_len + id_map_len
-        if total_len != len(data):
-            raise ValueError("Invalid StringTrie data: invalid payload length")
-        if id_map_len % 4 != 0:
-            raise ValueError("Invalid StringTrie data: id map length is not a multiple of 4")
-
-        key_offset = header_len
-        value_offset = key_offset + key_len
-        id_map_offset = value_offset + value_len
 
-        self._key_trie = Trie().frombytes(data[key_offset:value_offset])
-        self._value_trie = Trie().frombytes(data[value_offset:id_map_offset])
-        self._id_map = data[id_map_offset:]
+    cdef _load_sections(self, Trie key_trie, key_offsets, payload_offsets, blob):
+        if (len(key_trie) + 1) * 8 != len(key_offsets):
+            raise ValueError("Invalid PayloadTrie data: key trie and key offsets length mismatch")
+        self._key_trie = key_trie
+        self._set_sections(key_offsets, payload_offsets, blob)
+
+    cdef _load_data(self, data, Trie key_trie, tuple offsets):
+        cdef Py_ssize_t key_offsets_offset, payload_offsets_offset, blob_offset, end
+        _, key_offsets_offset, payload_offsets_offset, blob_offset, end = offsets
+        self._load_sections(
+            key_trie,
+            data[key_offsets_offset:payload_offsets_offset],
+            data[payload_offsets_offset:blob_offset],
+            data[blob_offset:end],
+        )
 
-        if len(self._key_trie) != id_map_len // 4:
-            raise ValueError("Invalid StringTrie data: key trie and id map length mismatch")
+    cpdef frombytes(self, bytes data) except +:
+        cdef tuple offsets = self._parse_header(data)
+        cdef Trie key_trie = Trie().frombytes(data[offsets[0]:offsets[1]])
+        self._load_data(data, key_trie, offsets)
+        self._buffer = None
+        self._shm = None
+        return self
 
-        for key_id in range(len(self._key_trie)):
-            value_id = self._value_id_from_key_id(key_id)
-            if value_id < 0 or value_id >= len(self._value_trie):
-                raise ValueError("Invalid StringTrie data: value id out of range")
+    def map(self, buffer):
+        """Load a PayloadTrie from an object exposing the buffer protocol.
 
+        All sections are used in place, without copying ``buffer``; a
+        reference to it is kept while the PayloadTrie is alive.
+        """
+        cdef object view = memoryview(buffer).cast("B")
+        cdef tuple offsets = self._parse_header(view)
+        cdef Trie key_trie = Trie().map(view[offsets[0]:offsets[1]])
+        self._load_data(view, key_trie, offsets)
+        self._buffer = view
+        self._shm = None
         return self
 
     def save(self, path):
-        """Save a StringTrie to a specified path."""
+        """Save a PayloadTrie to a specified path or a binary file-like object.
+
+        The sections are written one by one, without serializing the
+        PayloadTrie in memory first.
+        """
+        if hasattr(path, "write"):
+            self._write(path)
+            return
         with open(path, "wb") as f:
-            f.write(self.tobytes())
+            self._write(f)
 
     def load(self, path):
-        """Load a StringTrie from a specified path."""
+        """Load a PayloadTrie from a specified path or a binary file-like object.
+
+        Only the bytes of the PayloadTrie are read from a file-like object, so
+        several tries can be loaded from one stream in turn. The key trie,
+        the offsets and the payloads are read into place, without a copy of
+        the whole PayloadTrie.
+        """
+        cdef _FileStream stream
+        cdef unsigned long long key_len, key_offsets_len, payload_offsets_len, blob_len
+        if hasattr(path, "readinto") or hasattr(path, "read"):
+            stream = _FileStream(path)
+            key_len, key_offsets_len, payload_offsets_len, blob_len = self._unpack_header(
+                _read_header(stream, b"", _PAYLOAD_TRIE_HEADER, _PAYLOAD_TRIE_MAGIC,
+                             "PayloadTrie"))
+            key_trie = _read_trie(stream, key_len, "PayloadTrie")
+            # The offsets are otherwise checked on access, but here they
+            # bound the lengths of the next tables before these are allocated.
+            if (len(key_trie) + 1) * 8 != key_offsets_len:
+                raise ValueError("Invalid PayloadTrie data: key trie and key offsets length mismatch")
+            key_offsets = _read_table(stream, key_offsets_len, "PayloadTrie")
+            if _U64.unpack_from(key_offsets, key_offsets_len - 8)[0] + 1 != payload_offsets_len // 8:
+                raise ValueError("Invalid PayloadTrie data: key offsets and payload offsets length mismatch")
+            payload_offsets = _read_table(stream, payload_offsets_len, "PayloadTrie")
+            if _U64.unpack_from(payload_offsets, payload_offsets_len - 8)[0] != blob_len:
+                raise ValueError("Invalid PayloadTrie data: payload offsets and blob length mismatch")
+            self._load_sections(key_trie, key_offsets, payload_offsets,
+                                _read_table(stream, blob_len, "PayloadTrie"))
+            self._buffer = None
+            self._shm = None
+            return self
         with open(path, "rb") as f:
             self.frombytes(f.read())
         return self
 
-    def __reduce__(self):
-        return self.__class__, (), self.tobytes()
-
-    __setstate__ = frombytes
-
 
 # This symbol is not allowed in utf8 so it is safe to use
 # as a separator between utf8-encoded string and binary payload.
@@ -846,6 +4844,15 @@ cdef class BytesTrie(_UnicodeKeyedTrie):
     cpdef bytes _raw_key(self, unicode key, bytes payload):
         return key.encode('utf8') + self._b_value_separator + payload
 
+    cdef bint _has_payloads(self) noexcept nogil:
+        return True
+
+    cdef size_t _key_part_length(self, const string& entry) noexcept nogil:
+        cdef size_t i = 0
+        while i < entry.size() and <unsigned char>entry[i] != self._c_value_separator:
+            i += 1
+        return i
+
     cdef bint _contains(self, bytes key):
         cdef agent.Agent ag
         cdef bytes _key = key + self._b_value_separator
@@ -862,10 +4869,10 @@ cdef class BytesTrie(_UnicodeKeyedTrie):
 
         cdef agent.Agent ag
         cdef list res = []
-        cdef int key_len = len(key)
+        cdef Py_ssize_t key_len = len(key)
         cdef unicode prefix
         cdef bytes b_prefix
-        cdef int ind = 1
+        cdef Py_ssize_t ind = 1
 
         while ind <= key_len:
             prefix = key[:ind]
@@ -932,7 +4939,7 @@ cdef class BytesTrie(_UnicodeKeyedTrie):
         cdef unicode key
         cdef unsigned char* raw_key
         cdef list res = []
-        cdef int i, value_len
+        cdef size_t i
 
         cdef agent.Agent ag
         ag.set_query(b_prefix)
@@ -957,7 +4964,7 @@ cdef class BytesTrie(_UnicodeKeyedTrie):
         cdef bytes value
         cdef unicode key
         cdef unsigned char* raw_key
-        cdef int i, value_len
+        cdef size_t i
 
         cdef agent.Agent ag
         ag.set_query(b_prefix)
@@ -980,7 +4987,7 @@ cdef class BytesTrie(_UnicodeKeyedTrie):
         cdef unicode key
         cdef unsigned char* raw_key
         cdef list res = []
-        cdef int i
+        cdef size_t i
 
         cdef agent.Agent ag
         ag.set_query(b_prefix)
@@ -999,7 +5006,7 @@ cdef class BytesTrie(_UnicodeKeyedTrie):
         cdef bytes b_prefix = <bytes>prefix.encode('utf8')
         cdef unicode key
         cdef unsigned char* raw_key
-        cdef int i
+        cdef size_t i
 
         cdef agent.Agent ag
         ag.set_query(b_prefix)
@@ -1037,6 +5044,63 @@ cdef class _UnpackTrie(BytesTrie):
         return ((key, self._unpack(val)) for key, val in BytesTrie.iteritems(self, prefix))
 
 
+def _import_numpy(method):
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("NumPy is required for %s()" % method)
+    return numpy
+
+
+def _struct_dtype(numpy, fmt):
+    """Return a NumPy structured dtype matching the :mod:`struct` format
+    ``fmt``, with one field (``f0``, ``f1``, ...) per unpacked value."""
+    order = fmt[:1] if fmt[:1] in "@=<>!" else "@"
+    items = fmt[1:] if fmt[:1] in "@=<>!" else fmt
+    byteorder = {"@": "=", "=": "=", "<": "<", ">": ">", "!": ">"}[order]
+    names, formats, offsets = [], [], []
+    codes = ""
+    pos = 0
+
+    while pos < len(items.rstrip()):
+        match = _STRUCT_ITEM_RE.match(items, pos)
+        if match is None:
+            raise ValueError("unsupported struct format: %r" % fmt)
+        pos = match.end()
+        count, code = match.groups()
+        count = int(count) if count else 1
+        if code in "sp":
+            if code == "p":
+                raise ValueError("'p' struct format is not supported")
+            field_codes = ["%ds" % count]
+        else:
+            field_codes = [code] * count
+        for field_code in field_codes:
+            codes += field_code
+            if code == "x":
+                continue
+            size = struct.calcsize(order + field_code)
+            offsets.append(struct.calcsize(order + codes) - size)
+            names.append("f%d" % len(names))
+            if code in "sc":
+                formats.append("S%d" % size)
+            elif code == "?":
+                formats.append("?")
+            elif code in "efd":
+                formats.append("%sf%d" % (byteorder, size))
+            elif code in "bhilqn":
+                formats.append("%si%d" % (byteorder, size))
+            else:
+                formats.append("%su%d" % (byteorder, size))
+
+    return numpy.dtype({
+        "names": names,
+        "formats": formats,
+        "offsets": offsets,
+        "itemsize": struct.calcsize(fmt),
+    })
+
+
 cdef class RecordTrie(_UnpackTrie):
     """A trie mapping unicode keys to lists of data tuples.
 
@@ -1049,6 +5113,7 @@ cdef class RecordTrie(_UnpackTrie):
     """
     cdef _struct
     cdef _fmt
+    cdef object _dtype
 
     def __init__(self, fmt, arg=None, **options):
         """
@@ -1066,5 +5131,398 @@ cdef class RecordTrie(_UnpackTrie):
     cdef bytes _pack(self, value):
         return self._struct.pack(*value)
 
-    def __reduce__(self):
-        return self.__class__, (self._fmt, ), self.tobytes()
+    cdef _records_array(self, numpy, string& buf):
+        """Return the packed records in ``buf`` as a structured array."""
+        if self._dtype is None:
+            self._dtype = _struct_dtype(numpy, self._fmt)
+        cdef Py_ssize_t record_size = self._struct.size
+        res = numpy.empty(buf.size() // record_size if record_size else 0, self._dtype)
+        cdef unsigned char[::1] dst = res.view(numpy.uint8)
+        if buf.size():
+            memcpy(&dst[0], buf.data(), buf.size())
+        return res
+
+    def items_array(self, unicode prefix=""):
+        """
+        Return ``(keys, records)`` for all records of keys starting with
+        ``prefix``: a list of keys and a NumPy structured array with one
+        field per value of the record format, in the same order.
+
+        Records are copied from the trie without creating Python objects
+        for them. Requires NumPy.
+        """
+        numpy = _import_numpy("items_array")
+        cdef bytes b_prefix = <bytes>prefix.encode('utf8')
+        cdef list keys = []
+        cdef string buf, key_buf
+        cdef vector[size_t] key_ends
+        cdef const char* raw_key
+        cdef size_t i, start, length
+        cdef size_t record_size = self._struct.size
+        cdef bint bad_record = False
+        cdef agent.Agent ag
+        ag.set_query(b_prefix, len(b_prefix))
+
+        with nogil:
+            while self._trie.predictive_search(ag):
+                raw_key = ag.key().ptr()
+                length = ag.key().length()
+                for i in range(length):
+                    if <unsigned char>raw_key[i] == self._c_value_separator:
+                        break
+                if length - i - 1 != record_size:
+                    bad_record = True
+                    break
+                key_buf.append(raw_key, i)
+                key_ends.push_back(key_buf.size())
+                buf.append(raw_key + i + 1, record_size)
+        if bad_record:
+            raise ValueError("record size does not match the format %r" % self._fmt)
+
+        start = 0
+        for i in range(key_ends.size()):
+            keys.append(key_buf.data()[start:key_ends[i]].decode('utf8'))
+            start = key_ends[i]
+        return keys, self._records_array(numpy, buf)
+
+    def get_many_array(self, keys):
+        """
+        Return ``(records, key_index)`` for all records of ``keys``: a
+        NumPy structured array with one field per value of the record
+        format and an ``int32`` array with the position in ``keys`` of the
+        key each record belongs to. Missing keys have no records.
+
+        Requires NumPy.
+        """
+        numpy = _import_numpy("get_many_array")
+        cdef list queries = []
+        cdef vector[const char*] ptrs
+        cdef vector[Py_ssize_t] lengths
+        cdef vector[int] key_index
+        cdef string buf
+        cdef Py_ssize_t i, prefix_len
+        cdef size_t record_size = self._struct.size
+        cdef bint bad_record = False
+        cdef bytes query
+        cdef agent.Agent ag
+
+        for key in keys:
+            if isinstance(key, unicode):
+                query = (<unicode>key).encode('utf8') + self._b_value_separator
+            elif isinstance(key, bytes):
+                query = key + self._b_value_separator
+            else:
+                raise TypeError("key must be str or bytes, not %s" % type(key).__name__)
+            queries.append(query)
+            ptrs.push_back(PyBytes_AS_STRING(query))
+            lengths.push_back(PyBytes_GET_SIZE(query))
+
+        with nogil:
+            for i in range(<Py_ssize_t>ptrs.size()):
+                prefix_len = lengths[i]
+                ag.set_query(<char *>ptrs[i], prefix_len)
+                while self._trie.predictive_search(ag):
+                    if ag.key().length() - prefix_len != record_size:
+                        bad_record = True
+                        break
+                    buf.append(ag.key().ptr() + prefix_len, record_size)
+                    key_index.push_back(i)
+        if bad_record:
+            raise ValueError("record size does not match the format %r" % self._fmt)
+
+        index = numpy.empty(key_index.size(), numpy.int32)
+        cdef int[::1] index_view = index
+        if key_index.size():
+            memcpy(&index_view[0], key_index.data(), key_index.size() * sizeof(int))
+        return self._records_array(numpy, buf), index
+
+    cdef tuple _pickle_args(self):
+        return (self._fmt, )
+
+
+# Trie types which can be stored in a TrieBundle, by type name.
+_BUNDLE_TYPES = {
+    cls.__name__: cls
+    for cls in [BinaryTrie, Trie, BytesTrie, RecordTrie, StringTrie,
+                NumericTrie, PayloadTrie]
+}
+
+
+cdef tuple _bundle_section_type(obj):
+    """Return the type name, struct format and value separator stored in a
+    TrieBundle index for ``obj``."""
+    cdef bytes fmt = b"", separator = b""
+    type_name = type(obj).__name__
+    if _BUNDLE_TYPES.get(type_name) is not type(obj):
+        raise TypeError("unsupported TrieBundle section type: %s" % type_name)
+    if isinstance(obj, BytesTrie):
+        separator = (<BytesTrie>obj)._b_value_separator
+    if isinstance(obj, RecordTrie):
+        fmt = str((<RecordTrie>obj)._fmt).encode("utf8")
+    return type_name.encode("ascii"), fmt, separator
+
+
+cdef class TrieBundle:
+    """A read-only collection of named tries stored in a single file.
+
+    The file starts with a small header, each trie is stored in its own
+    page-aligned section and an index records the name, the type, the
+    ``RecordTrie`` format, the ``BytesTrie`` value separator, the
+    position and the CRC-32 checksum of every section. :meth:`mmap` maps
+    the file once and a trie is only constructed (in place, over its
+    section) when it is first accessed.
+
+    ``tries`` is a mapping or an iterable of ``(name, trie)`` pairs with
+    unicode names; supported types are :class:`Trie`,
+    :class:`BinaryTrie`, :class:`BytesTrie`, :class:`RecordTrie`,
+    :class:`StringTrie`, :class:`NumericTrie` and :class:`PayloadTrie`.
+    """
+    cdef list _names
+    # tries by name, constructed on first access for mapped bundles
+    cdef dict _tries
+    # (type name, fmt, separator, offset, size, checksum) by name
+    cdef dict _sections
+    # memoryview the sections are mapped from, or None
+    cdef object _buffer
+
+    def __init__(self, tries=None):
+        self._names = []
+        self._tries = {}
+        self._sections = {}
+        self._buffer = None
+        if tries is None:
+            return
+        items = tries.items() if hasattr(tries, "items") else tries
+        for name, obj in items:
+            if not isinstance(name, unicode):
+                raise TypeError("name must be str, not %s" % type(name).__name__)
+            if name in self._tries:
+                raise ValueError("duplicate TrieBundle section name: %r" % name)
+            _bundle_section_type(obj)
+            self._names.append(name)
+            self._tries[name] = obj
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __contains__(self, name):
+        return name in self._tries or name in self._sections
+
+    def __getitem__(self, name):
+        obj = self._tries.get(name)
+        if obj is None:
+            if name not in self._sections:
+                raise KeyError(name)
+            obj = self._tries.setdefault(name, self._open_section(name))
+        return obj
+
+    def get(self, name, default=None):
+        """Return the trie named ``name``, or ``default`` if there is none."""
+        return self[name] if name in self else default
+
+    def keys(self):
+        """Return a list of section names."""
+        return list(self._names)
+
+    def values(self):
+        """Return a list of tries; all of them are constructed."""
+        return [self[name] for name in self._names]
+
+    def items(self):
+        """Return a list of ``(name, trie)`` pairs; all tries are constructed."""
+        return [(name, self[name]) for name in self._names]
+
+    cdef _open_section(self, name):
+        type_name, fmt, separator, offset, size, _ = self._sections[name]
+        cls = _BUNDLE_TYPES[type_name]
+        if cls is RecordTrie:
+            obj = RecordTrie(fmt, value_separator=separator)
+        elif cls is BytesTrie:
+            obj = BytesTrie(value_separator=separator)
+        else:
+            obj = cls()
+        return obj.map(self._buffer[offset:offset + size])
+
+    def verify(self):
+        """Check the checksums of all sections of a mapped bundle.
+
+        Raise ``ValueError`` for the first section which doesn't match.
+        This reads every section, so it isn't done on load.
+        """
+        for name in self._names:
+            if name not in self._sections:
+                continue
+            _, _, _, offset, size, checksum = self._sections[name]
+            if zlib.crc32(self._buffer[offset:offset + size]) != checksum:
+                raise ValueError("Invalid TrieBundle data: checksum mismatch "
+                                 "in section %r" % name)
+
+    cdef _write(self, f):
+        cdef Py_ssize_t pos = _BUNDLE_HEADER.size
+        cdef list entries = []
+        f.write(_BUNDLE_HEADER.pack(_BUNDLE_MAGIC, _BUNDLE_VERSION, 0))
+        for name in self._names:
+            obj = self[name]
+            type_name, fmt, separator = _bundle_section_type(obj)
+            b_name = (<unicode>name).encode("utf8")
+            if len(b_name) > 0xffff or len(fmt) > 0xffff:
+                raise ValueError("TrieBundle section name or format is too long")
+            data = obj.tobytes()
+            padding = -pos % _BUNDLE_ALIGNMENT
+            f.write(b"\0" * padding)
+            pos += padding
+            f.write(data)
+            entries.append(_BUNDLE_ENTRY.pack(
+                pos, len(data), zlib.crc32(data), len(b_name), len(type_name),
+                len(fmt), len(separator)))
+            entries.append(b_name + type_name + fmt + separator)
+            pos += len(data)
+        index = _U32.pack(len(self._names)) + b"".join(entries)
+        f.write(index)
+        f.write(_BUNDLE_TRAILER.pack(pos, len(index)))
+
+    def save(self, path):
+        """Save a TrieBundle to a specified path or a binary file-like object."""
+        if hasattr(path, "write"):
+            self._write(path)
+            return
+        with open(path, "wb") as f:
+            self._write(f)
+
+    def load(self, path):
+        """Load a TrieBundle from a specified path or a binary file-like
+        object, which is read to the end."""
+        if hasattr(path, "read"):
+            return self.map(path.read())
+        with open(path, "rb") as f:
+            return self.map(f.read())
+
+    def mmap(self, path, populate=False, advice=None, lock=False):
+        """Memory map a TrieBundle stored in a file.
+
+        The file is mapped once, however many sections it has, and each
+        trie is mapped from its section on first access. The options
+        are the same as for :meth:`Trie.mmap`.
+        """
+        return self.map(_mmap_file(path, populate, advice, lock))
+
+    def warmup(self, wait=False):
+        """Read the pages of a mapped TrieBundle, all sections included,
+        in a background thread.
+
+        See :meth:`Trie.warmup`.
+        """
+        return _warmup(self._buffer, wait)
+
+    def resident_fraction(self):
+        """Return the fraction of the pages of a mapped TrieBundle which
+        are resident in memory, or None (see :meth:`Trie.resident_fraction`).
+        """
+        return _resident_fraction(self._buffer)
+
+    def map(self, buffer):
+        """Load a TrieBundle from an object exposing the buffer protocol.
+
+        The index is parsed immediately and tries are mapped from their
+        sections on first access; a reference to ``buffer`` is kept while
+        the TrieBundle is alive.
+        """
+        cdef object view = memoryview(buffer).cast("B")
+        cdef Py_ssize_t header_len = _BUNDLE_HEADER.size
+        cdef Py_ssize_t size = len(view)
+        cdef Py_ssize_t index_offset, index_len, pos, end
+        cdef Py_ssize_t offset, section_len, name_len, type_len, fmt_len, separator_len
+        cdef list names = []
+        cdef dict sections = {}
+
+        if size < header_len + _BUNDLE_TRAILER.size:
+            raise ValueError("Invalid TrieBundle data: truncated header")
+        magic, version, flags = _BUNDLE_HEADER.unpack_from(view)
+        if magic != _BUNDLE_MAGIC:
+            raise ValueError("Invalid TrieBundle data: bad magic")
+        if version != _BUNDLE_VERSION:
+            raise ValueError("Unsupported TrieBundle version: %d" % version)
+        index_offset, index_len = _BUNDLE_TRAILER.unpack_from(view, size - _BUNDLE_TRAILER.size)
+        if (index_offset < header_len or
+                index_offset + index_len != size - _BUNDLE_TRAILER.size or
+                index_len < _U32.size):
+            raise ValueError("Invalid TrieBundle data: invalid index position")
+
+        index = bytes(view[index_offset:index_offset + index_len])
+        pos = _U32.size
+        for _ in range(_U32.unpack_from(index)[0]):
+            if pos + _BUNDLE_ENTRY.size > index_len:
+                raise ValueError("Invalid TrieBundle data: truncated index")
+            (offset, section_len, checksum, name_len, type_len, fmt_len,
+             separator_len) = _BUNDLE_ENTRY.unpack_from(index, pos)
+            pos += _BUNDLE_ENTRY.size
+            end = pos + name_len + type_len + fmt_len + separator_len
+            if end > index_len:
+                raise ValueError("Invalid TrieBundle data: truncated index")
+            if offset < header_len or offset + section_len > index_offset:
+                raise ValueError("Invalid TrieBundle data: invalid section position")
+            name = index[pos:pos + name_len].decode("utf8")
+            pos += name_len
+            type_name = index[pos:pos + type_len].decode("ascii")
+            pos += type_len
+            fmt = index[pos:pos + fmt_len].decode("utf8")
+            pos += fmt_len
+            separator = index[pos:end]
+            pos = end
+            if type_name not in _BUNDLE_TYPES:
+                raise ValueError("Invalid TrieBundle data: unknown section type %r"
+                                 % type_name)
+            if name in sections:
+                raise ValueError("Invalid TrieBundle data: duplicate section %r" % name)
+            names.append(name)
+            sections[name] = (type_name, fmt, separator, offset, section_len, checksum)
+        if pos != index_len:
+            raise ValueError("Invalid TrieBundle data: invalid index length")
+
+        self._names = names
+        self._tries = {}
+        self._sections = sections
+        self._buffer = view
+        return self
+
+
+cdef class TrieHandle:
+    """A reference to the current version of a trie which can be replaced
+    atomically while other threads keep querying it.
+
+    Readers call :meth:`get` once per unit of work and use the returned
+    trie until they are done; :meth:`swap_from` publishes a fully loaded
+    replacement. A reader sees either the old or the new trie as a whole
+    (for a :class:`StringTrie`, its key trie, value trie and ID table
+    always come from the same file), never a partially loaded one.
+
+    The previous trie isn't modified: it stays valid for the readers
+    which still hold it and is freed, together with its memory mapping
+    or buffer, once the last of them drops it.
+    """
+    cdef object _trie
+    cdef object _lock
+
+    def __init__(self, trie):
+        self._trie = trie
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the current trie."""
+        with self._lock:
+            return self._trie
+
+    def swap_from(self, other):
+        """Make ``other`` the current trie and return the previous one.
+
+        ``other`` must be of the same type as the current trie.
+        """
+        with self._lock:
+            if type(other) is not type(self._trie):
+                raise TypeError("expected %s, got %s"
+                                % (type(self._trie).__name__, type(other).__name__))
+            previous, self._trie = self._trie, other
+        return previous
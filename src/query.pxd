@@ -6,15 +6,15 @@ cdef extern from "<marisa/query.h>" namespace "marisa" nogil:
 
         #Query &operator=(Query &query)
 
-        char operator[](int i)
+        char operator[](size_t i)
 
         void set_str(char *str)
-        void set_str(char *ptr, int length)
+        void set_str(char *ptr, size_t length)
         void set_id(int id)
 
         char *ptr()
-        int length()
-        int id()
+        size_t length()
+        size_t id()
 
         void clear()
         void swap(Query &rhs)
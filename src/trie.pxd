@@ -12,7 +12,7 @@ cdef extern from "<marisa/trie.h>" namespace "marisa" nogil:
         void build(keyset.Keyset &keyset) except +
 
         void mmap(char *filename) except +
-        void map(void *ptr, int size) except +
+        void map(void *ptr, size_t size) except +
 
         void load(char *filename) except +
         void read(int fd) except +
@@ -25,17 +25,17 @@ cdef extern from "<marisa/trie.h>" namespace "marisa" nogil:
         bint common_prefix_search(agent.Agent &agent) except +
         bint predictive_search(agent.Agent &agent) except +
 
-        int num_tries() except +
-        int num_keys() except +
-        int num_nodes() except +
+        size_t num_tries() except +
+        size_t num_keys() except +
+        size_t num_nodes() except +
 
         base.TailMode tail_mode()
         base.NodeOrder node_order()
 
         bint empty() except +
-        int size() except +
-        int total_size() except +
-        int io_size() except +
+        size_t size() except +
+        size_t total_size() except +
+        size_t io_size() except +
 
         void clear() except +
         void swap(Trie &rhs) except +
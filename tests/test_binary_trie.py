@@ -1,3 +1,4 @@
+import array
 import pickle
 from collections.abc import Mapping
 from uuid import uuid4
@@ -74,6 +75,124 @@ def test_get(keys):
     assert trie.get(b"non_existing_bytes_key", "default value") == "default value"
 
 
+@given(st.sets(text), st.lists(text))
+def test_key_ids(keys, queries):
+    trie = marisa_trie.BinaryTrie(keys)
+    queries = list(keys) + queries
+
+    ids = trie.key_ids(queries)
+    assert isinstance(ids, array.array)
+    assert list(ids) == [trie.get(key, -1) for key in queries]
+
+    out = array.array("i", [0] * len(queries))
+    assert trie.key_ids(queries, default=-2, out=out) is out
+    assert list(out) == [trie.get(key, -2) for key in queries]
+
+    with pytest.raises(TypeError):
+        trie.key_ids(["foo"])
+
+
+def test_scan():
+    trie = marisa_trie.BinaryTrie([b"ab", b"b", b"abc", b"\xff"])
+    data = b"xabc\xffab"
+    matches = trie.scan(data)
+    assert [data[start:end] for start, end, _ in matches] == [
+        b"ab", b"abc", b"b", b"\xff", b"ab", b"b"
+    ]
+    assert all(trie.restore_key(key_id) == data[start:end] for start, end, key_id in matches)
+    assert [
+        data[start:end] for start, end, _ in trie.scan(data, longest=True, overlapping=False)
+    ] == [b"abc", b"\xff", b"ab"]
+    assert list(trie.iter_scan(data * 50000)) == trie.scan(data * 50000)
+
+
+def test_fuzzy():
+    trie = marisa_trie.BinaryTrie([b"ab", b"abc", b"\xffb", b"b", b"xyz"])
+    assert trie.fuzzy(b"ab") == [
+        (b"ab", trie[b"ab"], 0),
+        (b"abc", trie[b"abc"], 1),
+        (b"b", trie[b"b"], 1),
+        (b"\xffb", trie[b"\xffb"], 1),
+    ]
+    assert trie.fuzzy(b"xy", 0) == []
+
+
+def test_cursor():
+    trie = marisa_trie.BinaryTrie([b"\xff", b"\xff\x00", b"\x00\x01", b"ab"])
+    cursor = trie.cursor()
+    assert len(cursor) == 4
+    assert cursor.push(b"\xff")
+    assert cursor.key_id == trie[b"\xff"]
+    assert cursor.has_children
+    assert sorted(cursor.keys()) == [b"\xff", b"\xff\x00"]
+    assert cursor.push(b"\x00")
+    assert not cursor.has_children
+    assert not cursor.push(b"\x00")
+    assert cursor.pop() == b"\x00"
+    assert cursor.pop() == b"\xff"
+    assert cursor.push(b"\x00\x01")
+    assert cursor.keys() == [b"\x00\x01"]
+
+
+@given(st.sets(st.binary()), st.integers(min_value=1, max_value=5))
+def test_pages_and_batches(keys, limit):
+    trie = marisa_trie.BinaryTrie(keys)
+    pages = [trie.sorted_keys(limit=limit)]
+    while pages[-1]:
+        pages.append(trie.sorted_keys(limit=limit, after=pages[-1][-1]))
+    assert [key for page in pages for key in page] == sorted(keys)
+    assert trie.sorted_items(after=b"\x00") == [(key, trie[key]) for key in sorted(keys) if key > b"\x00"]
+    assert sum(trie.iter_batches(batch_size=limit), []) == trie.keys()
+
+
+@given(st.sets(st.binary()))
+def test_count(keys):
+    trie = marisa_trie.BinaryTrie(keys)
+    for key in keys:
+        for prefix in [key, key[:1], key + b"\xff"]:
+            assert trie.count(prefix) == sum(k.startswith(prefix) for k in keys)
+            assert trie.has_prefix(prefix) == any(k.startswith(prefix) for k in keys)
+    assert trie.count() == len(keys)
+    assert trie.has_prefix() == bool(keys)
+    with pytest.raises(TypeError):
+        trie.count("")
+
+
+@given(
+    st.sets(text),
+    st.one_of(st.none(), text),
+    st.one_of(st.none(), text),
+    st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]),
+)
+def test_range(keys, lo, hi, order):
+    trie = marisa_trie.BinaryTrie(keys, order=order)
+    expected = sorted(
+        key for key in keys
+        if (lo is None or key >= lo) and (hi is None or key < hi)
+    )
+    assert trie.range(lo, hi) == expected
+    assert list(trie.iter_range(lo, hi, limit=3)) == expected[:3]
+
+
+@given(st.sets(st.binary()))
+def test_restore_keys(keys):
+    trie = marisa_trie.BinaryTrie(keys)
+    ids = list(range(len(trie)))
+    expected = [trie.restore_key(key_id) for key_id in ids]
+
+    assert trie.restore_keys(ids) == expected
+    data, offsets = trie.restore_keys(array.array("i", ids), joined=True)
+    assert data == b"".join(expected)
+    assert [data[offsets[i]:offsets[i + 1]] for i in ids] == expected
+
+
+@given(st.lists(st.binary()))
+def test_build_with_ids(keys):
+    trie, ids = marisa_trie.BinaryTrie.build_with_ids(keys)
+    assert isinstance(trie, marisa_trie.BinaryTrie)
+    assert list(ids) == [trie[key] for key in keys]
+
+
 @settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
 @given(st.sets(text))
 def test_saveload(tmp_path, keys):
@@ -248,6 +367,21 @@ def test_has_keys_with_prefix_empty():
     assert not empty_trie.has_keys_with_prefix(b"ab")
 
 
+@given(st.sets(text), st.lists(text))
+def test_prefilter(keys, queries):
+    trie = marisa_trie.BinaryTrie(keys, prefilter=True)
+    plain = marisa_trie.BinaryTrie(keys)
+    assert trie.has_prefilter
+    queries = list(keys) + queries
+    assert [key in trie for key in queries] == [key in plain for key in queries]
+    assert [trie.get(key) for key in queries] == [plain.get(key) for key in queries]
+    assert list(trie.key_ids(queries)) == list(plain.key_ids(queries))
+
+    trie2 = pickle.loads(pickle.dumps(trie))
+    assert trie2.has_prefilter
+    assert [key in trie2 for key in queries] == [key in plain for key in queries]
+
+
 def test_invalid_file():
     try:
         marisa_trie.BinaryTrie().load(__file__)
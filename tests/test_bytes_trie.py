@@ -117,6 +117,35 @@ def test_iterkeys(keys, values):
         assert trie.keys(prefix) == list(trie.iterkeys(prefix))
 
 
+@given(st.lists(st.tuples(text, st.binary())))
+def test_count(data):
+    trie = marisa_trie.BytesTrie(data)
+    keys = {key for key, _ in data}
+    assert trie.count() == len(keys)
+    for key in keys:
+        for prefix in [key, key[:1], key + "x"]:
+            assert trie.count(prefix) == sum(k.startswith(prefix) for k in keys)
+            assert trie.has_prefix(prefix) == any(k.startswith(prefix) for k in keys)
+
+
+def test_count_separator_in_values():
+    trie = marisa_trie.BytesTrie(
+        [("a", b"\xff"), ("a", b""), ("ab", b"\xff\xff"), ("b", b"")]
+    )
+    assert trie.count() == 3
+    assert trie.count("a") == 2
+    assert trie.count("ab") == 1
+    assert not trie.has_prefix("c")
+
+
+def test_prefilter_unsupported():
+    trie = marisa_trie.BytesTrie([("a", b"1")])
+    with pytest.raises(TypeError):
+        trie.build_prefilter()
+    assert not trie.build_prefilter(0).has_prefilter
+    assert "a" in trie
+
+
 @given(st.sets(st.tuples(text, st.binary())))
 def test_dumps_loads(data):
     trie = marisa_trie.BytesTrie(data)
@@ -0,0 +1,260 @@
+import array
+import io
+import pickle
+import struct
+from collections.abc import Mapping
+from uuid import uuid4
+
+import pytest
+import hypothesis.strategies as st
+from hypothesis import assume, given, settings, HealthCheck
+
+import marisa_trie
+
+from .utils import Reader, text
+
+
+int64s = st.integers(min_value=-(2**63), max_value=2**63 - 1)
+float64s = st.floats(allow_nan=False)
+
+
+@given(st.dictionaries(text, int64s), text)
+def test_init(data, missing_key):
+    assume(missing_key not in data)
+
+    trie = marisa_trie.NumericTrie(data.items())
+    assert trie.typecode == "q"
+    assert len(trie) == len(data)
+    for key, value in data.items():
+        assert key in trie
+        assert trie[key] == value
+        assert trie.get(key) == value
+
+    assert missing_key not in trie
+    assert trie.get(missing_key) is None
+    with pytest.raises(KeyError):
+        trie[missing_key]
+
+
+@given(st.dictionaries(text, float64s))
+def test_float_values(data):
+    trie = marisa_trie.NumericTrie(data.items(), typecode="d")
+    assert trie.typecode == "d"
+    assert dict(trie.items()) == data
+
+
+def test_invalid_values():
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie(typecode="i")
+    with pytest.raises(TypeError):
+        marisa_trie.NumericTrie([("foo", 1.5)])
+    with pytest.raises(OverflowError):
+        marisa_trie.NumericTrie([("foo", 2**63)])
+    with pytest.raises(TypeError):
+        marisa_trie.NumericTrie([(b"foo", 1)])
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie([("foo", 1), ("bar", 2), ("foo", 3)])
+
+
+@given(st.dictionaries(text, int64s), st.lists(text))
+def test_get_many(data, queries):
+    trie = marisa_trie.NumericTrie(data.items())
+    queries = list(data) + queries
+
+    values = trie.get_many(queries)
+    assert isinstance(values, array.array)
+    assert values.typecode == "q"
+    assert list(values) == [trie.get(key, 0) for key in queries]
+
+    out = array.array("q", [0] * len(queries))
+    assert trie.get_many(queries, default=-1, out=out) is out
+    assert list(out) == [trie.get(key, -1) for key in queries]
+
+
+def test_get_many_out():
+    trie = marisa_trie.NumericTrie([("foo", 1.5), ("bar", 2.5)], typecode="d")
+    out = array.array("d", [7.0] * 3)
+    assert trie.get_many(["bar", "baz"], default=-1.0, out=out) is out
+    assert list(out) == [2.5, -1.0, 7.0]
+
+    with pytest.raises(ValueError):
+        trie.get_many(["foo", "bar"], out=array.array("d", [0.0]))
+    with pytest.raises(ValueError):
+        trie.get_many(["foo"], out=array.array("q", [0]))
+
+
+@given(st.dictionaries(text, int64s))
+def test_iter(data):
+    trie = marisa_trie.NumericTrie(data.items())
+    assert trie.keys() == list(trie.iterkeys())
+    assert trie.values() == list(trie.itervalues())
+    assert trie.items() == list(trie.iteritems())
+    assert dict(trie.items()) == data
+
+    for key in data:
+        prefix = key[:5]
+        assert trie.keys(prefix) == list(trie.iterkeys(prefix))
+        assert trie.values(prefix) == list(trie.itervalues(prefix))
+        assert trie.items(prefix) == list(trie.iteritems(prefix))
+
+
+@given(
+    st.one_of(
+        st.tuples(st.just("q"), st.dictionaries(text, int64s)),
+        st.tuples(st.just("d"), st.dictionaries(text, float64s)),
+    ),
+    text,
+    st.integers(min_value=0, max_value=20),
+)
+def test_top_k(typed_data, prefix, k):
+    typecode, data = typed_data
+    trie = marisa_trie.NumericTrie(data.items(), typecode=typecode)
+    prefix = prefix[:1]
+    expected = sorted(
+        ((key, value) for key, value in data.items() if key.startswith(prefix)),
+        key=lambda item: (-item[1], item[0].encode("utf8")),
+    )
+    assert trie.top_k(prefix, k) == expected[:k]
+
+
+def test_top_k_ties():
+    trie = marisa_trie.NumericTrie(
+        [("b", 1), ("ab", 2), ("a", 1), ("abc", -1), ("c", 2)]
+    )
+    assert trie.top_k("", 4) == [("ab", 2), ("c", 2), ("a", 1), ("b", 1)]
+    assert trie.top_k("a", 10) == [("ab", 2), ("a", 1), ("abc", -1)]
+    assert trie.top_k("x", 10) == []
+    assert trie.top_k("a", 0) == []
+    with pytest.raises(ValueError):
+        trie.top_k("a", -1)
+
+    # the index is rebuilt for reloaded data
+    trie.frombytes(marisa_trie.NumericTrie([("a", 5), ("b", 7)]).tobytes())
+    assert trie.top_k("", 1) == [("b", 7)]
+
+
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(st.dictionaries(text, int64s))
+def test_saveload(tmp_path, data):
+    trie = marisa_trie.NumericTrie(data.items())
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+
+    trie2 = marisa_trie.NumericTrie().load(path)
+    assert trie2 == trie
+    assert dict(trie2.items()) == data
+
+
+def test_save_load_fileobj():
+    trie = marisa_trie.NumericTrie([("foo", 1), ("bar", 2)])
+    trie2 = marisa_trie.NumericTrie([("ёж", 0.5)], typecode="d")
+    f = io.BytesIO()
+    trie.save(f)
+    trie2.save(f)
+    assert f.getvalue() == trie.tobytes() + trie2.tobytes()
+
+    # only the bytes of each trie are read
+    reader = Reader(f.getvalue())
+    assert marisa_trie.NumericTrie().load(reader).items() == trie.items()
+    assert marisa_trie.NumericTrie().load(reader).items() == trie2.items()
+    assert reader.read(1) == b""
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie().load(Reader(trie.tobytes()[:-1]))
+
+
+def test_load_fileobj_corrupted():
+    trie = marisa_trie.NumericTrie([("foo", 1), ("bar", 2)])
+    # a values length which does not match the key trie is not allocated
+    data = bytearray(trie.tobytes())
+    struct.pack_into("<Q", data, 24, 2**60)
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie().load(Reader(bytes(data)))
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie().load(Reader(trie.tobytes()[:100]))
+
+
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(st.dictionaries(text, float64s))
+def test_mmap(tmp_path, data):
+    trie = marisa_trie.NumericTrie(data.items(), typecode="d")
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+
+    trie2 = marisa_trie.NumericTrie().mmap(path)
+    assert trie2.typecode == "d"
+    assert trie2 == trie
+    assert dict(trie2.items()) == data
+
+
+def test_map_invalid():
+    blob = marisa_trie.NumericTrie([("foo", 1)]).tobytes()
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie().map(blob[:-8])
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie().frombytes(b"not-a-valid-numerictrie")
+    with pytest.raises(ValueError):
+        marisa_trie.NumericTrie().frombytes(
+            marisa_trie.StringTrie([("foo", "bar")]).tobytes()
+        )
+
+
+def test_failed_load_leaves_trie_unchanged():
+    trie = marisa_trie.NumericTrie([("a", 5)])
+    blob = trie.tobytes()
+    # a float trie whose values don't match its keys
+    invalid = marisa_trie.NumericTrie([("a", 2.5)], typecode="d").tobytes()
+    header = struct.Struct("<8sHH4xQQ")
+    magic, version, flags, key_len, values_len = header.unpack_from(invalid)
+    invalid = header.pack(magic, version, flags, key_len, values_len + 8) + \
+        invalid[header.size:] + b"\0" * 8
+
+    for load in [trie.frombytes, trie.map]:
+        with pytest.raises(ValueError):
+            load(invalid)
+        assert trie.typecode == "q"
+        assert trie["a"] == 5
+        assert list(trie.get_many(["a"])) == [5]
+        assert trie.tobytes() == blob
+
+
+@given(st.dictionaries(text, int64s))
+def test_dumps_loads(data):
+    trie = marisa_trie.NumericTrie(data.items())
+    trie2 = pickle.loads(pickle.dumps(trie))
+    assert trie2 == trie
+    assert dict(trie2.items()) == data
+
+
+@given(st.dictionaries(text, int64s))
+def test_pickle_out_of_band(data):
+    trie = marisa_trie.NumericTrie(data.items())
+    buffers = []
+    trie2 = pickle.loads(
+        pickle.dumps(trie, protocol=5, buffer_callback=buffers.append), buffers=buffers
+    )
+    assert len(buffers) == 1
+    assert trie2 == trie
+    assert trie2.items() == trie.items()
+
+
+def test_shared_memory():
+    trie = marisa_trie.NumericTrie([("foo", 1.5), ("bar", 2.5)], typecode="d").to_shared_memory()
+    try:
+        trie2 = pickle.loads(pickle.dumps(trie))
+        assert trie2.shared_memory.name == trie.shared_memory.name
+        assert trie2 == trie
+        assert trie2.items() == trie.items()
+
+        shm = trie2.shared_memory
+        trie2.close()
+        assert len(trie2) == 0 and trie2.shared_memory is None
+        assert shm.buf is None
+    finally:
+        trie.shared_memory.unlink()
+
+
+def test_mapping():
+    for method in Mapping.__abstractmethods__:
+        assert hasattr(marisa_trie.NumericTrie, method)
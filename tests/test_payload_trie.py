@@ -0,0 +1,191 @@
+import io
+import pickle
+import struct
+from collections.abc import Mapping
+from uuid import uuid4
+
+import pytest
+import hypothesis.strategies as st
+from hypothesis import assume, given, settings, HealthCheck
+
+import marisa_trie
+
+from .utils import Reader, text
+
+
+pairs = st.lists(st.tuples(text, st.binary()))
+
+
+def _as_dict(data):
+    res = {}
+    for key, payload in data:
+        res.setdefault(key, []).append(payload)
+    return res
+
+
+@given(pairs, text)
+def test_init(data, missing_key):
+    expected = _as_dict(data)
+    assume(missing_key not in expected)
+
+    trie = marisa_trie.PayloadTrie(data)
+    assert len(trie) == len(expected)
+    for key, payloads in expected.items():
+        assert key in trie
+        assert trie[key] == payloads
+        assert trie.get(key) == payloads
+
+    assert missing_key not in trie
+    assert trie.get(missing_key) is None
+    with pytest.raises(KeyError):
+        trie[missing_key]
+
+
+def test_payload_order():
+    trie = marisa_trie.PayloadTrie(
+        [("foo", b"2"), ("bar", b""), ("foo", b"1"), ("foo", b"2")]
+    )
+    assert trie["foo"] == [b"2", b"1", b"2"]
+    assert trie["bar"] == [b""]
+
+
+def test_invalid_pairs():
+    with pytest.raises(TypeError):
+        marisa_trie.PayloadTrie([(b"foo", b"bar")])
+    with pytest.raises(TypeError):
+        marisa_trie.PayloadTrie([("foo", "bar")])
+    with pytest.raises(TypeError):
+        marisa_trie.PayloadTrie(["foo"])
+
+
+@given(pairs)
+def test_iter(data):
+    trie = marisa_trie.PayloadTrie(data)
+    assert trie.keys() == list(trie.iterkeys())
+    assert trie.items() == list(trie.iteritems())
+    assert trie.items() == [(key, payload) for key in trie.keys() for payload in trie[key]]
+
+    for key, _ in data:
+        prefix = key[:5]
+        assert trie.keys(prefix) == list(trie.iterkeys(prefix))
+        assert trie.items(prefix) == list(trie.iteritems(prefix))
+
+
+def test_prefixes():
+    trie = marisa_trie.PayloadTrie([("foo", b"x"), ("f", b"y"), ("foobar", b"z")])
+    assert trie.prefixes("foobarz") == ["f", "foo", "foobar"]
+    assert list(trie.iter_prefixes("fo")) == ["f"]
+
+
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(pairs)
+def test_saveload(tmp_path, data):
+    trie = marisa_trie.PayloadTrie(data)
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+
+    trie2 = marisa_trie.PayloadTrie().load(path)
+    assert trie2 == trie
+    assert trie2.items() == trie.items()
+
+
+def test_save_load_fileobj():
+    trie = marisa_trie.PayloadTrie([("foo", b"bar"), ("foo", b"baz")])
+    trie2 = marisa_trie.PayloadTrie([("ёж", b"\x00")])
+    f = io.BytesIO()
+    trie.save(f)
+    trie2.save(f)
+    assert f.getvalue() == trie.tobytes() + trie2.tobytes()
+
+    # only the bytes of each trie are read
+    reader = Reader(f.getvalue())
+    assert marisa_trie.PayloadTrie().load(reader).items() == trie.items()
+    assert marisa_trie.PayloadTrie().load(reader).items() == trie2.items()
+    assert reader.read(1) == b""
+    with pytest.raises(ValueError):
+        marisa_trie.PayloadTrie().load(Reader(b"not-a-payload-trie"))
+
+
+@pytest.mark.parametrize("offset", [32, 40])
+def test_load_fileobj_corrupted(offset):
+    trie = marisa_trie.PayloadTrie([("foo", b"bar"), ("foo", b"baz")])
+    # a table length which does not match the offsets before it is not allocated
+    data = bytearray(trie.tobytes())
+    struct.pack_into("<Q", data, offset, 2**60)
+    with pytest.raises(ValueError):
+        marisa_trie.PayloadTrie().load(Reader(bytes(data)))
+    with pytest.raises(ValueError):
+        marisa_trie.PayloadTrie().load(Reader(trie.tobytes()[:100]))
+
+
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(pairs)
+def test_mmap(tmp_path, data):
+    trie = marisa_trie.PayloadTrie(data)
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+
+    trie2 = marisa_trie.PayloadTrie().mmap(path)
+    assert trie2 == trie
+    assert trie2.items() == trie.items()
+
+
+def test_map_invalid():
+    blob = marisa_trie.PayloadTrie([("foo", b"bar")]).tobytes()
+    with pytest.raises(ValueError):
+        marisa_trie.PayloadTrie().map(blob[:-1])
+    with pytest.raises(ValueError):
+        marisa_trie.PayloadTrie().frombytes(b"not-a-valid-payloadtrie")
+
+
+def test_map_corrupted_offsets():
+    blob = bytearray(marisa_trie.PayloadTrie([("foo", b"bar")]).tobytes())
+    # the last payload offset is followed by the 3-byte payload blob
+    blob[-11:-3] = b"\xff" * 8
+    trie = marisa_trie.PayloadTrie().map(blob)
+    assert "foo" in trie
+    with pytest.raises(ValueError):
+        trie["foo"]
+
+
+@given(pairs)
+def test_dumps_loads(data):
+    trie = marisa_trie.PayloadTrie(data)
+    trie2 = pickle.loads(pickle.dumps(trie))
+    assert trie2 == trie
+    assert trie2.items() == trie.items()
+
+
+@given(pairs)
+def test_pickle_out_of_band(data):
+    trie = marisa_trie.PayloadTrie(data)
+    buffers = []
+    trie2 = pickle.loads(
+        pickle.dumps(trie, protocol=5, buffer_callback=buffers.append), buffers=buffers
+    )
+    assert len(buffers) == 1
+    assert trie2 == trie
+    assert trie2.items() == trie.items()
+
+
+def test_shared_memory():
+    trie = marisa_trie.PayloadTrie([("foo", b"x"), ("foo", b"y")]).to_shared_memory()
+    try:
+        trie2 = pickle.loads(pickle.dumps(trie))
+        assert trie2.shared_memory.name == trie.shared_memory.name
+        assert trie2 == trie
+        assert trie2.items() == trie.items()
+
+        shm = trie2.shared_memory
+        trie2.close()
+        assert len(trie2) == 0 and trie2.shared_memory is None
+        assert shm.buf is None
+    finally:
+        trie.shared_memory.unlink()
+
+
+def test_mapping():
+    for method in Mapping.__abstractmethods__:
+        assert hasattr(marisa_trie.PayloadTrie, method)
@@ -1,6 +1,8 @@
 import io
 import pickle
+import struct
 
+import pytest
 import hypothesis.strategies as st
 from hypothesis import given
 
@@ -18,3 +20,78 @@ def test_dumps_loads(data):
     buf.seek(0)
 
     assert trie == pickle.load(buf)
+
+
+@given(st.sets(st.tuples(text, records)))
+def test_pickle_out_of_band(data):
+    trie = marisa_trie.RecordTrie("<H?", data)
+    buffers = []
+    data = pickle.dumps(trie, protocol=5, buffer_callback=buffers.append)
+    assert pickle.loads(data, buffers=buffers) == trie
+
+
+def test_shared_memory():
+    trie = marisa_trie.RecordTrie("<H?", [("foo", (1, True))]).to_shared_memory()
+    try:
+        assert pickle.loads(pickle.dumps(trie)) == trie
+    finally:
+        trie.shared_memory.unlink()
+
+
+@given(st.sets(st.tuples(text, records)))
+def test_count(data):
+    trie = marisa_trie.RecordTrie("<H?", data)
+    keys = {key for key, _ in data}
+    assert trie.count() == len(keys)
+    for key in keys:
+        assert trie.count(key[:1]) == sum(k.startswith(key[:1]) for k in keys)
+
+
+@given(st.sets(st.tuples(text, records)), text)
+def test_items_array(data, prefix):
+    numpy = pytest.importorskip("numpy")
+    trie = marisa_trie.RecordTrie("<H?", data)
+
+    keys, values = trie.items_array(prefix)
+    assert isinstance(values, numpy.ndarray)
+    assert values.dtype.names == ("f0", "f1")
+    assert list(zip(keys, values.tolist())) == trie.items(prefix)
+
+
+@given(st.sets(st.tuples(text, records)), st.lists(text))
+def test_get_many_array(data, queries):
+    pytest.importorskip("numpy")
+    trie = marisa_trie.RecordTrie("<H?", data)
+    queries = [key for key, _ in data] + queries
+
+    values, key_index = trie.get_many_array(queries)
+    assert len(values) == len(key_index)
+    assert [(queries[i], value) for i, value in zip(key_index, values.tolist())] == [
+        (key, value) for key in queries for value in trie.get(key, [])
+    ]
+
+
+@pytest.mark.parametrize(
+    "fmt, value",
+    [
+        ("@bxid", (-1, 2, 1.5)),
+        (">3sQ", (b"abc", 2**64 - 1)),
+        ("=hHfe", (-1, 2, 1.5, 0.5)),
+        ("c2i", (b"z", 1, -2)),
+        ("4?", (True, False, True, True)),
+    ],
+)
+def test_array_dtype(fmt, value):
+    numpy = pytest.importorskip("numpy")
+    trie = marisa_trie.RecordTrie(fmt, [("foo", value), ("bar", value)])
+
+    keys, values = trie.items_array()
+    assert keys == ["bar", "foo"]
+    assert values.dtype.itemsize == struct.calcsize(fmt)
+    assert values.tolist() == [value, value]
+    assert values.tobytes() == struct.pack(fmt, *value) * 2
+
+    values, key_index = trie.get_many_array(["foo", "baz"])
+    assert values.tolist() == [value]
+    assert key_index.dtype == numpy.int32
+    assert key_index.tolist() == [0]
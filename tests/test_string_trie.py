@@ -1,5 +1,9 @@
+import gc
 import io
 import pickle
+import struct
+import sys
+import warnings
 from collections.abc import Mapping
 from uuid import uuid4
 
@@ -9,7 +13,7 @@ from hypothesis import assume, given, settings, HealthCheck
 
 import marisa_trie
 
-from .utils import text
+from .utils import Reader, text
 
 
 @given(st.dictionaries(text, text), text)
@@ -74,6 +78,28 @@ def test_prefix_items():
     assert trie.prefix_items("b") == []
 
 
+def test_fuzzy():
+    trie = marisa_trie.StringTrie(
+        [("colour", "British"), ("color", "American"), ("cooler", "fridge")]
+    )
+    assert trie.fuzzy("color") == [("color", "American", 0), ("colour", "British", 1)]
+    assert trie.fuzzy("colr", 2) == [
+        ("color", "American", 1),
+        ("colour", "British", 2),
+        ("cooler", "fridge", 2),
+    ]
+
+
+def test_count():
+    trie = marisa_trie.StringTrie([("foo", "x"), ("foobar", "y"), ("bar", "x")])
+    assert trie.count() == 3
+    assert trie.count("foo") == 2
+    assert trie.count("baz") == 0
+    assert trie.has_prefix("ba")
+    assert not trie.has_prefix("x")
+    assert trie.has_prefix()
+
+
 @given(st.dictionaries(text, text))
 def test_iter(data):
     trie = marisa_trie.StringTrie(data.items())
@@ -94,6 +120,30 @@ def test_items_roundtrip(data):
     assert dict(trie.items()) == data
 
 
+@given(st.dictionaries(text, text))
+def test_items_match_lookups(data):
+    trie = marisa_trie.StringTrie(data.items())
+    items = trie.items()
+    assert [key for key, _ in items] == trie.keys()
+    assert [value for _, value in items] == trie.values()
+    assert all(trie[key] == value for key, value in items)
+
+
+def test_map_corrupted_id_map():
+    blob = bytearray(marisa_trie.StringTrie([("foo", "bar")]).tobytes())
+    blob[-4:] = b"\xff\xff\xff\xff"
+    trie = marisa_trie.StringTrie().map(blob)
+    assert "foo" in trie
+    with pytest.raises(ValueError):
+        trie["foo"]
+    with pytest.raises(ValueError):
+        trie.items()
+    with pytest.raises(ValueError):
+        list(trie.iteritems())
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().frombytes(bytes(blob))
+
+
 def test_accessors():
     trie = marisa_trie.StringTrie([("foo", "x"), ("bar", "y")])
     assert isinstance(trie.key_trie, marisa_trie.Trie)
@@ -115,6 +165,115 @@ def test_saveload(tmp_path, data):
     assert dict(trie2.items()) == data
 
 
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(st.dictionaries(text, text))
+def test_mmap(tmp_path, data):
+    trie = marisa_trie.StringTrie(data.items())
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+
+    trie2 = marisa_trie.StringTrie().mmap(path)
+    assert trie2 == trie
+    assert dict(trie2.items()) == data
+    assert trie2.tobytes() == trie.tobytes()
+
+
+def test_mmap_warmup(tmp_path):
+    trie = marisa_trie.StringTrie([("nyc", "new york"), ("la", "los angeles")])
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+
+    trie2 = marisa_trie.StringTrie().mmap(path, advice="random")
+    assert not trie2.warmup(wait=True).is_alive()
+    assert trie2.resident_fraction() in (None, 1.0)
+    assert trie2 == trie
+    assert marisa_trie.StringTrie().resident_fraction() is None
+
+
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(st.dictionaries(text, text), st.lists(text))
+def test_prefilter(tmp_path, data, queries):
+    trie = marisa_trie.StringTrie(data.items(), prefilter=True)
+    assert trie.has_prefilter
+    assert not trie.value_trie.has_prefilter
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+    trie2 = marisa_trie.StringTrie().mmap(path)
+    assert trie2.has_prefilter
+    assert trie2 == trie
+
+    queries = list(data) + queries
+    for key in queries:
+        assert (key in trie2) == (key in data)
+        assert trie2.get(key) == data.get(key)
+
+    builder = marisa_trie.StringTrieBuilder(prefilter=True)
+    for key, value in data.items():
+        builder.add(key, value)
+    assert builder.build().has_prefilter
+
+
+@given(st.dictionaries(text, text))
+def test_map(data):
+    trie = marisa_trie.StringTrie(data.items())
+    blob = trie.tobytes()
+
+    trie2 = marisa_trie.StringTrie().map(blob)
+    assert trie2 == trie
+
+    buf = bytearray(b"pad" + blob + b"pad")
+    trie3 = marisa_trie.StringTrie().map(memoryview(buf)[3:-3])
+    assert trie3 == trie
+    assert dict(trie3.items()) == data
+
+
+def test_map_invalid():
+    blob = marisa_trie.StringTrie([("foo", "bar")]).tobytes()
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().map(blob[:-4])
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().map(b"not-a-valid-stringtrie")
+
+
+def test_read_version_1():
+    trie = marisa_trie.StringTrie([("foo", "bar"), ("baz", "qux")])
+    blob = trie.tobytes()
+    magic, version, flags, key_len, value_len, id_map_len = struct.unpack_from(
+        "<8sHH4xQQQ", blob
+    )
+    assert version == 2
+    blob_v1 = struct.pack("<8sHHIII", magic, 1, flags, key_len, value_len, id_map_len)
+    blob_v1 += blob[40:]
+    assert marisa_trie.StringTrie().frombytes(blob_v1) == trie
+    assert marisa_trie.StringTrie().map(blob_v1).items() == trie.items()
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().frombytes(blob_v1[:20])
+
+
+@pytest.mark.skipif(sys.maxsize < 2**32, reason="needs a 64-bit platform")
+def test_mmap_section_over_4gb(tmp_path):
+    # The key trie section is padded with a sparse 4 GB hole; libmarisa
+    # ignores data after the trie, so only the 64-bit sizes are exercised.
+    trie = marisa_trie.StringTrie([("foo", "bar"), ("baz", "qux")])
+    blob = trie.tobytes()
+    header = struct.Struct("<8sHH4xQQQ")
+    magic, version, flags, key_len, value_len, id_map_len = header.unpack_from(blob)
+    padding = 2**32
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    with open(path, "wb") as f:
+        f.write(header.pack(magic, version, flags, key_len + padding, value_len, id_map_len))
+        f.write(blob[header.size:header.size + key_len])
+        f.seek(padding, io.SEEK_CUR)
+        f.write(blob[header.size + key_len:])
+
+    trie2 = marisa_trie.StringTrie().mmap(path)
+    assert trie2.items() == trie.items()
+    assert trie2["baz"] == "qux"
+
+
 @given(st.dictionaries(text, text))
 def test_tobytes_frombytes(data):
     trie = marisa_trie.StringTrie(data.items())
@@ -138,6 +297,71 @@ def test_dumps_loads(data):
     assert dict(trie2.items()) == data
 
 
+@given(st.dictionaries(text, text))
+def test_pickle_out_of_band(data):
+    trie = marisa_trie.StringTrie(data.items())
+    buffers = []
+    trie2 = pickle.loads(
+        pickle.dumps(trie, protocol=5, buffer_callback=buffers.append), buffers=buffers
+    )
+    assert len(buffers) == 1
+    assert trie2 == trie
+    assert trie2.items() == trie.items()
+
+
+def test_shared_memory():
+    trie = marisa_trie.StringTrie([("foo", "bar"), ("baz", "bar")]).to_shared_memory()
+    try:
+        trie2 = pickle.loads(pickle.dumps(trie))
+        assert trie2.shared_memory.name == trie.shared_memory.name
+        assert trie2 == trie
+        assert trie2.items() == trie.items()
+
+        shm = trie2.shared_memory
+        trie2.close()
+        assert len(trie2) == 0 and trie2.shared_memory is None
+        assert shm.buf is None
+    finally:
+        trie.shared_memory.unlink()
+
+
+def test_save_load_fileobj():
+    trie = marisa_trie.StringTrie([("foo", "bar"), ("baz", "bar")])
+    trie2 = marisa_trie.StringTrie([("ёж", "ёжик")], prefilter=True)
+    f = io.BytesIO()
+    trie.save(f)
+    trie2.save(f)
+    assert f.getvalue() == trie.tobytes() + trie2.tobytes()
+
+    # only the bytes of each trie are read
+    reader = Reader(f.getvalue())
+    assert marisa_trie.StringTrie().load(reader) == trie
+    assert marisa_trie.StringTrie().load(reader).items() == trie2.items()
+    assert reader.read(1) == b""
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().load(Reader(trie.tobytes()[:-1]))
+
+
+def test_load_fileobj_corrupted():
+    trie = marisa_trie.StringTrie([("foo", "bar"), ("baz", "bar")])
+    # a table length which does not match the key trie is not allocated
+    data = bytearray(trie.tobytes())
+    struct.pack_into("<Q", data, 32, 2**60)
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().load(Reader(bytes(data)))
+    with pytest.raises(ValueError):
+        marisa_trie.StringTrie().load(Reader(trie.tobytes()[:100]))
+
+
+def test_failed_load_leaves_trie_unchanged():
+    trie = marisa_trie.StringTrie([("foo", "bar")])
+    blob = bytearray(marisa_trie.StringTrie([("baz", "qux")]).tobytes())
+    blob[-4:] = b"\xff" * 4  # value id out of range
+    with pytest.raises(ValueError):
+        trie.frombytes(bytes(blob))
+    assert trie.items() == [("foo", "bar")]
+
+
 def test_mapping():
     for method in Mapping.__abstractmethods__:
         assert hasattr(marisa_trie.StringTrie, method)
@@ -147,3 +371,61 @@ def test_frombytes_invalid_magic():
     trie = marisa_trie.StringTrie()
     with pytest.raises(ValueError):
         trie.frombytes(b"not-a-valid-stringtrie")
+
+
+@given(st.dictionaries(text, text), st.integers(min_value=1, max_value=2000))
+def test_builder(data, memory_limit):
+    builder = marisa_trie.StringTrieBuilder(memory_limit=memory_limit)
+    builder.update(data.items())
+    trie = builder.build()
+    assert trie == marisa_trie.StringTrie(data.items())
+    assert dict(trie.items()) == data
+
+    stats = builder.stats
+    assert stats["records"] == stats["keys"] == len(data)
+    assert stats["values"] == len(set(data.values()))
+
+
+def test_builder_progress():
+    calls = []
+    builder = marisa_trie.StringTrieBuilder(
+        progress=lambda stage, count: calls.append((stage, count)), progress_every=2
+    )
+    builder.update([("a", "x"), ("b", "x"), ("c", "y"), ("d", "y")])
+    builder.build()
+    assert calls == [
+        ("add", 2), ("add", 4), ("keys", 2), ("keys", 4), ("values", 2)
+    ]
+
+
+def test_builder_duplicate_keys_disallowed():
+    builder = marisa_trie.StringTrieBuilder(memory_limit=1)
+    builder.update([("foo", "x"), ("bar", "y"), ("foo", "z")])
+    with pytest.raises(ValueError):
+        builder.build()
+
+
+def test_builder_type_checks():
+    builder = marisa_trie.StringTrieBuilder()
+    with pytest.raises(TypeError):
+        builder.add(b"foo", "bar")
+    with pytest.raises(TypeError):
+        builder.add("foo", b"bar")
+    with pytest.raises(TypeError):
+        builder.update(["foo"])
+
+
+def test_builder_closes_runs_on_collection():
+    # the progress callback puts the builder in a reference cycle, so it is
+    # freed by the cyclic GC, which clears its attributes before deallocation
+    holder = []
+    builder = marisa_trie.StringTrieBuilder(
+        memory_limit=1, progress=lambda stage, count, holder=holder: None
+    )
+    holder.append(builder)
+    builder.update([("foo", "x"), ("bar", "y")])
+    del builder, holder
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", ResourceWarning)
+        gc.collect()
+    assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
@@ -5,6 +5,7 @@ which tests that different objects can be created and consumed in parallel threa
 from __future__ import annotations
 
 import pickle
+import threading
 from functools import partial
 from uuid import uuid4
 
@@ -110,6 +111,22 @@ def test_get_same_key(cls, data_st, data):
     run_threaded(f)
 
 
+@parametrize(8, 8)
+@given(st.data())
+def test_prefixes(cls, data_st, data):
+    """Different threads call prefixes and iter_prefixes on the same object"""
+    trie, as_dict = make_trie(cls, data_st, data)
+    expected = {key: trie.prefixes(key) for key in as_dict}
+
+    def f(i):
+        key = list(as_dict)[i]
+        assert trie.prefixes(key) == expected[key]
+        if hasattr(trie, "iter_prefixes"):
+            assert list(trie.iter_prefixes(key)) == expected[key]
+
+    run_threaded(f, pass_count=True, max_workers=8)
+
+
 @parametrize()
 @given(st.data())
 def test_iter(cls, data_st, data):
@@ -179,3 +196,43 @@ def test_dumps_loads(cls, data_st, data):
         assert dict(trie2) == as_dict
 
     run_threaded(f)
+
+
+@pytest.mark.parametrize("cls", [marisa_trie.Trie, marisa_trie.StringTrie])
+def test_handle_swap(tmp_path, cls):
+    """Threads query a TrieHandle while another thread swaps in mmapped versions"""
+    paths = []
+    for version in range(4):
+        if cls is marisa_trie.StringTrie:
+            trie = cls((f"key{i}", f"v{version}") for i in range(100 + version))
+        else:
+            trie = cls(f"v{version}:{i}" for i in range(100 + version))
+        paths.append(str(tmp_path / f"{uuid4()}.bin"))
+        trie.save(paths[-1])
+
+    handle = marisa_trie.TrieHandle(cls().mmap(paths[0]))
+    done = threading.Event()
+
+    def check(trie):
+        if cls is marisa_trie.StringTrie:
+            versions = set(trie.values())
+            assert trie.get(f"key{len(trie) - 1}") in versions
+        else:
+            versions = {key.split(":")[0] for key in trie}
+        # every snapshot is a complete single version
+        assert len(versions) == 1
+        assert len(trie) == 100 + int(versions.pop()[1:])
+
+    def f(i):
+        if i == 0:
+            try:
+                for n in range(200):
+                    handle.swap_from(cls().mmap(paths[n % len(paths)]))
+            finally:
+                done.set()
+        else:
+            while not done.is_set():
+                check(handle.get())
+
+    run_threaded(f, pass_count=True, max_workers=8)
+    check(handle.get())
@@ -1,4 +1,11 @@
+import array
+import gc
+import io
+import mmap
+import os
 import pickle
+import random
+import sys
 from collections.abc import Mapping
 from uuid import uuid4
 
@@ -8,7 +15,7 @@ from hypothesis import given, assume, settings, HealthCheck
 
 import marisa_trie
 
-from .utils import text
+from .utils import Reader, text
 
 
 @given(st.sets(text), text)
@@ -79,6 +86,343 @@ def test_get(keys):
     assert trie.get(b"non_existing_bytes_key", "default value") == "default value"
 
 
+@given(st.sets(text), st.lists(text))
+def test_key_ids(keys, queries):
+    trie = marisa_trie.Trie(keys)
+    queries = list(keys) + queries
+
+    ids = trie.key_ids(queries)
+    assert isinstance(ids, array.array)
+    assert list(ids) == [trie.get(key, -1) for key in queries]
+    assert list(trie.key_ids(iter(queries), default=-2)) == [
+        trie.get(key, -2) for key in queries
+    ]
+
+
+def test_key_ids_out():
+    trie = marisa_trie.Trie(["foo", "bar"])
+    out = array.array("i", [7] * 4)
+    assert trie.key_ids(["bar", "baz", b"foo"], out=out) is out
+    assert list(out) == [trie["bar"], -1, trie["foo"], 7]
+
+    with pytest.raises(ValueError):
+        trie.key_ids(["foo", "bar"], out=array.array("i", [0]))
+
+    with pytest.raises(TypeError):
+        trie.key_ids([1])
+
+
+def _naive_scan(trie, text, longest, overlapping):
+    res = []
+    start = 0
+    while start < len(text):
+        matches = [
+            (start, start + len(key), trie[key])
+            for key in trie.prefixes(text[start:])
+            if key
+        ]
+        if longest:
+            matches = matches[-1:]
+        elif not overlapping:
+            matches = matches[:1]
+        res.extend(matches)
+        start = matches[-1][1] if matches and not overlapping else start + 1
+    return res
+
+
+@given(st.sets(text), text, st.booleans(), st.booleans())
+def test_scan(keys, text, longest, overlapping):
+    trie = marisa_trie.Trie(keys)
+    text = "ф".join(list(keys)[:3]) + text
+    expected = _naive_scan(trie, text, longest, overlapping)
+    assert trie.scan(text, longest=longest, overlapping=overlapping) == expected
+    assert list(trie.iter_scan(text, longest=longest, overlapping=overlapping)) == expected
+
+
+@pytest.mark.parametrize("longest", [False, True])
+@pytest.mark.parametrize("overlapping", [False, True])
+def test_iter_scan_chunks(longest, overlapping):
+    # matches cross the boundaries of the chunks iter_scan searches
+    trie = marisa_trie.Trie(["ёжик", "жик в", "в тумане", "а"])
+    text = "ёжик в тумане, " * 10000
+    matches = trie.iter_scan(text, longest=longest, overlapping=overlapping)
+    assert next(matches) == trie.scan(text, longest=longest, overlapping=overlapping)[0]
+    assert list(trie.iter_scan(text, longest, overlapping)) == trie.scan(
+        text, longest, overlapping
+    )
+
+
+def _levenshtein(a, b):
+    row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        prev, row[0] = row[0], i
+        for j, cb in enumerate(b, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ca != cb))
+    return row[-1]
+
+
+@given(
+    st.sets(text),
+    text,
+    st.integers(min_value=0, max_value=2),
+    st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]),
+)
+def test_fuzzy(keys, query, max_distance, order):
+    trie = marisa_trie.Trie(keys, order=order)
+    keys = keys | {query[:-1], query[1:]}
+    expected = sorted(
+        (
+            (key, trie[key], _levenshtein(query, key))
+            for key in keys
+            if key in trie and _levenshtein(query, key) <= max_distance
+        ),
+        key=lambda match: (match[2], match[0].encode("utf8")),
+    )
+    assert trie.fuzzy(query, max_distance) == expected
+
+
+def test_fuzzy_unicode():
+    trie = marisa_trie.Trie(["ёжик", "ежик", "ёж", "ёжики", ""])
+    assert [key for key, _, _ in trie.fuzzy("ёжик")] == ["ёжик", "ежик", "ёжики"]
+    assert trie.fuzzy("ё") == [("", trie[""], 1), ("ёж", trie["ёж"], 1)]
+    assert [key for key, _, _ in trie.fuzzy("ёжик", 0)] == ["ёжик"]
+
+    with pytest.raises(ValueError):
+        trie.fuzzy("ёжик", -1)
+
+
+@given(
+    st.sets(text),
+    st.lists(st.one_of(text, st.none())),
+    st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]),
+)
+def test_cursor(keys, steps, order):
+    trie = marisa_trie.Trie(keys, order=order)
+    cursor = trie.cursor()
+    parts = []
+    for part in steps:
+        if part is None:
+            if parts:
+                assert cursor.pop() == parts.pop()
+            else:
+                with pytest.raises(IndexError):
+                    cursor.pop()
+        else:
+            prefix = "".join(parts) + part[:2]
+            found = cursor.push(part[:2])
+            assert found == any(key.startswith(prefix) for key in keys)
+            if found:
+                parts.append(part[:2])
+
+        prefix = "".join(parts)
+        assert cursor.prefix == prefix
+        assert cursor.keys() == trie.keys(prefix)
+        assert list(cursor.iter_keys(limit=2)) == trie.keys(prefix)[:2]
+        assert len(cursor) == len(trie.keys(prefix))
+        assert cursor.is_key == (prefix in keys)
+        assert cursor.has_children == any(
+            len(key) > len(prefix) for key in trie.keys(prefix)
+        )
+
+
+def test_cursor_key_id():
+    trie = marisa_trie.Trie(["foo", "foobar", "fob", "ёж"])
+    cursor = trie.cursor()
+    with pytest.raises(KeyError):
+        cursor.key_id
+    assert cursor.push("fo")
+    assert not cursor.is_key
+    assert cursor.push("o")
+    assert cursor.key_id == trie["foo"]
+    assert not cursor.push("d")
+    assert cursor.prefix == "foo"
+    assert cursor.pop() == "o"
+    assert cursor.push("b")
+    assert cursor.key_id == trie["fob"]
+    assert not cursor.has_children
+
+    with pytest.raises(TypeError):
+        cursor.push(1)
+    with pytest.raises(TypeError):
+        marisa_trie.TrieCursor(marisa_trie.BytesTrie())
+
+    # the cursor follows a reloaded trie
+    trie.frombytes(marisa_trie.Trie(["fob", "fobs"]).tobytes())
+    assert cursor.prefix == "fob"
+    assert cursor.has_children
+    assert len(cursor) == 2
+    assert cursor.pop() == "b"
+    assert len(cursor) == 2
+
+    # pushed prefixes missing from a reloaded trie match no keys
+    assert cursor.push("b")
+    trie.frombytes(marisa_trie.Trie(["foo"]).tobytes())
+    assert cursor.prefix == "fob"
+    assert len(cursor) == 0 and cursor.keys() == []
+    assert not cursor.is_key and not cursor.push("s")
+    assert cursor.pop() == "b"
+    assert len(cursor) == 1
+    assert cursor.push("o") and cursor.key_id == trie["foo"]
+
+
+@given(
+    st.sets(text),
+    text,
+    st.integers(min_value=1, max_value=5),
+    st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]),
+)
+def test_sorted_keys_pages(keys, prefix, limit, order):
+    trie = marisa_trie.Trie(keys, order=order)
+    prefix = prefix[:1]
+    expected = sorted(trie.keys(prefix), key=lambda key: key.encode("utf8"))
+
+    pages = [trie.sorted_keys(prefix, limit=limit)]
+    while pages[-1]:
+        pages.append(trie.sorted_keys(prefix, limit=limit, after=pages[-1][-1]))
+    assert all(len(page) <= limit for page in pages)
+    assert [key for page in pages for key in page] == expected
+    assert trie.sorted_keys(prefix) == expected
+    assert trie.sorted_keys(prefix, after="") == [key for key in expected if key]
+    assert trie.sorted_items(prefix, limit=limit) == [
+        (key, trie[key]) for key in expected[:limit]
+    ]
+    # keys() and iter_batches() keep the node order
+    assert sum(trie.iter_batches(prefix, batch_size=limit), []) == trie.keys(prefix)
+
+
+def test_sorted_keys_after_missing_key():
+    trie = marisa_trie.Trie(["a", "ab", "b", "ba", "c"])
+    assert trie.sorted_keys(after="aa") == ["ab", "b", "ba", "c"]
+    assert trie.sorted_keys("b", after="a", limit=1) == ["b"]
+    assert trie.sorted_keys("b", after="bz") == []
+    assert trie.sorted_keys("x", limit=10) == []
+    assert trie.sorted_keys(limit=0) == []
+    with pytest.raises(ValueError):
+        trie.sorted_keys(limit=-1)
+
+
+@given(st.sets(text), st.integers(min_value=1, max_value=10))
+def test_iter_batches(keys, batch_size):
+    trie = marisa_trie.Trie(keys)
+    batches = list(trie.iter_batches(batch_size=batch_size))
+    assert all(0 < len(batch) <= batch_size for batch in batches)
+    assert [key for batch in batches for key in batch] == trie.keys()
+
+    for key in keys:
+        prefix = key[:2]
+        assert sum(trie.iter_batches(prefix, batch_size), []) == trie.keys(prefix)
+
+
+@given(
+    st.sets(text),
+    st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]),
+)
+def test_count(keys, order):
+    trie = marisa_trie.Trie(keys, order=order)
+    assert trie.count() == len(keys)
+    for key in keys:
+        for prefix in [key, key[:1], key[:2], key + "x"]:
+            assert trie.count(prefix) == len(trie.keys(prefix))
+            assert trie.has_prefix(prefix) == bool(trie.keys(prefix))
+
+
+def test_count_empty():
+    trie = marisa_trie.Trie()
+    assert trie.count() == 0
+    assert not trie.has_prefix()
+    with pytest.raises(TypeError):
+        marisa_trie.Trie(["a"]).count(1)
+
+
+@given(
+    st.sets(text),
+    st.one_of(st.none(), text),
+    st.one_of(st.none(), text),
+    st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]),
+)
+def test_range(keys, lo, hi, order):
+    trie = marisa_trie.Trie(keys, order=order)
+    expected = [
+        key.decode("utf8") for key in sorted(k.encode("utf8") for k in keys)
+        if (lo is None or key >= lo.encode("utf8"))
+        and (hi is None or key < hi.encode("utf8"))
+    ]
+    assert trie.range(lo, hi) == expected
+    assert list(trie.iter_range(lo, hi)) == expected
+    assert trie.range(lo, hi, limit=2) == expected[:2]
+    assert list(trie.iter_range(lo, hi, limit=1)) == expected[:1]
+
+
+def test_range_bounds():
+    trie = marisa_trie.Trie(["2024-01-01", "2024-01-31", "2024-02-01", "2024"])
+    assert trie.range("2024-01", "2024-02") == ["2024-01-01", "2024-01-31"]
+    assert trie.range("2024-01-31") == ["2024-01-31", "2024-02-01"]
+    assert trie.range(hi="2024-01-01") == ["2024"]
+    assert trie.range("2024-02", "2024-01") == []
+    assert trie.range(limit=0) == []
+    with pytest.raises(ValueError):
+        trie.range(limit=-1)
+    with pytest.raises(TypeError):
+        trie.range(b"2024")
+
+
+def test_scan_offsets():
+    trie = marisa_trie.Trie(["new", "new york", "york", "ёж", "ёжик", ""])
+    text = "a new york ёжик"
+    matches = trie.scan(text)
+    assert [text[start:end] for start, end, _ in matches] == [
+        "new", "new york", "york", "ёж", "ёжик"
+    ]
+    assert all(trie.restore_key(key_id) == text[start:end] for start, end, key_id in matches)
+    assert [text[start:end] for start, end, _ in trie.scan(text, longest=True)] == [
+        "new york", "york", "ёжик"
+    ]
+    assert [
+        text[start:end] for start, end, _ in trie.scan(text, longest=True, overlapping=False)
+    ] == ["new york", "ёжик"]
+    assert [text[start:end] for start, end, _ in trie.scan(text, overlapping=False)] == [
+        "new", "york", "ёж"
+    ]
+
+
+@given(st.sets(text))
+def test_restore_keys(keys):
+    trie = marisa_trie.Trie(keys)
+    ids = list(range(len(trie)))[::-1] * 2
+    expected = [trie.restore_key(key_id) for key_id in ids]
+
+    assert trie.restore_keys(ids) == expected
+    assert trie.restore_keys(array.array("i", ids)) == expected
+    assert trie.restore_keys(array.array("q", ids)) == expected
+    assert trie.restore_keys(iter(ids)) == expected
+
+    data, offsets = trie.restore_keys(ids, joined=True)
+    assert isinstance(offsets, array.array)
+    assert len(offsets) == len(ids) + 1
+    assert [
+        data[offsets[i]:offsets[i + 1]].decode("utf8") for i in range(len(ids))
+    ] == expected
+
+
+def test_restore_keys_invalid():
+    trie = marisa_trie.Trie(["foo", "bar"])
+    with pytest.raises(KeyError):
+        trie.restore_keys([0, 2])
+    with pytest.raises(KeyError):
+        trie.restore_keys(array.array("i", [-1]))
+    with pytest.raises(TypeError):
+        trie.restore_keys(["foo"])
+
+
+@given(st.lists(text), st.sampled_from([marisa_trie.LABEL_ORDER, marisa_trie.WEIGHT_ORDER]))
+def test_build_with_ids(keys, order):
+    trie, ids = marisa_trie.Trie.build_with_ids(keys, order=order)
+    assert isinstance(trie, marisa_trie.Trie)
+    assert trie == marisa_trie.Trie(keys, order=order)
+    assert isinstance(ids, array.array)
+    assert list(ids) == [trie[key] for key in keys]
+
+
 @settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
 @given(st.sets(text))
 def test_saveload(tmp_path, keys):
@@ -94,6 +438,214 @@ def test_saveload(tmp_path, keys):
         assert key in trie2
 
 
+@given(st.sets(text), st.sets(text))
+def test_save_load_fileobj(keys, keys2):
+    trie = marisa_trie.Trie(keys)
+    trie2 = marisa_trie.Trie(keys2)
+    f = io.BytesIO()
+    trie.save(f)
+    trie2.save(f)
+    assert f.getvalue() == trie.tobytes() + trie2.tobytes()
+
+    # only the bytes of each trie are read
+    f.seek(0)
+    assert marisa_trie.Trie().load(f).items() == trie.items()
+    assert marisa_trie.Trie().load(f).items() == trie2.items()
+    assert f.read() == b""
+
+
+@given(st.sets(text), st.lists(text))
+def test_prefilter(keys, queries):
+    trie = marisa_trie.Trie(keys, prefilter=True)
+    plain = marisa_trie.Trie(keys)
+    assert trie.has_prefilter
+    assert not plain.has_prefilter
+    assert trie == plain
+
+    queries = list(keys) + queries
+    assert [key in trie for key in queries] == [key in plain for key in queries]
+    assert [trie.get(key) for key in queries] == [plain.get(key) for key in queries]
+    assert list(trie.key_ids(queries)) == list(plain.key_ids(queries))
+    for key in keys:
+        assert trie[key] == plain[key]
+
+
+def test_prefilter_persistence(tmp_path):
+    keys = [str(i) for i in range(1000)]
+    trie = marisa_trie.Trie(keys, prefilter=16)
+    blob = trie.tobytes()
+    # the prefilter precedes the trie, so it doesn't change the trie itself
+    assert blob.endswith(marisa_trie.Trie(keys).tobytes())
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+    f = io.BytesIO()
+    trie.save(f)
+    trie.save(f)
+    assert f.getvalue() == blob + blob
+    f.seek(0)
+
+    loaded = [
+        marisa_trie.Trie().load(path),
+        marisa_trie.Trie().mmap(path),
+        marisa_trie.Trie().frombytes(blob),
+        marisa_trie.Trie().load(f),
+        marisa_trie.Trie().load(f),
+        pickle.loads(pickle.dumps(trie)),
+        pickle.loads(pickle.dumps(marisa_trie.Trie().map(blob), protocol=5)),
+    ]
+    for trie2 in loaded:
+        assert trie2.has_prefilter
+        assert trie2.tobytes() == blob
+        assert "1" in trie2 and "1000" not in trie2
+
+    # a prefilter added to a mapped trie is pickled too
+    trie2 = marisa_trie.Trie().map(marisa_trie.Trie(keys).tobytes()).build_prefilter()
+    assert pickle.loads(pickle.dumps(trie2, protocol=5)).has_prefilter
+
+    assert not trie2.build_prefilter(0).has_prefilter
+    assert not trie2.load(path).frombytes(marisa_trie.Trie(keys).tobytes()).has_prefilter
+    with pytest.raises(ValueError):
+        trie2.build_prefilter(65)
+
+
+def test_prefilter_unseekable_stream():
+    tries = [
+        marisa_trie.Trie(["foo", "bar"], prefilter=True),
+        marisa_trie.Trie(["baz"]),
+        marisa_trie.Trie(["qux"], prefilter=True),
+    ]
+    f = io.BytesIO()
+    for trie in tries:
+        trie.save(f)
+    reader = Reader(f.getvalue())
+    for trie in tries:
+        trie2 = marisa_trie.Trie().load(reader)
+        assert trie2.has_prefilter == trie.has_prefilter
+        assert trie2.tobytes() == trie.tobytes()
+    assert reader.read(1) == b""
+
+
+def test_prefilter_invalid():
+    blob = bytearray(marisa_trie.Trie(["foo"], prefilter=True).tobytes())
+    assert blob[:8] == b"MARISAPF"
+    with pytest.raises(ValueError):
+        marisa_trie.Trie().map(blob[:40])
+    with pytest.raises(ValueError):
+        marisa_trie.Trie().load(io.BytesIO(blob[:40]))
+
+    blob[8] = 2
+    with pytest.raises(ValueError):
+        marisa_trie.Trie().frombytes(bytes(blob))
+
+    # other data after a trie is ignored as before
+    trie = marisa_trie.Trie().map(marisa_trie.Trie(["foo"]).tobytes() + b"\0" * 64)
+    assert not trie.has_prefilter
+    assert "foo" in trie
+
+
+@given(st.lists(text), st.integers(0, 10), st.integers(0, 10))
+def test_top_k(keys, prefix_len, k):
+    weights = [float(i % 7) for i in range(len(keys))]
+    trie = marisa_trie.Trie(keys, weights=weights, store_weights=True)
+    prefix = keys[0][:prefix_len] if keys else ""
+    totals = {}
+    for key, weight in zip(keys, weights):
+        totals[key] = totals.get(key, 0.0) + weight
+    expected = sorted(
+        ((key, weight) for key, weight in totals.items() if key.startswith(prefix)),
+        key=lambda item: (-item[1], item[0].encode("utf8")),
+    )
+    assert trie.top_k(prefix, k) == expected[:k]
+
+
+def test_top_k_persistence(tmp_path):
+    keys = ["foo", "foobar", "fox", "bar", "food", "foo"]
+    weights = [1, 5, 3, 10, 2, 4]
+    trie = marisa_trie.Trie(keys, weights=weights, store_weights=True, prefilter=True)
+    expected = [("foo", 5.0), ("foobar", 5.0), ("fox", 3.0)]
+    assert trie.has_weights
+    assert trie.top_k("fo", 3) == expected
+    assert trie.top_k("x", 3) == []
+    blob = trie.tobytes()
+    assert blob.endswith(marisa_trie.Trie(keys, weights=weights).tobytes())
+
+    path = str(tmp_path / f"{uuid4()}.bin")
+    trie.save(path)
+    f = io.BytesIO()
+    trie.save(f)
+    trie.save(f)
+    f.seek(0)
+    loaded = [
+        marisa_trie.Trie().load(path),
+        marisa_trie.Trie().mmap(path),
+        marisa_trie.Trie().frombytes(blob),
+        marisa_trie.Trie().load(f),
+        marisa_trie.Trie().load(Reader(blob)),
+        pickle.loads(pickle.dumps(trie)),
+        pickle.loads(pickle.dumps(marisa_trie.Trie().map(blob), protocol=5)),
+    ]
+    for trie2 in loaded:
+        assert trie2.has_weights and trie2.has_prefilter
+        assert trie2.top_k("fo", 3) == expected
+        assert trie2.tobytes() == blob
+
+    # the weights are replaced (and the index rebuilt) when reloading
+    trie.frombytes(marisa_trie.Trie(["a", "b"], weights=[1, 2], store_weights=True).tobytes())
+    assert trie.top_k("", 1) == [("b", 2.0)]
+    trie.frombytes(marisa_trie.Trie(["a", "b"], weights=[1, 2]).tobytes())
+    assert not trie.has_weights
+    with pytest.raises(ValueError):
+        trie.top_k("", 1)
+
+    binary_trie = marisa_trie.BinaryTrie([b"a", b"b"], weights=[2, 1], store_weights=True)
+    assert binary_trie.top_k(b"", 5) == [(b"a", 2.0), (b"b", 1.0)]
+    with pytest.raises(ValueError):
+        binary_trie.top_k(b"", -1)
+
+
+def test_top_k_invalid_weights():
+    blob = marisa_trie.Trie(["foo", "bar"], store_weights=True).tobytes()
+    assert blob[:8] == b"MARISAWT"
+    # two weights for a trie with one key
+    blob = blob[:64] + marisa_trie.Trie(["foo"]).tobytes()
+    trie = marisa_trie.Trie()
+    with pytest.raises(ValueError):
+        trie.frombytes(blob)
+    assert not trie.has_weights
+
+
+def test_save_load_fileobj_errors():
+    class BrokenFile:
+        def write(self, data):
+            raise ZeroDivisionError
+
+        def readinto(self, buffer):
+            raise ZeroDivisionError
+
+    trie = marisa_trie.Trie(["foo", "bar"])
+    with pytest.raises(ZeroDivisionError):
+        trie.save(BrokenFile())
+    with pytest.raises(ZeroDivisionError):
+        marisa_trie.Trie().load(BrokenFile())
+    with pytest.raises(RuntimeError):
+        marisa_trie.Trie().load(io.BytesIO(trie.tobytes()[:-1]))
+
+
+def test_load_read_only_fileobj():
+    class ChunkedFile:
+        def __init__(self, data):
+            self.data = data
+
+        def read(self, size):
+            size = min(size, 3)
+            chunk, self.data = self.data[:size], self.data[size:]
+            return chunk
+
+    trie = marisa_trie.Trie(["foo", "bar"])
+    assert marisa_trie.Trie().load(ChunkedFile(trie.tobytes())).keys() == trie.keys()
+
+
 @settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
 @given(st.sets(text))
 def test_mmap(tmp_path, keys):
@@ -153,6 +705,73 @@ def test_tobytes_frombytes(keys):
         assert trie2.key_id(key) == trie.key_id(key)
 
 
+@pytest.mark.skipif(sys.maxsize < 2**32, reason="needs a 64-bit platform")
+def test_map_over_2gb(tmp_path):
+    # a small trie at the start of a sparse file of more than 2 GB
+    trie = marisa_trie.Trie(["foo", "bar", "foobar"])
+    path = str(tmp_path / f"{uuid4()}.bin")
+    with open(path, "wb") as f:
+        f.write(trie.tobytes())
+        f.truncate(2**31 + 4096)
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    trie2 = marisa_trie.Trie().map(mapped)
+    assert trie2.items() == trie.items()
+    del trie2
+    mapped.close()
+
+
+def _random_keys(num_keys, length, seed=0):
+    rng = random.Random(seed)
+    for _ in range(num_keys):
+        yield rng.randbytes(length // 2).hex()
+
+
+def _check_large_trie(tmp_path, num_keys, length):
+    trie = marisa_trie.Trie(_random_keys(num_keys, length))
+    path = str(tmp_path / f"{uuid4()}.marisa")
+    trie.save(path)
+    del trie
+
+    trie = marisa_trie.Trie().mmap(path)
+    assert len(trie) == num_keys
+    for i, key in enumerate(_random_keys(num_keys, length)):
+        if i % 1000 == 0:
+            assert key in trie
+            assert trie.restore_key(trie.key_id(key)) == key
+    return os.path.getsize(path)
+
+
+def test_max_num_keys():
+    # key IDs are returned as C ints and array('i'), with -1 for misses,
+    # so the limit keeps every ID positive
+    assert marisa_trie._MAX_NUM_KEYS == 2**31 - 1
+    ids = array.array("i", [marisa_trie._MAX_NUM_KEYS - 1, -1])
+    assert ids[0] > 0
+    with pytest.raises(OverflowError):
+        array.array("i", [marisa_trie._MAX_NUM_KEYS + 1])
+
+    trie = marisa_trie.Trie(["foo"])
+    with pytest.raises(KeyError):
+        trie.restore_key(marisa_trie._MAX_NUM_KEYS - 1)
+
+
+def test_large_trie_helpers(tmp_path):
+    assert _check_large_trie(tmp_path, 100, 64) > 100 * 64
+
+
+@pytest.mark.skipif(
+    not os.environ.get("MARISA_TRIE_LARGE_TESTS"),
+    reason="set MARISA_TRIE_LARGE_TESTS=1 to build a trie over 2 GB "
+    "(needs about 6 GB of memory)",
+)
+def test_build_over_2gb(tmp_path):
+    # random keys share almost nothing, so the image is about as large as
+    # the keys themselves
+    assert _check_large_trie(tmp_path, 2_200_000, 1024) > 2**31
+
+
 @given(st.sets(text))
 def test_dumps_loads(keys):
     trie = marisa_trie.Trie(keys)
@@ -165,6 +784,148 @@ def test_dumps_loads(keys):
         assert trie2.key_id(key) == trie.key_id(key)
 
 
+def test_map_keeps_buffer():
+    data = bytearray(marisa_trie.Trie(["foo", "bar"]).tobytes())
+    trie = marisa_trie.Trie().map(data)
+    with pytest.raises(BufferError):
+        data.extend(b"x")
+    assert "foo" in trie
+
+    trie.frombytes(bytes(data))
+    data.extend(b"x")
+    with pytest.raises(ValueError):
+        trie.map(object())
+
+
+@pytest.mark.parametrize("advice", [None, "normal", "random", "sequential", "willneed"])
+def test_mmap_options(tmp_path, advice):
+    keys = [str(i) for i in range(10000)]
+    path = str(tmp_path / f"{uuid4()}.bin")
+    marisa_trie.Trie(keys).save(path)
+
+    trie = marisa_trie.Trie().mmap(path, populate=True, advice=advice)
+    assert trie.keys() == marisa_trie.Trie(keys).keys()
+    fraction = trie.resident_fraction()
+    if fraction is not None:
+        assert fraction == 1.0
+
+
+def test_mmap_invalid_options(tmp_path):
+    path = str(tmp_path / f"{uuid4()}.bin")
+    marisa_trie.Trie(["foo"]).save(path)
+    with pytest.raises(ValueError):
+        marisa_trie.Trie().mmap(path, advice="never")
+
+    try:
+        trie = marisa_trie.Trie().mmap(path, lock=True)
+    except OSError:
+        pass  # unsupported, or over RLIMIT_MEMLOCK
+    else:
+        assert "foo" in trie
+
+
+def test_warmup(tmp_path):
+    path = str(tmp_path / f"{uuid4()}.bin")
+    marisa_trie.Trie([str(i) for i in range(10000)]).save(path)
+
+    trie = marisa_trie.Trie().mmap(path)
+    thread = trie.warmup()
+    # the thread keeps the mapping while the trie is reloaded
+    trie.frombytes(marisa_trie.Trie(["foo"]).tobytes())
+    thread.join()
+    assert trie.keys() == ["foo"]
+    assert trie.resident_fraction() is None
+    assert not trie.warmup(wait=True).is_alive()
+
+    trie.mmap(path)
+    assert not trie.warmup(wait=True).is_alive()
+    assert trie.resident_fraction() in (None, 1.0)
+
+
+def test_handle():
+    data = bytearray(marisa_trie.Trie(["foo", "bar"]).tobytes())
+    handle = marisa_trie.TrieHandle(marisa_trie.Trie().map(data))
+    reader = handle.get()
+
+    assert handle.swap_from(marisa_trie.Trie(["baz"])) is reader
+    assert handle.get().keys() == ["baz"]
+    # the previous trie is untouched and keeps its buffer for its readers
+    assert reader.keys() == ["bar", "foo"]
+    with pytest.raises(BufferError):
+        data.extend(b"x")
+    del reader
+    data.extend(b"x")
+
+    with pytest.raises(TypeError):
+        handle.swap_from(marisa_trie.BinaryTrie([b"baz"]))
+    assert handle.get().keys() == ["baz"]
+
+
+def test_shared_memory():
+    trie = marisa_trie.Trie(["foo", "bar", "foobar"]).to_shared_memory()
+    shm = trie.shared_memory
+    try:
+        assert trie.keys("foo") == ["foo", "foobar"]
+        data = pickle.dumps(trie)
+        assert len(data) < len(trie.tobytes())
+
+        trie2 = pickle.loads(data)
+        assert trie2.shared_memory.name == shm.name
+        assert trie2.items() == trie.items()
+        assert marisa_trie.Trie().from_shared_memory(shm.name).keys() == trie.keys()
+
+        # the block stays open while a trie is mapped from it
+        with pytest.raises(BufferError):
+            shm.close()
+        trie.frombytes(trie.tobytes())
+        assert trie.shared_memory is None
+    finally:
+        shm.unlink()
+
+
+def test_shared_memory_close(monkeypatch):
+    trie = marisa_trie.Trie(["foo", "bar"]).to_shared_memory()
+    shm = trie.shared_memory
+    try:
+        trie2 = marisa_trie.Trie().from_shared_memory(shm.name)
+        cursor = trie2.cursor()
+        assert cursor.push("fo")
+        trie2.close()
+        assert len(trie2) == 0 and trie2.shared_memory is None
+        assert not cursor.is_key and cursor.keys() == []
+
+        # a trie collected by the garbage collector releases the block
+        # before it is finalized
+        errors = []
+        monkeypatch.setattr(sys, "unraisablehook", errors.append)
+        trie3 = pickle.loads(pickle.dumps(trie))
+        cycle = [trie3]
+        cycle.append(cycle)
+        del trie3, cycle
+        gc.collect()
+        assert errors == []
+    finally:
+        trie.close()
+        shm.unlink()
+
+
+@given(st.sets(text))
+def test_pickle_out_of_band(keys):
+    trie = marisa_trie.Trie(keys)
+    buffers = []
+    data = pickle.dumps(trie, protocol=5, buffer_callback=buffers.append)
+    assert len(buffers) == 1
+
+    trie2 = pickle.loads(data, buffers=buffers)
+    assert trie2.items() == trie.items()
+    # a mapped trie sends the buffer it is mapped from
+    buffers2 = []
+    pickle.dumps(trie2, protocol=5, buffer_callback=buffers2.append)
+    assert buffers2[0].raw() == buffers[0].raw()
+
+    assert pickle.loads(pickle.dumps(trie, protocol=5)).items() == trie.items()
+
+
 def test_contains_empty():
     assert "foo" not in marisa_trie.Trie()
 
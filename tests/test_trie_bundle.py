@@ -0,0 +1,123 @@
+import io
+from collections.abc import Mapping
+from uuid import uuid4
+
+import pytest
+import hypothesis.strategies as st
+from hypothesis import given, settings, HealthCheck
+
+import marisa_trie
+
+from .utils import text
+
+
+def _tries():
+    return {
+        "vocab": marisa_trie.Trie(["foo", "bar", "foobar"]),
+        "binary": marisa_trie.BinaryTrie([b"\x00", b"\xff"]),
+        "bytes": marisa_trie.BytesTrie([("foo", b"a=b")], value_separator=b"="),
+        "stats": marisa_trie.RecordTrie("<H?", [("foo", (1, True)), ("bar", (2, False))]),
+        "aliases": marisa_trie.StringTrie([("nyc", "new york"), ("la", "los angeles")]),
+        "scores": marisa_trie.NumericTrie([("foo", 1.5)], typecode="d"),
+        "payloads": marisa_trie.PayloadTrie([("foo", b"x"), ("foo", b"")]),
+    }
+
+
+def _check_bundle(bundle, tries):
+    assert bundle.keys() == list(tries)
+    assert len(bundle) == len(tries)
+    for name, trie in tries.items():
+        assert name in bundle
+        assert type(bundle[name]) is type(trie)
+        assert bundle[name] is bundle[name]
+        assert bundle[name].items() == trie.items()
+    assert "missing" not in bundle
+    assert bundle.get("missing") is None
+    with pytest.raises(KeyError):
+        bundle["missing"]
+
+
+def test_mmap(tmp_path):
+    tries = _tries()
+    path = str(tmp_path / f"{uuid4()}.bundle")
+    marisa_trie.TrieBundle(tries).save(path)
+
+    bundle = marisa_trie.TrieBundle().mmap(path)
+    bundle.verify()
+    _check_bundle(bundle, tries)
+    # the format and the separator are restored from the index
+    assert bundle["stats"]["foo"] == [(1, True)]
+    assert bundle["bytes"]["foo"] == [b"a=b"]
+
+
+def test_mmap_warmup(tmp_path):
+    tries = _tries()
+    path = str(tmp_path / f"{uuid4()}.bundle")
+    marisa_trie.TrieBundle(tries).save(path)
+
+    bundle = marisa_trie.TrieBundle().mmap(path, populate=True, advice="willneed")
+    assert bundle.resident_fraction() in (None, 1.0)
+    bundle.warmup(wait=True)
+    _check_bundle(bundle, tries)
+
+
+def test_save_load_fileobj():
+    tries = _tries()
+    f = io.BytesIO()
+    marisa_trie.TrieBundle(tries.items()).save(f)
+    f.seek(0)
+    bundle = marisa_trie.TrieBundle().load(f)
+    _check_bundle(bundle, tries)
+
+    # a loaded bundle can be saved again
+    f2 = io.BytesIO()
+    bundle.save(f2)
+    assert f2.getvalue() == f.getvalue()
+
+
+@settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
+@given(st.dictionaries(text, st.sets(text), max_size=5))
+def test_sections(tmp_path, data):
+    tries = {name: marisa_trie.Trie(keys) for name, keys in data.items()}
+    path = str(tmp_path / f"{uuid4()}.bundle")
+    marisa_trie.TrieBundle(tries).save(path)
+    _check_bundle(marisa_trie.TrieBundle().mmap(path), tries)
+
+
+def test_page_aligned_sections():
+    f = io.BytesIO()
+    marisa_trie.TrieBundle(_tries()).save(f)
+    data = f.getvalue()
+    bundle = marisa_trie.TrieBundle().map(data)
+    for name in bundle:
+        blob = bundle[name].tobytes()
+        offset = data.index(blob, 4096)
+        assert offset % 4096 == 0
+
+
+def test_invalid():
+    with pytest.raises(TypeError):
+        marisa_trie.TrieBundle({"foo": {}})
+    with pytest.raises(TypeError):
+        marisa_trie.TrieBundle({b"foo": marisa_trie.Trie()})
+    with pytest.raises(ValueError):
+        marisa_trie.TrieBundle([("foo", marisa_trie.Trie()), ("foo", marisa_trie.Trie())])
+
+    f = io.BytesIO()
+    marisa_trie.TrieBundle(_tries()).save(f)
+    data = f.getvalue()
+    with pytest.raises(ValueError):
+        marisa_trie.TrieBundle().map(b"not-a-valid-bundle" * 2)
+    with pytest.raises(ValueError):
+        marisa_trie.TrieBundle().map(data[:-1])
+
+    corrupted = bytearray(data)
+    corrupted[4096 + 100] ^= 0xFF
+    bundle = marisa_trie.TrieBundle().map(corrupted)
+    with pytest.raises(ValueError):
+        bundle.verify()
+
+
+def test_mapping():
+    for method in Mapping.__abstractmethods__:
+        assert hasattr(marisa_trie.TrieBundle, method)
@@ -1,4 +1,5 @@
 import concurrent.futures
+import io
 import threading
 import string
 
@@ -6,13 +7,23 @@ import pytest
 import hypothesis.strategies as st
 
 
-__all__ = ("text", "records", "run_threaded")
+__all__ = ("text", "records", "run_threaded", "Reader")
 
 
 text = st.text(f"абвгдеёжзиклмнопрстуфхцчъыьэюя{string.ascii_lowercase}")
 records = st.tuples(st.integers(min_value=0, max_value=2**16 - 1), st.booleans())
 
 
+class Reader:
+    """A read-only stream which can neither peek nor seek."""
+
+    def __init__(self, data):
+        self._f = io.BytesIO(data)
+
+    def read(self, size):
+        return self._f.read(size)
+
+
 def run_threaded(
     func,
     max_workers=8,